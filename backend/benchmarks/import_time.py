@@ -0,0 +1,119 @@
+"""Cold import time of server.py, with a JSON baseline and a regression gate.
+
+Each run imports the app in a fresh interpreter, which is what a worker boot
+or a reload pays before it can serve. Reports the median wall time and the
+slowest top-level imports (from ``python -X importtime``). Fails when the
+median is more than ``--threshold`` slower than the baseline, or when a
+module in HEAVY_MODULES is loaded at import time instead of at first use.
+
+    cd backend
+    python -m benchmarks.import_time
+    python -m benchmarks.import_time --save      # refresh the baseline
+
+Nothing connects to MongoDB; importing the module must not need a database.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).parent
+BACKEND_DIR = BENCH_DIR.parent
+BASELINE_PATH = BENCH_DIR / "baselines" / "import_time.json"
+
+# Must only be imported by the code paths that use them
+HEAVY_MODULES = ["numpy", "pandas", "boto3", "botocore", "google.genai", "openai", "litellm", "emergentintegrations"]
+
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import server
+elapsed = time.perf_counter() - started
+print(json.dumps({"import_ms": elapsed * 1000, "loaded": [m for m in %r if m in sys.modules]}))
+""" % (HEAVY_MODULES,)
+
+
+def import_once(importtime: bool = False) -> tuple:
+    env = {**os.environ, "MONGO_URL": os.environ.get("MONGO_URL", "mongodb://localhost:27017"),
+           "DB_NAME": os.environ.get("DB_NAME", "import_time")}
+    command = [sys.executable, *(["-X", "importtime"] if importtime else []), "-c", PROBE]
+    result = subprocess.run(command, cwd=BACKEND_DIR, env=env, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def slowest_imports(importtime_log: str, top: int) -> list:
+    """Top-level modules imported by server.py, by cumulative microseconds."""
+    children, modules = [], []
+    for line in importtime_log.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        # The log is post-order: a module's direct imports are listed just before it
+        if depth == 1:
+            children.append((name.strip(), int(cumulative)))
+        elif depth == 0:
+            if name.strip() == "server":
+                modules = children + [("server (total)", int(cumulative))]
+            children = []
+    modules.sort(key=lambda m: m[1], reverse=True)
+    return [{"module": name, "cumulative_ms": round(us / 1000, 1)} for name, us in modules[:top]]
+
+
+def main(args) -> int:
+    _, importtime_log = import_once(importtime=True)
+    runs = [import_once()[0] for _ in range(args.warmup + args.repeat)][args.warmup:]
+    timings = [r["import_ms"] for r in runs]
+    loaded = sorted({m for r in runs for m in r["loaded"]})
+    result = {
+        "median_ms": round(statistics.median(timings), 1),
+        "min_ms": round(min(timings), 1),
+        "max_ms": round(max(timings), 1),
+        "runs": args.repeat
+    }
+
+    print(f"{'module':<36} {'cumulative ms':>14}")
+    for row in slowest_imports(importtime_log, args.top):
+        print(f"{row['module']:<36} {row['cumulative_ms']:>14}")
+    print(f"\nimport server: median {result['median_ms']} ms (min {result['min_ms']}, max {result['max_ms']}) over {args.repeat} runs")
+
+    baseline = json.loads(BASELINE_PATH.read_text())["result"] if BASELINE_PATH.exists() else None
+    if baseline:
+        change = result["median_ms"] / baseline["median_ms"] - 1
+        print(f"baseline {baseline['median_ms']} ms ({change:+.1%})")
+
+    if args.save:
+        BASELINE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        BASELINE_PATH.write_text(json.dumps({
+            "meta": {
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "created_at": datetime.now(timezone.utc).isoformat()
+            },
+            "result": result
+        }, indent=2, sort_keys=True) + "\n")
+        print(f"Baseline saved to {BASELINE_PATH}")
+
+    failed = False
+    if loaded:
+        print(f"\nLoaded at import time, should be lazy: {', '.join(loaded)}")
+        failed = True
+    if baseline and not args.save and change > args.threshold:
+        print(f"\nImport time regressed by more than {args.threshold:.0%}")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=1, help="runs discarded while the OS file cache warms up")
+    parser.add_argument("--top", type=int, default=15, help="how many of the slowest imports to list")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed median slowdown, e.g. 0.25 for 25%%")
+    parser.add_argument("--save", action="store_true", help="store this result as the new baseline")
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,201 @@
+"""In-process API benchmarks with JSON baselines and a regression gate.
+
+Drives ``server.app`` through httpx's ASGI transport at several data sizes
+and records p50/p95/mean latency per scenario. Each size is seeded with
+seed_data.py's generator into its own database. Results are compared against a
+stored baseline; the run fails if any scenario's p50 is more than
+``--threshold`` slower.
+
+    cd backend
+    python -m benchmarks.run --backend mongo --sizes 100,1000,10000
+    python -m benchmarks.run --backend memory --save      # refresh the baseline
+
+``--backend mongo`` uses MONGO_URL (databases ``<DB_NAME>_bench_<size>`` are
+dropped afterwards). ``--backend memory`` needs ``pip install mongomock-motor``.
+Its numbers only compare with other in-memory runs, so each backend keeps its
+own baseline file.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import httpx
+import numpy as np
+
+BENCH_DIR = Path(__file__).parent
+BASELINE_DIR = BENCH_DIR / "baselines"
+
+os.environ.setdefault("MONGO_TRANSACTIONS", "off")
+# Background jobs would compete with the measurements
+os.environ.setdefault("ARCHIVE_INTERVAL_HOURS", "0")
+os.environ.setdefault("LOOP_WATCHDOG_INTERVAL_MS", "0")
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# name -> (role, method, path); paths may use {deal_id}
+SCENARIOS = {
+    "get_deals": ("admin", "GET", "/api/deals"),
+    "get_dashboard_stats": ("admin", "GET", "/api/dashboard/stats"),
+    "get_dashboard_stats_agent": ("sales_agent", "GET", "/api/dashboard/stats"),
+    "get_pipeline": ("admin", "GET", "/api/dashboard/pipeline"),
+    "get_commissions": ("admin", "GET", "/api/commissions"),
+    "get_messages": ("admin", "GET", "/api/messages?deal_id={deal_id}"),
+    "upload_document": ("admin", "POST", "/api/documents/upload"),
+    "upload_progress": ("admin", "POST", "/api/progress-updates"),
+}
+UPLOAD_BYTES = 200 * 1024
+
+
+async def settle_background_tasks(app, timeout: float = 120):
+    """Let startup backfills and migrations finish before measuring."""
+    await asyncio.wait([app.state.migrations], timeout=timeout)
+
+
+def build_request(scenario: str, deal_id: str) -> dict:
+    _, method, path = SCENARIOS[scenario]
+    request = {"method": method, "url": path.format(deal_id=deal_id)}
+    if scenario == "upload_document":
+        request["data"] = {"deal_id": deal_id, "name": "Benchmark drawing", "doc_type": "pdf", "category": "client_facing"}
+        request["files"] = {"file": ("drawing.pdf", os.urandom(UPLOAD_BYTES), "application/pdf")}
+    elif scenario == "upload_progress":
+        request["data"] = {"deal_id": deal_id, "notes": "Benchmark", "progress_percentage": "50"}
+        request["files"] = [("photos", ("site.jpg", os.urandom(UPLOAD_BYTES), "image/jpeg"))]
+    return request
+
+
+async def measure(client: httpx.AsyncClient, headers: dict, scenario: str, deal_id: str, repeat: int, warmup: int) -> dict:
+    timings = []
+    for i in range(warmup + repeat):
+        request = build_request(scenario, deal_id)
+        started = time.perf_counter()
+        response = await client.request(**request, headers=headers)
+        elapsed = time.perf_counter() - started
+        if response.status_code != 200:
+            raise RuntimeError(f"{scenario} returned {response.status_code}: {response.text[:200]}")
+        if i >= warmup:
+            timings.append(elapsed * 1000)
+    timings = np.array(timings)
+    return {
+        "p50_ms": round(float(np.percentile(timings, 50)), 3),
+        "p95_ms": round(float(np.percentile(timings, 95)), 3),
+        "mean_ms": round(float(timings.mean()), 3),
+        "runs": repeat
+    }
+
+
+async def run_size(server, seed_data, database, backend: str, size: int, scenarios: list, repeat: int, warmup: int) -> dict:
+    server.db = server.BinaryIdDatabase(database)
+    if backend == "memory":
+        # mongomock-motor's with_options loses the async wrapper, and there is no secondary to route to
+        server.db._reporting = server.db
+    await seed_data.seed_sample(server, size, seed=size)
+    results = {}
+    async with server.app.router.lifespan_context(server.app):
+        await settle_background_tasks(server.app)
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            tokens = {}
+            for role in {SCENARIOS[s][0] for s in scenarios}:
+                response = await client.post("/api/auth/login", json={
+                    "email": f"{role}.0@{seed_data.LOAD_EMAIL_DOMAIN}", "password": seed_data.LOAD_PASSWORD
+                })
+                tokens[role] = {"Authorization": f"Bearer {response.json()['token']}"}
+            # A deal with messages, so get_messages measures real work
+            message = await server.db.messages.find_one({}, {"_id": 0, "deal_id": 1})
+            deal_id = message["deal_id"] if message else (await server.db.deals.find_one({}, {"_id": 0, "id": 1}))["id"]
+            for scenario in scenarios:
+                results[f"{scenario}@{size}"] = await measure(client, tokens[SCENARIOS[scenario][0]], scenario, deal_id, repeat, warmup)
+                print(f"  {scenario}@{size}: p50 {results[f'{scenario}@{size}']['p50_ms']} ms", flush=True)
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Print current vs baseline and return the keys that regressed."""
+    regressions = []
+    print(f"\n{'scenario':<36} {'p50 ms':>10} {'baseline':>10} {'change':>8}")
+    for key, row in results.items():
+        base = baseline.get(key)
+        if not base:
+            print(f"{key:<36} {row['p50_ms']:>10} {'-':>10} {'new':>8}")
+            continue
+        change = row["p50_ms"] / base["p50_ms"] - 1 if base["p50_ms"] else 0
+        flag = "  REGRESSION" if change > threshold else ""
+        print(f"{key:<36} {row['p50_ms']:>10} {base['p50_ms']:>10} {change:>+8.1%}{flag}")
+        if change > threshold:
+            regressions.append(key)
+    return regressions
+
+
+async def main(args) -> int:
+    sys.path.insert(0, str(BENCH_DIR.parent))
+    if args.backend == "memory":
+        try:
+            from mongomock_motor import AsyncMongoMockClient
+        except ImportError:
+            print("--backend memory needs mongomock-motor: pip install mongomock-motor", file=sys.stderr)
+            return 2
+        os.environ.setdefault("MONGO_URL", "mongodb://unused")
+        os.environ.setdefault("DB_NAME", "bench")
+    import server
+    import seed_data
+
+    if args.backend == "memory":
+        server.client = AsyncMongoMockClient(tz_aware=True)
+    upload_dir = Path(tempfile.mkdtemp(prefix="bench-uploads-"))
+    server.UPLOAD_DIR = upload_dir
+    scenarios = args.scenarios.split(",") if args.scenarios else list(SCENARIOS)
+    results = {}
+    try:
+        for size in [int(s) for s in args.sizes.split(",")]:
+            name = f"{os.environ['DB_NAME']}_bench_{size}"
+            print(f"Size {size}:", flush=True)
+            await server.client.drop_database(name)
+            try:
+                results.update(await run_size(server, seed_data, server.client[name], args.backend, size, scenarios, args.repeat, args.warmup))
+            finally:
+                await server.client.drop_database(name)
+    finally:
+        shutil.rmtree(upload_dir, ignore_errors=True)
+
+    baseline_path = Path(args.baseline) if args.baseline else BASELINE_DIR / f"{args.backend}.json"
+    baseline = json.loads(baseline_path.read_text())["results"] if baseline_path.exists() else {}
+    regressions = compare(results, baseline, args.threshold)
+
+    if args.save:
+        baseline_path.parent.mkdir(parents=True, exist_ok=True)
+        baseline_path.write_text(json.dumps({
+            "meta": {
+                "backend": args.backend,
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "created_at": datetime.now(timezone.utc).isoformat()
+            },
+            "results": {**baseline, **results}
+        }, indent=2, sort_keys=True) + "\n")
+        print(f"\nBaseline saved to {baseline_path}")
+        return 0
+    if regressions:
+        print(f"\n{len(regressions)} scenario(s) regressed by more than {args.threshold:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backend", choices=["mongo", "memory"], default="mongo")
+    parser.add_argument("--sizes", default="100,1000,10000", help="comma-separated deal counts")
+    parser.add_argument("--scenarios", help=f"comma-separated subset of: {', '.join(SCENARIOS)}")
+    parser.add_argument("--repeat", type=int, default=30)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed p50 slowdown, e.g. 0.25 for 25%%")
+    parser.add_argument("--baseline", help="baseline file (default: benchmarks/baselines/<backend>.json)")
+    parser.add_argument("--save", action="store_true", help="store these results as the new baseline")
+    sys.exit(asyncio.run(main(parser.parse_args())))
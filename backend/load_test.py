@@ -0,0 +1,200 @@
+"""Scripted per-role load against the ASGI app, fully offline.
+
+Drives ``server.app`` in-process through httpx's ASGI transport, so there is no
+network and no separate server. Run it against a database filled by
+seed_data.py. Each role gets ``--concurrency`` virtual users that log in as
+seeded users and loop through that role's weighted mix of dashboards, lists,
+uploads and logins. The report gives throughput and p50/p95/p99 latency per
+route.
+
+    python load_test.py --duration 60 --concurrency 5 [--roles admin,sales_agent] [--json report.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+import numpy as np
+
+from seed_data import LOAD_EMAIL_DOMAIN, LOAD_PASSWORD
+
+PHOTO_BYTES = 150 * 1024
+DOCUMENT_BYTES = 400 * 1024
+
+
+class VirtualUser:
+    def __init__(self, client: httpx.AsyncClient, role: str, index: int, stats: dict, rng: np.random.Generator):
+        self.client = client
+        self.role = role
+        self.email = f"{role}.{index}@{LOAD_EMAIL_DOMAIN}"
+        self.stats = stats
+        self.rng = rng
+        self.headers = {}
+        self.deal_ids = []
+
+    async def request(self, label: str, method: str, url: str, **kwargs) -> httpx.Response:
+        started = time.perf_counter()
+        response = await self.client.request(method, url, headers=self.headers, **kwargs)
+        entry = self.stats.setdefault(label, {"latencies": [], "errors": 0})
+        entry["latencies"].append(time.perf_counter() - started)
+        if response.status_code >= 400:
+            entry["errors"] += 1
+        return response
+
+    def pick_deal(self):
+        return self.deal_ids[int(self.rng.integers(len(self.deal_ids)))] if self.deal_ids else None
+
+    async def login(self):
+        response = await self.request("POST /api/auth/login", "POST", "/api/auth/login",
+                                      json={"email": self.email, "password": LOAD_PASSWORD})
+        if response.status_code != 200:
+            raise RuntimeError(f"Login failed for {self.email}; was the database seeded with seed_data.py?")
+        self.headers = {"Authorization": f"Bearer {response.json()['token']}"}
+
+    async def list_deals(self):
+        response = await self.request("GET /api/deals", "GET", "/api/deals")
+        if response.status_code == 200:
+            self.deal_ids = [d["id"] for d in response.json()[:200]]
+
+    async def get_deal(self):
+        if deal_id := self.pick_deal():
+            await self.request("GET /api/deals/{deal_id}", "GET", f"/api/deals/{deal_id}")
+
+    async def dashboard(self):
+        await self.request("GET /api/dashboard/stats", "GET", "/api/dashboard/stats")
+
+    async def pipeline(self):
+        await self.request("GET /api/dashboard/pipeline", "GET", "/api/dashboard/pipeline")
+
+    async def activity(self):
+        await self.request("GET /api/activity", "GET", "/api/activity")
+
+    async def commissions(self):
+        await self.request("GET /api/commissions", "GET", "/api/commissions")
+
+    async def tasks(self):
+        await self.request("GET /api/tasks", "GET", "/api/tasks")
+
+    async def messages(self):
+        if deal_id := self.pick_deal():
+            await self.request("GET /api/messages", "GET", "/api/messages", params={"deal_id": deal_id})
+
+    async def documents(self):
+        if deal_id := self.pick_deal():
+            await self.request("GET /api/documents", "GET", "/api/documents", params={"deal_id": deal_id})
+
+    async def typeahead(self):
+        prefix = "".join(self.rng.choice(list("abcdefghijklmnoprstw"), size=2))
+        await self.request("GET /api/search/typeahead", "GET", "/api/search/typeahead", params={"q": prefix})
+
+    async def upload_progress(self):
+        if deal_id := self.pick_deal():
+            await self.request("POST /api/progress-updates", "POST", "/api/progress-updates", data={
+                "deal_id": deal_id, "notes": "Load test progress", "progress_percentage": str(int(self.rng.integers(0, 100)))
+            }, files=[("photos", ("site.jpg", os.urandom(PHOTO_BYTES), "image/jpeg"))])
+
+    async def upload_document(self):
+        if deal_id := self.pick_deal():
+            await self.request("POST /api/documents/upload", "POST", "/api/documents/upload", data={
+                "deal_id": deal_id, "name": "Load test drawing", "doc_type": "pdf", "category": "client_facing"
+            }, files={"file": ("drawing.pdf", os.urandom(DOCUMENT_BYTES), "application/pdf")})
+
+
+# Weighted action mix per role
+ROLE_PROFILES = {
+    "admin": {"dashboard": 4, "pipeline": 3, "list_deals": 3, "get_deal": 2, "commissions": 2, "activity": 2, "typeahead": 1, "login": 0.2},
+    "sales_agent": {"dashboard": 4, "list_deals": 3, "get_deal": 2, "commissions": 3, "typeahead": 2, "activity": 1, "login": 0.2},
+    "project_manager": {"dashboard": 3, "list_deals": 2, "get_deal": 2, "tasks": 3, "messages": 2, "documents": 1,
+                        "upload_progress": 1, "upload_document": 0.5, "login": 0.2},
+    "supervisor": {"dashboard": 2, "tasks": 4, "get_deal": 1, "messages": 1, "upload_progress": 2, "login": 0.2},
+    "fabricator": {"dashboard": 2, "tasks": 4, "get_deal": 1, "upload_progress": 1, "login": 0.2},
+    "partner": {"dashboard": 2, "list_deals": 3, "get_deal": 2, "login": 0.2},
+    "client_b2b": {"dashboard": 3, "list_deals": 2, "get_deal": 3, "documents": 2, "messages": 2, "login": 0.2},
+    "client_residential": {"dashboard": 3, "list_deals": 2, "get_deal": 3, "documents": 2, "messages": 2, "login": 0.2}
+}
+
+
+async def run_user(user: VirtualUser, profile: dict, deadline: float):
+    actions = list(profile)
+    weights = np.array(list(profile.values()), dtype=float)
+    weights /= weights.sum()
+    await user.login()
+    await user.list_deals()
+    while time.perf_counter() < deadline:
+        await getattr(user, actions[int(user.rng.choice(len(actions), p=weights))])()
+
+
+def summarize(stats: dict, elapsed: float) -> dict:
+    report = {}
+    for label, entry in sorted(stats.items()):
+        latencies = np.array(entry["latencies"]) * 1000
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        report[label] = {
+            "requests": len(latencies),
+            "errors": entry["errors"],
+            "rps": round(len(latencies) / elapsed, 2),
+            "p50_ms": round(float(p50), 2),
+            "p95_ms": round(float(p95), 2),
+            "p99_ms": round(float(p99), 2)
+        }
+    return report
+
+
+def print_report(report: dict, elapsed: float):
+    print(f"\n{'route':<34} {'reqs':>7} {'err':>5} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for label, row in report.items():
+        print(f"{label:<34} {row['requests']:>7} {row['errors']:>5} {row['rps']:>8} "
+              f"{row['p50_ms']:>9} {row['p95_ms']:>9} {row['p99_ms']:>9}")
+    total = sum(row["requests"] for row in report.values())
+    print(f"\n{total} requests in {elapsed:.1f}s ({total / elapsed:.1f} req/s)")
+
+
+async def main(args):
+    os.environ.setdefault("MONGO_TRANSACTIONS", "off")
+    if args.db:
+        os.environ["DB_NAME"] = args.db
+    import server
+
+    # Keep load-test uploads out of the real upload directory
+    upload_dir = Path(tempfile.mkdtemp(prefix="loadtest-uploads-"))
+    server.UPLOAD_DIR = upload_dir
+    roles = args.roles.split(",") if args.roles else list(ROLE_PROFILES)
+    stats = {}
+    try:
+        async with server.app.router.lifespan_context(server.app):
+            transport = httpx.ASGITransport(app=server.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=None) as client:
+                users = [
+                    VirtualUser(client, role, i, stats, np.random.default_rng([args.seed, n]))
+                    for n, (role, i) in enumerate((role, i) for role in roles for i in range(args.concurrency))
+                ]
+                started = time.perf_counter()
+                deadline = started + args.duration
+                await asyncio.gather(*[run_user(u, ROLE_PROFILES[u.role], deadline) for u in users])
+                elapsed = time.perf_counter() - started
+    finally:
+        shutil.rmtree(upload_dir, ignore_errors=True)
+
+    report = summarize(stats, elapsed)
+    print_report(report, elapsed)
+    if args.json:
+        Path(args.json).write_text(json.dumps({
+            "duration_s": round(elapsed, 2), "concurrency": args.concurrency, "roles": roles, "routes": report
+        }, indent=2))
+    server.client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--duration", type=float, default=60, help="seconds to run")
+    parser.add_argument("--concurrency", type=int, default=5, help="virtual users per role")
+    parser.add_argument("--roles", help="comma-separated roles (default: all)")
+    parser.add_argument("--db", help="database to load (defaults to DB_NAME)")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", help="also write the report to this file")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,34 @@
+"""Run an online data migration to completion.
+
+The server also runs these in the background at startup; run one by hand to
+finish it before a rollout. Safe to interrupt and rerun.
+
+    python migrate.py datetimes|binary_ids|typeahead [--batch-size 500]
+"""
+import argparse
+import asyncio
+
+from server import client, backfill_typeahead_fields, migrate_binary_ids, migrate_datetimes
+
+MIGRATIONS = {
+    "datetimes": migrate_datetimes,
+    "binary_ids": migrate_binary_ids,
+    "typeahead": backfill_typeahead_fields
+}
+
+
+async def main(migration: str, batch_size: int):
+    converted = await MIGRATIONS[migration](batch_size=batch_size)
+    for name, count in converted.items():
+        if count:
+            print(f"{name}: {count} converted")
+    print(f"Done: {sum(converted.values())} documents converted")
+    client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("migration", choices=sorted(MIGRATIONS))
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+    asyncio.run(main(args.migration, args.batch_size))
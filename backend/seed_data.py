@@ -0,0 +1,305 @@
+"""Fill a local MongoDB with production-scale synthetic data.
+
+Generates users for every role, deals spread across all stages, and the tasks,
+messages, documents, commissions and activity that hang off them. Documents
+are shaped exactly like the ones the API writes. Every generated user can log
+in with LOAD_PASSWORD, as ``<role>.<n>@load.dealcentric.com``.
+
+    python seed_data.py --deals 1000000 [--db dealcentric_load] [--drop] [--seed 42]
+
+Runs fully offline against MONGO_URL; indexes are created when the server (or
+load_test.py) starts up.
+"""
+import argparse
+import asyncio
+import os
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+LOAD_PASSWORD = "Load@123"
+LOAD_EMAIL_DOMAIN = "load.dealcentric.com"
+
+STAGE_WEIGHTS = {
+    "inquiry": 0.18, "quotation": 0.12, "negotiation": 0.08, "contract": 0.06, "execution": 0.06,
+    "fabrication": 0.05, "installation": 0.05, "handover": 0.04, "completed": 0.26, "closed": 0.10
+}
+# (low, high) progress percentage per stage
+STAGE_PROGRESS = {
+    "execution": (10, 40), "fabrication": (30, 60), "installation": (60, 90), "handover": (90, 100), "completed": (100, 100)
+}
+SERVICE_TYPES = ["Interior Fit-out", "Facade Works", "Joinery", "MEP Works", "Landscaping", "Glazing", "Flooring"]
+NAME_PARTS = (
+    ["North", "Harbour", "Cedar", "Summit", "Riverside", "Grand", "Oak", "Marina", "Central", "Westgate"],
+    ["Tower", "Villa", "Plaza", "Residence", "Office", "Mall", "Clinic", "School", "Hotel", "Warehouse"],
+    ["Fit-out", "Renovation", "Extension", "Refurbishment", "Facade", "Phase 2", "Upgrade", "Build"]
+)
+MESSAGE_ROLES = [
+    ["admin", "project_manager"],
+    ["admin", "project_manager", "client_b2b", "client_residential"],
+    ["admin", "project_manager", "supervisor", "fabricator"]
+]
+DOC_CATEGORIES = ["client_facing", "internal", "deal_relationship"]
+
+
+def user_counts(args) -> dict:
+    return {
+        "admin": args.admins, "sales_agent": args.agents, "project_manager": args.pms, "supervisor": args.supervisors,
+        "fabricator": args.fabricators, "partner": args.partners, "client_b2b": args.clients // 2,
+        "client_residential": args.clients - args.clients // 2
+    }
+
+
+async def seed_users(server, counts: dict, rng: np.random.Generator, now: datetime) -> dict:
+    password = server.hash_password(LOAD_PASSWORD)
+    users = {}
+    for role, count in counts.items():
+        docs = []
+        for i in range(count):
+            doc = {
+                "id": str(uuid.uuid4()),
+                "email": f"{role}.{i}@{LOAD_EMAIL_DOMAIN}",
+                "password": password,
+                "name": f"{role.replace('_', ' ').title()} {i}",
+                "role": role,
+                "is_active": True,
+                "created_at": now - timedelta(days=int(rng.integers(30, 1000)))
+            }
+            if role == "sales_agent":
+                doc.update({"commission_rate": float(rng.choice([3.0, 4.0, 5.0, 6.0, 8.0])), "deals_won": 0, "total_commission_earned": 0})
+            if role in ("partner", "client_b2b"):
+                doc["company"] = f"{doc['name']} Ltd"
+            docs.append(doc)
+        if docs:
+            await server.db.users.insert_many(docs)
+        users[role] = docs
+    return users
+
+
+async def reserve_change_seqs(server, count: int) -> int:
+    """First of ``count`` consecutive change sequence numbers."""
+    counter = await server.db.counters.find_one_and_update(
+        {"_id": "change_seq"}, {"$inc": {"value": count}}, upsert=True, return_document=server.ReturnDocument.AFTER
+    )
+    return counter["value"] - count + 1
+
+
+def build_batch(server, size: int, users: dict, rng: np.random.Generator, now: datetime, args) -> dict:
+    stages = list(STAGE_WEIGHTS)
+    stage_idx = rng.choice(len(stages), size=size, p=list(STAGE_WEIGHTS.values()))
+    age_days = rng.uniform(0, 730, size)
+    touched_days = rng.uniform(0, 1, size) * np.minimum(age_days, 120)
+    estimated = np.round(rng.lognormal(np.log(50000), 1.0, size), -2)
+    # A few agents bring in most of the work
+    agent_idx = (rng.zipf(1.6, size) - 1) % max(len(users["sales_agent"]), 1)
+    has_agent = rng.random(size) < 0.85
+    clients = users["client_b2b"] + users["client_residential"]
+    client_idx = rng.integers(0, len(clients), size)
+
+    batch = {"deals": [], "tasks": [], "messages": [], "documents": [], "commissions": [], "activity_logs": []}
+    for i in range(size):
+        stage = stages[stage_idx[i]]
+        rank = server.STAGE_RANK.get(stage, -1)
+        created = now - timedelta(days=float(age_days[i]))
+        updated = created + timedelta(days=float(touched_days[i]))
+        client = clients[client_idx[i]]
+        agent = users["sales_agent"][agent_idx[i]] if has_agent[i] and users["sales_agent"] else None
+        name = " ".join(str(rng.choice(part)) for part in NAME_PARTS) + f" #{rng.integers(1, 10000)}"
+        won = rank >= server.STAGE_RANK[server.DealStage.CONTRACT] and stage != server.DealStage.CLOSED
+        contract_value = float(np.round(estimated[i] * rng.uniform(0.85, 1.15), -2)) if won else None
+        low, high = STAGE_PROGRESS.get(stage, (0, 0))
+        executing = stage in STAGE_PROGRESS
+        deal = {
+            "id": str(uuid.uuid4()),
+            "name": name,
+            "name_lc": name.lower(),
+            "client_name": client["name"],
+            "client_name_lc": client["name"].lower(),
+            "client_email": client["email"],
+            "client_email_lc": client["email"].lower(),
+            "client_phone": None,
+            "client_type": "B2B" if client["role"] == "client_b2b" else "Residential",
+            "service_types": [str(s) for s in rng.choice(SERVICE_TYPES, size=int(rng.integers(1, 4)), replace=False)],
+            "estimated_value": float(estimated[i]),
+            "contract_value": contract_value,
+            "amount_paid": round(contract_value * (1.0 if stage == "completed" else float(rng.uniform(0, 0.9))), 2) if won else 0,
+            "description": None,
+            "stage": stage,
+            "referral_agent_id": agent["id"] if agent else None,
+            "partner_ids": [users["partner"][rng.integers(len(users["partner"]))]["id"]] if users["partner"] and rng.random() < 0.1 else [],
+            "assigned_pm": users["project_manager"][rng.integers(len(users["project_manager"]))]["id"] if executing and users["project_manager"] else None,
+            "assigned_supervisor": users["supervisor"][rng.integers(len(users["supervisor"]))]["id"] if executing and users["supervisor"] else None,
+            "assigned_fabricators": [
+                users["fabricator"][j]["id"] for j in rng.choice(len(users["fabricator"]), size=min(2, len(users["fabricator"])), replace=False)
+            ] if executing and users["fabricator"] else [],
+            "start_date": created + timedelta(days=30) if executing else None,
+            "end_date": created + timedelta(days=150) if executing else None,
+            "progress_percentage": float(rng.integers(low, high + 1)) if executing else 0,
+            "revision": int(rng.integers(1, 12)),
+            "created_by": agent["id"] if agent else users["admin"][0]["id"],
+            "created_at": created,
+            "updated_at": updated,
+            "client_visible_notes": [],
+            "internal_notes": []
+        }
+        batch["deals"].append(deal)
+        batch["activity_logs"].append({
+            "id": str(uuid.uuid4()),
+            "entity_id": deal["id"],
+            "action": "deal_created",
+            "description": f"Deal '{name}' created",
+            "user_id": deal["created_by"],
+            "audience": server.deal_audience(deal),
+            "timestamp": created,
+            **server.activity_expiry(created)
+        })
+
+        if agent:
+            batch["commissions"].append({
+                "id": str(uuid.uuid4()),
+                "deal_id": deal["id"],
+                "agent_id": agent["id"],
+                "rate": agent["commission_rate"],
+                "status": "active" if won else "pending",
+                "earned_amount": round(contract_value * agent["commission_rate"] / 100, 2) if won else 0,
+                "released_amount": round(contract_value * agent["commission_rate"] / 100, 2) if stage == "completed" else 0,
+                "created_at": created
+            })
+
+        if executing:
+            for t in range(int(rng.poisson(args.tasks_per_deal))):
+                assignee = deal["assigned_fabricators"][0] if t % 2 and deal["assigned_fabricators"] else deal["assigned_supervisor"]
+                start = deal["start_date"] + timedelta(days=7 * t)
+                progress = float(min(100, max(0, deal["progress_percentage"] + rng.integers(-30, 30))))
+                batch["tasks"].append({
+                    "id": str(uuid.uuid4()),
+                    "deal_id": deal["id"],
+                    "name": f"Task {t + 1}",
+                    "description": None,
+                    "start_date": start,
+                    "end_date": start + timedelta(days=int(rng.integers(3, 21))),
+                    "assigned_to": assignee,
+                    "status": "completed" if progress >= 100 else ("in_progress" if progress > 0 else "pending"),
+                    "progress": progress,
+                    "revision": 1,
+                    "is_milestone": t == 0,
+                    "is_client_visible": bool(rng.random() < 0.5),
+                    "created_at": created
+                })
+
+        for m in range(int(rng.poisson(args.messages_per_deal))):
+            sender = agent or users["admin"][0]
+            batch["messages"].append({
+                "id": str(uuid.uuid4()),
+                "deal_id": deal["id"],
+                "content": f"Update {m + 1} on {name}",
+                "visible_to_roles": MESSAGE_ROLES[int(rng.integers(len(MESSAGE_ROLES)))],
+                "sender_id": sender["id"],
+                "sender_name": sender["name"],
+                "sender_role": sender["role"],
+                "created_at": created + timedelta(hours=6 * (m + 1))
+            })
+
+        for d in range(int(rng.poisson(args.documents_per_deal))):
+            category = DOC_CATEGORIES[int(rng.integers(len(DOC_CATEGORIES)))]
+            batch["documents"].append({
+                "id": str(uuid.uuid4()),
+                "deal_id": deal["id"],
+                "name": f"Document {d + 1}",
+                "name_lc": f"document {d + 1}",
+                "doc_type": "pdf",
+                "category": category,
+                "file_path": f"/uploads/{uuid.uuid4()}.pdf",
+                "version": 1,
+                "is_client_visible": category == "client_facing",
+                "approval_status": "approved" if rng.random() < 0.7 else "pending",
+                "uploaded_by": deal["created_by"],
+                "uploaded_by_name": "Load Generator",
+                "created_at": created + timedelta(days=d)
+            })
+    return batch
+
+
+async def insert_batch(server, batch: dict, now: datetime) -> dict:
+    """Stamp change sequence numbers on synced documents and insert the batch."""
+    synced = [doc for name in server.SYNCED_COLLECTIONS for doc in batch.get(name, [])]
+    first_seq = await reserve_change_seqs(server, len(synced))
+    for i, doc in enumerate(synced):
+        doc.update({"change_seq": first_seq + i, "changed_at": now})
+    counts = {}
+    for name, docs in batch.items():
+        if docs:
+            await getattr(server.db, name).insert_many(docs, ordered=False)
+            counts[name] = len(docs)
+    return counts
+
+
+def sample_args(deals: int) -> argparse.Namespace:
+    """User counts and child rates scaled to a ``deals``-sized sample."""
+    return argparse.Namespace(
+        admins=1, agents=max(5, deals // 200), pms=max(2, deals // 1000), supervisors=max(2, deals // 500),
+        fabricators=max(3, deals // 400), partners=2, clients=max(10, deals // 10),
+        tasks_per_deal=4, messages_per_deal=3, documents_per_deal=2
+    )
+
+
+async def seed_sample(server, deals: int, seed: int = 0, batch_size: int = 5000):
+    """Seed a small dataset into ``server.db``; used by the benchmarks and query plan tests."""
+    rng = np.random.default_rng(seed)
+    now = datetime.now(timezone.utc)
+    args = sample_args(deals)
+    users = await seed_users(server, user_counts(args), rng, now)
+    for offset in range(0, deals, batch_size):
+        await insert_batch(server, build_batch(server, min(batch_size, deals - offset), users, rng, now, args), now)
+
+
+async def seed(args):
+    os.environ.setdefault("MONGO_TRANSACTIONS", "off")
+    if args.db:
+        os.environ["DB_NAME"] = args.db
+    import server
+
+    rng = np.random.default_rng(args.seed)
+    now = datetime.now(timezone.utc)
+    if args.drop:
+        for name in ("users", "deals", "tasks", "messages", "documents", "commissions", "activity_logs", "counters"):
+            await server.db.raw.drop_collection(name)
+
+    users = await seed_users(server, user_counts(args), rng, now)
+    print(f"Users: {sum(len(v) for v in users.values())} (password {LOAD_PASSWORD})")
+
+    started = time.perf_counter()
+    totals = {}
+    for offset in range(0, args.deals, args.batch_size):
+        batch = build_batch(server, min(args.batch_size, args.deals - offset), users, rng, now, args)
+        for name, count in (await insert_batch(server, batch, now)).items():
+            totals[name] = totals.get(name, 0) + count
+        done = offset + len(batch["deals"])
+        elapsed = time.perf_counter() - started
+        print(f"\r{done}/{args.deals} deals ({done / elapsed:,.0f}/s)", end="", flush=True)
+    print()
+    for name, count in totals.items():
+        print(f"{name}: {count}")
+    server.client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--deals", type=int, default=1_000_000)
+    parser.add_argument("--db", help="database to fill (defaults to DB_NAME)")
+    parser.add_argument("--drop", action="store_true", help="drop the generated collections first")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--admins", type=int, default=5)
+    parser.add_argument("--agents", type=int, default=300)
+    parser.add_argument("--pms", type=int, default=60)
+    parser.add_argument("--supervisors", type=int, default=120)
+    parser.add_argument("--fabricators", type=int, default=250)
+    parser.add_argument("--partners", type=int, default=80)
+    parser.add_argument("--clients", type=int, default=20000)
+    parser.add_argument("--tasks-per-deal", type=float, default=4)
+    parser.add_argument("--messages-per-deal", type=float, default=3)
+    parser.add_argument("--documents-per-deal", type=float, default=2)
+    asyncio.run(seed(parser.parse_args()))
@@ -0,0 +1,172 @@
+"""Run the API on one port with several worker processes.
+
+The parent binds the socket once and starts ``--workers`` uvicorn processes
+that share it, so the kernel spreads connections across them. Workers keep
+caches and background jobs consistent through the coordinator in server.py
+(COORDINATION_BACKEND). Metrics from every worker are collected through
+PROMETHEUS_MULTIPROC_DIR. Behind a reverse proxy, list its address in
+TRUSTED_PROXIES so the app sees real client addresses.
+
+    python serve.py --workers 4 --port 8001
+
+Signals to the parent:
+    SIGHUP          rolling reload: start a fresh worker, wait until it serves,
+                    retire an old one, repeat; the port never stops answering
+    SIGTERM/SIGINT  stop; each worker finishes in-flight requests first
+A worker that exits unexpectedly is replaced.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import tempfile
+import threading
+from pathlib import Path
+
+import uvicorn
+
+logger = logging.getLogger("serve")
+
+# Lets the listening socket be pickled across to spawned workers
+multiprocessing.allow_connection_pickling()
+
+
+def run_worker(config: uvicorn.Config, ready, sockets=None):
+    """Worker process body: uvicorn's Server.run, plus a ready flag for the parent."""
+    # A spawned worker starts from a fresh interpreter, so logging is set up again
+    config.configure_logging()
+    server = uvicorn.Server(config)
+    config.setup_event_loop()
+
+    async def signal_ready():
+        while not server.started:
+            await asyncio.sleep(0.05)
+        ready.set()
+
+    async def serve():
+        watcher = asyncio.ensure_future(signal_ready())
+        try:
+            await server.serve(sockets=sockets)
+        finally:
+            watcher.cancel()
+
+    asyncio.run(serve())
+
+
+class Supervisor:
+    def __init__(self, config: uvicorn.Config, workers: int, ready_timeout: float):
+        self.config = config
+        self.workers = workers
+        self.ready_timeout = ready_timeout
+        self.sockets = [config.bind_socket()]
+        self.processes = {}  # process -> ready event
+        self.should_exit = threading.Event()
+        self.reload_requested = threading.Event()
+        self.failed_starts = 0
+        self.context = multiprocessing.get_context("spawn")
+
+    def spawn(self):
+        ready = self.context.Event()
+        process = self.context.Process(target=run_worker, args=(self.config, ready, self.sockets))
+        process.start()
+        self.processes[process] = ready
+        logger.info("Started worker [%s]", process.pid)
+        return process
+
+    def retire(self, process):
+        process.terminate()
+        process.join(self.config.timeout_graceful_shutdown or 30)
+        if process.is_alive():
+            logger.warning("Worker [%s] did not stop in time, killing it", process.pid)
+            process.kill()
+            process.join()
+        self.forget(process)
+
+    def forget(self, process):
+        self.processes.pop(process, None)
+        if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+            from prometheus_client import multiprocess
+            multiprocess.mark_process_dead(process.pid)
+
+    def reload(self):
+        logger.info("Reloading %d workers", len(self.processes))
+        for old in list(self.processes):
+            if self.should_exit.is_set():
+                return
+            new = self.spawn()
+            if not self.processes[new].wait(self.ready_timeout):
+                logger.error("New worker [%s] did not start within %ss; keeping the old workers", new.pid, self.ready_timeout)
+                self.retire(new)
+                return
+            self.retire(old)
+        logger.info("Reload complete")
+
+    def replace_dead(self):
+        for process in list(self.processes):
+            if process.is_alive():
+                continue
+            logger.warning("Worker [%s] exited with code %s, replacing it", process.pid, process.exitcode)
+            started = self.processes[process].is_set()
+            self.forget(process)
+            # A worker that dies before serving (bad config, database down) is retried with backoff
+            self.failed_starts = 0 if started else self.failed_starts + 1
+            if self.failed_starts and self.should_exit.wait(min(2 ** self.failed_starts, 60)):
+                return
+            self.spawn()
+
+    def run(self):
+        signal.signal(signal.SIGINT, lambda *_: self.should_exit.set())
+        signal.signal(signal.SIGTERM, lambda *_: self.should_exit.set())
+        signal.signal(signal.SIGHUP, lambda *_: self.reload_requested.set())
+        logger.info("Started parent process [%s]", os.getpid())
+        for _ in range(self.workers):
+            self.spawn()
+        while not self.should_exit.wait(0.5):
+            if self.reload_requested.is_set():
+                self.reload_requested.clear()
+                self.reload()
+            self.replace_dead()
+        for process in list(self.processes):
+            process.terminate()
+        for process in list(self.processes):
+            self.retire(process)
+        logger.info("Stopped parent process [%s]", os.getpid())
+
+
+def prepare_metrics_dir() -> Path:
+    """PROMETHEUS_MULTIPROC_DIR, created or cleared of a previous run's samples.
+
+    Must be set before workers import prometheus_client.
+    """
+    path = Path(os.environ.get("PROMETHEUS_MULTIPROC_DIR") or tempfile.mkdtemp(prefix="dealcentric-metrics-"))
+    path.mkdir(parents=True, exist_ok=True)
+    # Only prometheus_client's own files: the directory is operator-supplied and may hold other things
+    for sample_file in path.glob("*.db"):
+        sample_file.unlink()
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = str(path)
+    return path
+
+
+def main(args):
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s:     %(message)s")
+    prepare_metrics_dir()
+    config = uvicorn.Config(
+        # Forwarded headers are handled by the app itself (TRUSTED_PROXIES in server.py)
+        args.app, host=args.host, port=args.port, log_level=args.log_level, proxy_headers=False,
+        timeout_graceful_shutdown=args.graceful_timeout
+    )
+    Supervisor(config, args.workers, args.ready_timeout).run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--app", default="server:app", help="ASGI app import path")
+    parser.add_argument("--host", default=os.environ.get("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", "8001")))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1)))
+    parser.add_argument("--graceful-timeout", type=float, default=30, help="seconds a worker gets to finish in-flight requests")
+    parser.add_argument("--ready-timeout", type=float, default=60, help="seconds a reloaded worker gets to start serving")
+    parser.add_argument("--log-level", default="info")
+    main(parser.parse_args())
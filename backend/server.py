@@ -1,15 +1,50 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form, Header, Request, Response
+from fastapi.responses import JSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from uvicorn.middleware.proxy_headers import ProxyHeadersMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import InsertOne, UpdateOne, UpdateMany, ReplaceOne, DeleteOne, DeleteMany, ReturnDocument
+from pymongo.errors import DuplicateKeyError, CollectionInvalid, ExecutionTimeout
+from pymongo.read_preferences import make_read_preference, read_pref_mode_from_name
+from pymongo import monitoring
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, generate_latest, multiprocess, CONTENT_TYPE_LATEST
+from concurrent.futures import ThreadPoolExecutor
+from opentelemetry import trace, propagate
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider, SpanProcessor
+from opentelemetry.sdk.trace.export import SpanExporter, SpanExportResult, SimpleSpanProcessor, BatchSpanProcessor
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+from collections import deque
+import collections
+import functools
+from contextlib import asynccontextmanager
+from bson import Binary
+from bson.binary import UUID_SUBTYPE
 from fastapi.staticfiles import StaticFiles
+from python_multipart.multipart import MultipartParser, parse_options_header
 import os
+import asyncio
+import contextvars
 import logging
+import random
+import socket
+import statistics
+import sys
+import threading
+import time
+import traceback
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Set, Tuple, Callable
 import uuid
+from tempfile import SpooledTemporaryFile
+import copy
+import base64
+import hashlib
+import json
+import re
 from datetime import datetime, timezone, timedelta
 import jwt
 import bcrypt
@@ -17,23 +52,607 @@ import bcrypt
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
+# ==================== METRICS ====================
+# Prometheus metrics served at /metrics. Mongo command latency and document
+# counts come from pymongo's command monitoring and pool occupancy from its
+# pool events, so they are registered on the client below rather than wrapped
+# around individual queries.
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template", ["method", "route", "status"]
+)
+MONGO_COMMAND_SECONDS = Histogram(
+    "mongo_command_duration_seconds", "Mongo command latency", ["collection", "command", "outcome"]
+)
+MONGO_COMMAND_DOCUMENTS = Histogram(
+    "mongo_command_documents", "Documents returned or written per Mongo command", ["collection", "command"],
+    buckets=(0, 1, 10, 100, 1000, 10000, 100000)
+)
+# Under serve.py every worker has its own pool; livesum adds up the live workers
+MONGO_POOL_CONNECTIONS = Gauge("mongo_pool_connections", "Open pool connections", ["address"], multiprocess_mode="livesum")
+MONGO_POOL_CHECKED_OUT = Gauge("mongo_pool_checked_out", "Pool connections in use", ["address"], multiprocess_mode="livesum")
+MONGO_POOL_WAITING = Gauge("mongo_pool_waiting", "Operations waiting for a pool connection", ["address"], multiprocess_mode="livesum")
+MONGO_POOL_MAX_SIZE = Gauge("mongo_pool_max_size", "Configured maxPoolSize", ["address"], multiprocess_mode="livesum")
+MONGO_POOL_CHECKOUT_FAILURES = Counter(
+    "mongo_pool_checkout_failures_total", "Failed connection check-outs", ["address", "reason"]
+)
+UPLOAD_BYTES = Counter("upload_bytes_total", "Bytes received by upload endpoints", ["endpoint"])
+EVENT_LOOP_LAG_SECONDS = Histogram(
+    "event_loop_lag_seconds", "How late the loop heartbeat woke up",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+EVENT_LOOP_STALLS = Counter("event_loop_stalls_total", "Times the event loop was blocked past the threshold", ["route"])
+EVENT_LOOP_STALL_SECONDS = Histogram("event_loop_stall_duration_seconds", "How long each stall held the loop", ["route"])
+LOGIN_ATTEMPTS = Counter("login_attempts_total", "Login attempts by outcome", ["outcome"])
+LOGIN_REJECTED = Counter(
+    "login_rate_limited_total", "Logins turned away before any password check", ["scope", "source"]
+)
+LOGIN_BLOCKS = Counter("login_blocks_total", "Times an IP or account reached its failed-login limit", ["scope"])
+BCRYPT_QUEUE_DEPTH = Gauge("bcrypt_queue_depth", "Password hashes waiting for a bcrypt worker", multiprocess_mode="livesum")
+
+# Commands whose first field names the collection they run against
+COLLECTION_COMMANDS = {
+    "find", "insert", "update", "delete", "aggregate", "count", "distinct", "findAndModify", "createIndexes"
+}
+
+def command_documents(command_name: str, reply: dict) -> int:
+    cursor = reply.get("cursor")
+    if cursor:
+        return len(cursor.get("firstBatch", cursor.get("nextBatch", [])))
+    if command_name == "findAndModify":
+        return 1 if reply.get("value") else 0
+    return reply.get("n", 0)
+
+def command_collection(event) -> Optional[str]:
+    if event.command_name in COLLECTION_COMMANDS:
+        collection = event.command.get(event.command_name)
+    elif event.command_name == "getMore":
+        collection = event.command.get("collection")
+    else:
+        return None
+    return collection if isinstance(collection, str) else None
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    def __init__(self):
+        self._collections: Dict[Tuple[int, Any], str] = {}
+
+    def started(self, event):
+        collection = command_collection(event)
+        if collection is not None:
+            self._collections[(event.request_id, event.connection_id)] = collection
+
+    def succeeded(self, event):
+        collection = self._collections.pop((event.request_id, event.connection_id), None)
+        if collection is None:
+            return
+        MONGO_COMMAND_SECONDS.labels(collection, event.command_name, "ok").observe(event.duration_micros / 1e6)
+        MONGO_COMMAND_DOCUMENTS.labels(collection, event.command_name).observe(command_documents(event.command_name, event.reply))
+
+    def failed(self, event):
+        collection = self._collections.pop((event.request_id, event.connection_id), None)
+        if collection is not None:
+            MONGO_COMMAND_SECONDS.labels(collection, event.command_name, "error").observe(event.duration_micros / 1e6)
+
+POOL_GAUGES = {
+    "connections": MONGO_POOL_CONNECTIONS,
+    "checked_out": MONGO_POOL_CHECKED_OUT,
+    "waiting": MONGO_POOL_WAITING,
+    "max_size": MONGO_POOL_MAX_SIZE
+}
+
+class MongoPoolMetrics(monitoring.ConnectionPoolListener):
+    """Keeps per-server pool counts for /api/health and mirrors them into the gauges.
+
+    Pool events fire on whichever thread runs the operation, hence the lock.
+    """
+    def __init__(self):
+        self.pools: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def _add(self, event, field: str, delta: int):
+        address = self._address(event)
+        with self._lock:
+            pool = self.pools.setdefault(address, {"connections": 0, "checked_out": 0, "waiting": 0, "max_size": 100})
+            pool[field] += delta
+            POOL_GAUGES[field].labels(address).set(pool[field])
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {address: dict(pool) for address, pool in self.pools.items()}
+
+    def pool_created(self, event):
+        address = self._address(event)
+        max_size = event.options.get("maxPoolSize", 100)
+        with self._lock:
+            self.pools[address] = {"connections": 0, "checked_out": 0, "waiting": 0, "max_size": max_size}
+            MONGO_POOL_MAX_SIZE.labels(address).set(max_size)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        address = self._address(event)
+        with self._lock:
+            self.pools.pop(address, None)
+            for field in ("connections", "checked_out", "waiting"):
+                POOL_GAUGES[field].labels(address).set(0)
+
+    def connection_created(self, event):
+        self._add(event, "connections", 1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._add(event, "connections", -1)
+
+    def connection_check_out_started(self, event):
+        self._add(event, "waiting", 1)
+
+    def connection_check_out_failed(self, event):
+        self._add(event, "waiting", -1)
+        MONGO_POOL_CHECKOUT_FAILURES.labels(self._address(event), str(event.reason)).inc()
+
+    def connection_checked_out(self, event):
+        self._add(event, "waiting", -1)
+        self._add(event, "checked_out", 1)
+
+    def connection_checked_in(self, event):
+        self._add(event, "checked_out", -1)
+
+    @staticmethod
+    def _address(event) -> str:
+        return "%s:%s" % event.address
+
+mongo_pool_metrics = MongoPoolMetrics()
+
+# ==================== SLOW QUERY LISTENER ====================
+# Commands slower than SLOW_QUERY_MS are handed to record_slow_query() together
+# with the endpoint that issued them. The request scope travels in a context
+# variable, which motor copies into its executor threads where listeners run.
+
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '100'))
+request_scope: contextvars.ContextVar = contextvars.ContextVar("request_scope", default=None)
+
+class SlowQueryListener(monitoring.CommandListener):
+    def __init__(self):
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._started: Dict[Tuple[int, Any], tuple] = {}
+
+    def started(self, event):
+        collection = command_collection(event)
+        if collection is not None and collection != "slow_queries":
+            self._started[(event.request_id, event.connection_id)] = (
+                event.database_name, collection, event.command, request_scope.get()
+            )
+
+    def succeeded(self, event):
+        self._finished(event)
+
+    def failed(self, event):
+        self._finished(event)
+
+    def _finished(self, event):
+        started = self._started.pop((event.request_id, event.connection_id), None)
+        if started is None or self.loop is None or event.duration_micros < SLOW_QUERY_MS * 1000:
+            return
+        database_name, collection, command, scope = started
+        self.loop.call_soon_threadsafe(create_background_task, record_slow_query(
+            database_name, collection, event.command_name, command, event.duration_micros / 1000, scope
+        ))
+
+slow_query_listener = SlowQueryListener()
+
+# ==================== TRACING ====================
+# OpenTelemetry traces: each request is a root span (TracingMiddleware) and
+# every Mongo command, bcrypt hash, upload write and activity log entry a child
+# span. A TRACE_SAMPLE_RATE share of requests is recorded, or any request whose
+# incoming traceparent is sampled. Sampled responses carry a Server-Timing
+# breakdown. Spans are kept in an in-process buffer (GET /api/admin/traces)
+# and, when TRACE_EXPORT_FILE is set, appended to it as JSON lines.
+
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0.01'))
+TRACE_EXPORT_FILE = os.environ.get('TRACE_EXPORT_FILE', '')
+TRACE_BUFFER_SPANS = int(os.environ.get('TRACE_BUFFER_SPANS', '5000'))
+# Spans finished during the current request, for its Server-Timing header
+server_timings: contextvars.ContextVar = contextvars.ContextVar("server_timings", default=None)
+
+class RecentSpans(SpanExporter):
+    """In-process collector keeping the most recent spans."""
+    def __init__(self, max_spans: int):
+        self.spans = deque(maxlen=max_spans)
+
+    def export(self, spans):
+        self.spans.extend(spans)
+        return SpanExportResult.SUCCESS
+
+class JsonLinesSpanExporter(SpanExporter):
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, spans):
+        with open(self.path, "a") as f:
+            for span in spans:
+                f.write(span.to_json(indent=None) + "\n")
+        return SpanExportResult.SUCCESS
+
+class ServerTimingProcessor(SpanProcessor):
+    def on_end(self, span):
+        timings = server_timings.get()
+        if timings is not None and not is_root_span(span):
+            timings.append((span.name, (span.end_time - span.start_time) / 1e6))
+
+def is_root_span(span) -> bool:
+    """True for the request span, including one continuing a remote parent."""
+    return span.parent is None or span.parent.is_remote
+
+recent_spans = RecentSpans(TRACE_BUFFER_SPANS)
+tracer_provider = TracerProvider(
+    resource=Resource.create({"service.name": os.environ.get('OTEL_SERVICE_NAME', 'dealcentric-api')}),
+    sampler=ParentBased(TraceIdRatioBased(TRACE_SAMPLE_RATE))
+)
+tracer_provider.add_span_processor(ServerTimingProcessor())
+tracer_provider.add_span_processor(SimpleSpanProcessor(recent_spans))
+if TRACE_EXPORT_FILE:
+    # Batched so file writes happen on the exporter thread, not the event loop
+    tracer_provider.add_span_processor(BatchSpanProcessor(JsonLinesSpanExporter(TRACE_EXPORT_FILE)))
+tracer = tracer_provider.get_tracer("dealcentric")
+
+def traced(name: str):
+    """Run the decorated coroutine function inside a child span."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with tracer.start_as_current_span(name):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+class MongoTracingListener(monitoring.CommandListener):
+    def __init__(self):
+        self._spans: Dict[Tuple[int, Any], Any] = {}
+
+    def started(self, event):
+        if not trace.get_current_span().is_recording():
+            return
+        collection = command_collection(event)
+        name = f"mongo {event.command_name} {collection}" if collection else f"mongo {event.command_name}"
+        self._spans[(event.request_id, event.connection_id)] = tracer.start_span(
+            name, kind=trace.SpanKind.CLIENT, attributes={
+                "db.system": "mongodb", "db.name": event.database_name,
+                "db.operation": event.command_name, "db.mongodb.collection": collection or ""
+            }
+        )
+
+    def succeeded(self, event):
+        span = self._spans.pop((event.request_id, event.connection_id), None)
+        if span is not None:
+            span.end()
+
+    def failed(self, event):
+        span = self._spans.pop((event.request_id, event.connection_id), None)
+        if span is not None:
+            span.set_status(trace.Status(trace.StatusCode.ERROR, str(event.failure.get("errmsg", ""))))
+            span.end()
+
+# ==================== MONGO CONNECTION ====================
+# Pool size, timeouts and wire compression are tuned per deployment through the
+# environment. A variable that is unset leaves the driver default, or whatever
+# MONGO_URL says, in place.
+
+# env var -> (client option, type)
+MONGO_CLIENT_OPTIONS = {
+    "MONGO_MAX_POOL_SIZE": ("maxPoolSize", int),
+    "MONGO_MIN_POOL_SIZE": ("minPoolSize", int),
+    "MONGO_MAX_CONNECTING": ("maxConnecting", int),
+    "MONGO_MAX_IDLE_TIME_MS": ("maxIdleTimeMS", int),
+    "MONGO_WAIT_QUEUE_TIMEOUT_MS": ("waitQueueTimeoutMS", int),
+    "MONGO_SERVER_SELECTION_TIMEOUT_MS": ("serverSelectionTimeoutMS", int),
+    "MONGO_CONNECT_TIMEOUT_MS": ("connectTimeoutMS", int),
+    "MONGO_SOCKET_TIMEOUT_MS": ("socketTimeoutMS", int),
+    "MONGO_COMPRESSORS": ("compressors", str)
+}
+MONGO_CLIENT_DEFAULTS = {
+    # Fail a request after 5s without a reachable server rather than the driver's 30s
+    "MONGO_SERVER_SELECTION_TIMEOUT_MS": "5000",
+    # Negotiated with the server, first match wins; "snappy" also works with python-snappy installed
+    "MONGO_COMPRESSORS": "zstd,zlib"
+}
+
+def mongo_client_options() -> dict:
+    options = {}
+    for env, (option, cast) in MONGO_CLIENT_OPTIONS.items():
+        value = os.environ.get(env, MONGO_CLIENT_DEFAULTS.get(env))
+        if value:
+            options[option] = cast(value)
+    return options
+
+# Server-side limit on every read, so a runaway query is killed instead of
+# holding a pooled connection; 0 disables it. Dashboard and report reads get a
+# longer limit and go to a secondary when the deployment has one.
+MONGO_MAX_TIME_MS = int(os.environ.get('MONGO_MAX_TIME_MS', '15000'))
+MONGO_REPORTING_MAX_TIME_MS = int(os.environ.get('MONGO_REPORTING_MAX_TIME_MS', '60000'))
+MONGO_REPORTING_READ_PREFERENCE = os.environ.get('MONGO_REPORTING_READ_PREFERENCE', 'secondaryPreferred')
+# How far behind the primary a secondary may be and still serve reports; -1 is unbounded, else at least 90
+MONGO_REPORTING_MAX_STALENESS_SECONDS = int(os.environ.get('MONGO_REPORTING_MAX_STALENESS_SECONDS', '-1'))
+
+def reporting_read_preference():
+    mode = read_pref_mode_from_name(MONGO_REPORTING_READ_PREFERENCE)
+    return make_read_preference(mode, None, MONGO_REPORTING_MAX_STALENESS_SECONDS)
+
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# Timestamps are stored as BSON dates; tz_aware returns them as UTC-aware datetimes
+client = AsyncIOMotorClient(
+    mongo_url, tz_aware=True, **mongo_client_options(),
+    event_listeners=[MongoCommandMetrics(), mongo_pool_metrics, slow_query_listener, MongoTracingListener()]
+)
+
+# ==================== BINARY IDS ====================
+# Ids are uuid4 strings everywhere in the application and the API, but are
+# stored as 16-byte BSON UUIDs (binary subtype 4) instead of 36-char strings.
+# ``db`` wraps the database so the conversion happens in one place: id fields
+# are encoded on the way in and every binary UUID is decoded back to its string
+# on the way out. Until migrate_binary_ids has converted old documents, lookups
+# also match the legacy string form.
+
+ID_FIELDS = {
+    "id", "deal_id", "user_id", "agent_id", "referral_agent_id", "assigned_pm", "assigned_supervisor",
+    "assigned_fabricators", "partner_ids", "assigned_to", "entity_id", "created_by", "sender_id",
+    "commission_id", "client_id", "uploaded_by", "task_id", "released_by", "recorded_by"
+}
+# Turn off once migrate_binary_ids reports nothing left to convert
+BINARY_ID_LEGACY_LOOKUP = os.environ.get('BINARY_ID_LEGACY_LOOKUP', 'on') == 'on'
+
+def to_binary_id(value):
+    """The binary form of a canonical uuid string; anything else is returned unchanged."""
+    if isinstance(value, str) and len(value) == 36:
+        try:
+            parsed = uuid.UUID(value)
+        except ValueError:
+            return value
+        if str(parsed) == value:
+            return Binary.from_uuid(parsed)
+    return value
+
+def id_candidates(value) -> list:
+    binary = to_binary_id(value)
+    if binary is value:
+        return [value]
+    return [binary, value] if BINARY_ID_LEGACY_LOOKUP else [binary]
+
+def encode_id_condition(condition):
+    if isinstance(condition, dict) and any(k.startswith("$") for k in condition):
+        encoded = {}
+        for op, value in condition.items():
+            if op in ("$eq", "$ne"):
+                candidates = id_candidates(value)
+                if len(candidates) == 1:
+                    encoded[op] = candidates[0]
+                else:
+                    encoded["$in" if op == "$eq" else "$nin"] = candidates
+            elif op in ("$in", "$nin"):
+                encoded[op] = [c for v in value for c in id_candidates(v)]
+            elif op in ("$lt", "$lte", "$gt", "$gte"):
+                encoded[op] = to_binary_id(value)
+            else:
+                encoded[op] = value
+        return encoded
+    candidates = id_candidates(condition)
+    return candidates[0] if len(candidates) == 1 else {"$in": candidates}
+
+def encode_id_filter(query):
+    if not isinstance(query, dict):
+        return query
+    encoded = {}
+    for key, value in query.items():
+        if key in ("$and", "$or", "$nor"):
+            encoded[key] = [encode_id_filter(q) for q in value]
+        elif key in ID_FIELDS:
+            encoded[key] = encode_id_condition(value)
+        else:
+            encoded[key] = value
+    return encoded
+
+def encode_id_value(value):
+    if isinstance(value, list):
+        return [to_binary_id(v) for v in value]
+    if isinstance(value, dict):
+        if "$each" in value:
+            return {**value, "$each": [to_binary_id(v) for v in value["$each"]]}
+        if "$in" in value:
+            return {**value, "$in": [c for v in value["$in"] for c in id_candidates(v)]}
+        return value
+    return to_binary_id(value)
+
+def encode_id_document(document: dict) -> dict:
+    return {k: encode_id_value(v) if k in ID_FIELDS else v for k, v in document.items()}
+
+def encode_id_update(update):
+    if not isinstance(update, dict):
+        return update  # aggregation pipeline updates are passed through
+    return {op: encode_id_document(fields) if isinstance(fields, dict) else fields for op, fields in update.items()}
+
+def decode_ids(value):
+    if isinstance(value, dict):
+        return {k: decode_ids(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [decode_ids(v) for v in value]
+    if isinstance(value, Binary) and value.subtype == UUID_SUBTYPE:
+        return str(value.as_uuid())
+    return value
+
+def encode_id_operation(op):
+    """Encode a pymongo bulk write request; a request type not handled here raises TypeError."""
+    op = copy.copy(op)
+    if isinstance(op, InsertOne):
+        op._doc = encode_id_document(op._doc)
+    elif isinstance(op, (UpdateOne, UpdateMany)):
+        op._filter = encode_id_filter(op._filter)
+        op._doc = encode_id_update(op._doc)
+    elif isinstance(op, ReplaceOne):
+        op._filter = encode_id_filter(op._filter)
+        op._doc = encode_id_document(op._doc)
+    elif isinstance(op, (DeleteOne, DeleteMany)):
+        op._filter = encode_id_filter(op._filter)
+    else:
+        raise TypeError(f"Unsupported bulk write request: {type(op).__name__}")
+    return op
+
+class BinaryIdCursor:
+    def __init__(self, cursor):
+        self.raw = cursor
+
+    def __getattr__(self, name):
+        attr = getattr(self.raw, name)
+        if not callable(attr):
+            return attr
+        def chained(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            return self if result is self.raw else result
+        return chained
+
+    async def to_list(self, length):
+        return decode_ids(await self.raw.to_list(length))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return decode_ids(await self.raw.__anext__())
+
+class BinaryIdCollection:
+    def __init__(self, collection, max_time_ms: int = 0):
+        self.raw = collection
+        self.max_time_ms = max_time_ms
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+    def _limit(self, kwargs: dict, name: str) -> dict:
+        if self.max_time_ms:
+            kwargs.setdefault(name, self.max_time_ms)
+        return kwargs
+
+    def find(self, filter=None, *args, **kwargs):
+        return BinaryIdCursor(self.raw.find(encode_id_filter(filter or {}), *args, **self._limit(kwargs, "max_time_ms")))
+
+    async def find_one(self, filter=None, *args, **kwargs):
+        return decode_ids(await self.raw.find_one(encode_id_filter(filter or {}), *args, **self._limit(kwargs, "max_time_ms")))
+
+    async def find_one_and_update(self, filter, update, *args, **kwargs):
+        return decode_ids(await self.raw.find_one_and_update(encode_id_filter(filter), encode_id_update(update), *args, **kwargs))
+
+    async def count_documents(self, filter, *args, **kwargs):
+        return await self.raw.count_documents(encode_id_filter(filter), *args, **self._limit(kwargs, "maxTimeMS"))
+
+    def aggregate(self, pipeline, *args, **kwargs):
+        pipeline = [{"$match": encode_id_filter(stage["$match"])} if "$match" in stage else stage for stage in pipeline]
+        return BinaryIdCursor(self.raw.aggregate(pipeline, *args, **self._limit(kwargs, "maxTimeMS")))
+
+    async def insert_one(self, document, *args, **kwargs):
+        encoded = encode_id_document(document)
+        result = await self.raw.insert_one(encoded, *args, **kwargs)
+        document["_id"] = encoded["_id"]
+        return result
+
+    async def insert_many(self, documents, *args, **kwargs):
+        documents = list(documents)
+        encoded = [encode_id_document(d) for d in documents]
+        result = await self.raw.insert_many(encoded, *args, **kwargs)
+        for document, stored in zip(documents, encoded):
+            document["_id"] = stored["_id"]
+        return result
+
+    async def update_one(self, filter, update, *args, **kwargs):
+        return await self.raw.update_one(encode_id_filter(filter), encode_id_update(update), *args, **kwargs)
+
+    async def update_many(self, filter, update, *args, **kwargs):
+        return await self.raw.update_many(encode_id_filter(filter), encode_id_update(update), *args, **kwargs)
+
+    async def delete_one(self, filter, *args, **kwargs):
+        return await self.raw.delete_one(encode_id_filter(filter), *args, **kwargs)
+
+    async def delete_many(self, filter, *args, **kwargs):
+        return await self.raw.delete_many(encode_id_filter(filter), *args, **kwargs)
+
+    async def bulk_write(self, requests, *args, **kwargs):
+        return await self.raw.bulk_write([encode_id_operation(op) for op in requests], *args, **kwargs)
+
+class BinaryIdDatabase:
+    def __init__(self, database, max_time_ms: Optional[int] = None):
+        self.raw = database
+        self.max_time_ms = MONGO_MAX_TIME_MS if max_time_ms is None else max_time_ms
+        self._collections = {}
+        self._reporting = None
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if name not in self._collections:
+            self._collections[name] = BinaryIdCollection(getattr(self.raw, name), self.max_time_ms)
+        return self._collections[name]
+
+    @property
+    def reporting(self) -> "BinaryIdDatabase":
+        """The same database for dashboard and report reads, which tolerate slightly stale data."""
+        if self._reporting is None:
+            self._reporting = BinaryIdDatabase(
+                self.raw.with_options(read_preference=reporting_read_preference()), MONGO_REPORTING_MAX_TIME_MS
+            )
+        return self._reporting
+
+db = BinaryIdDatabase(client[os.environ['DB_NAME']])
 
 # JWT Config
 JWT_SECRET = os.environ.get('JWT_SECRET', 'dealcentric_secret_2024')
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 24
 
-# Create uploads directory
 UPLOAD_DIR = ROOT_DIR / "uploads"
-UPLOAD_DIR.mkdir(exist_ok=True)
+
+# Fire-and-forget tasks are held here until they finish: the event loop keeps
+# only weak references, so an unreferenced task can be collected mid-run
+background_tasks: Set[asyncio.Task] = set()
+
+def create_background_task(coro) -> asyncio.Task:
+    task = asyncio.ensure_future(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def cancel_tasks(*tasks: Optional[asyncio.Task]):
+    tasks = [t for t in tasks if t is not None]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Startup work lives here, not at import time, so importing the module (for
+    # a worker boot, a reload or a tool like migrate.py) touches nothing.
+    # Long-running jobs keep their handles on app.state and are cancelled before
+    # the client closes.
+    UPLOAD_DIR.mkdir(exist_ok=True)
+    await create_indexes()
+    await create_slow_query_log()
+    app.state.loop_heartbeat = start_loop_watchdog()
+    await coordinator.start()
+    # Backfills run in the background on the worker holding the lease; tests and
+    # benchmarks await this handle before measuring
+    app.state.migrations = asyncio.create_task(run_when_leader("migrations", run_startup_migrations))
+    app.state.archival = asyncio.create_task(archival_loop()) if ARCHIVE_INTERVAL_HOURS > 0 else None
+    try:
+        yield
+    finally:
+        await cancel_tasks(app.state.migrations, app.state.archival, app.state.loop_heartbeat, *background_tasks)
+        await shutdown_db_client()
 
 # Create the main app
-app = FastAPI(title="Deal-Centric PMS API")
-app.mount("/uploads", StaticFiles(directory=str(UPLOAD_DIR)), name="uploads")
+app = FastAPI(title="Deal-Centric PMS API", lifespan=lifespan)
+app.mount("/uploads", StaticFiles(directory=str(UPLOAD_DIR), check_dir=False), name="uploads")
 
 api_router = APIRouter(prefix="/api")
 security = HTTPBearer()
@@ -65,6 +684,14 @@ class DealStage:
     COMPLETED = "completed"
     CLOSED = "closed"
 
+# Lifecycle order, used to compare how far a deal has progressed
+STAGE_ORDER = [
+    DealStage.INQUIRY, DealStage.QUOTATION, DealStage.NEGOTIATION, DealStage.CONTRACT,
+    DealStage.EXECUTION, DealStage.FABRICATION, DealStage.INSTALLATION, DealStage.HANDOVER,
+    DealStage.COMPLETED, DealStage.CLOSED
+]
+STAGE_RANK = {stage: i for i, stage in enumerate(STAGE_ORDER)}
+
 # ==================== PYDANTIC MODELS ====================
 
 class UserCreate(BaseModel):
@@ -107,15 +734,15 @@ class DealUpdate(BaseModel):
     contract_value: Optional[float] = None
     description: Optional[str] = None
     assigned_pm: Optional[str] = None
-    start_date: Optional[str] = None
-    end_date: Optional[str] = None
+    start_date: Optional[datetime] = None
+    end_date: Optional[datetime] = None
 
 class TaskCreate(BaseModel):
     deal_id: str
     name: str
     description: Optional[str] = None
-    start_date: str
-    end_date: str
+    start_date: datetime
+    end_date: datetime
     assigned_to: Optional[str] = None
     is_milestone: bool = False
     is_client_visible: bool = False
@@ -148,6 +775,21 @@ class CommissionCreate(BaseModel):
     rate: float
     milestone_triggers: List[Dict[str, Any]]  # When to release commission
 
+class RateRule(BaseModel):
+    rate: float
+    min_deal_value: float = 0
+    max_deal_value: Optional[float] = None
+    agent_ids: Optional[List[str]] = None  # None applies to every agent
+    stages: Optional[List[str]] = None  # None applies to every stage
+
+class CommissionSimulation(BaseModel):
+    rules: List[RateRule]  # Applied in order; later matching rules win
+
+class PaymentCreate(BaseModel):
+    amount: float
+    reference: Optional[str] = None
+    notes: Optional[str] = None
+
 class MessageCreate(BaseModel):
     deal_id: str
     content: str
@@ -161,6 +803,18 @@ def hash_password(password: str) -> str:
 def verify_password(password: str, hashed: str) -> bool:
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
+# bcrypt is deliberately slow, so it runs on a small pool instead of the event loop
+BCRYPT_WORKERS = int(os.environ.get('BCRYPT_WORKERS', '4'))
+bcrypt_executor = ThreadPoolExecutor(max_workers=BCRYPT_WORKERS, thread_name_prefix="bcrypt")
+
+@traced("bcrypt")
+async def run_bcrypt(fn, *args):
+    BCRYPT_QUEUE_DEPTH.inc()
+    def job():
+        BCRYPT_QUEUE_DEPTH.dec()
+        return fn(*args)
+    return await asyncio.get_running_loop().run_in_executor(bcrypt_executor, job)
+
 def create_token(user_id: str, role: str) -> str:
     payload = {
         "user_id": user_id,
@@ -190,15 +844,376 @@ def require_roles(allowed_roles: List[str]):
         return user
     return role_checker
 
-async def log_activity(entity_id: str, action: str, description: str, user_id: str):
+# Activity entries are tagged with their audience when written, so feeds read
+# the caller's slice straight off the (audience, timestamp) index. Admins see
+# everything; deal activity is also tagged with the deal and each of its members.
+ADMIN_AUDIENCE = f"role:{UserRole.ADMIN}"
+DEAL_MEMBER_FIELDS = ("referral_agent_id", "partner_ids", "assigned_pm", "assigned_supervisor", "assigned_fabricators")
+# What deal_audience needs from a deal
+DEAL_AUDIENCE_PROJECTION = {"_id": 0, "id": 1, "client_email": 1, **{f: 1 for f in DEAL_MEMBER_FIELDS}}
+
+def deal_member_tags(deal: dict) -> List[str]:
+    tags = []
+    for field in DEAL_MEMBER_FIELDS:
+        value = deal.get(field)
+        for member_id in (value if isinstance(value, list) else [value]):
+            if member_id:
+                tags.append(f"user:{member_id}")
+    if deal.get("client_email"):
+        tags.append(f"client:{deal['client_email']}")
+    return tags
+
+def deal_audience(deal: Optional[dict]) -> List[str]:
+    if not deal:
+        return [ADMIN_AUDIENCE]
+    return [ADMIN_AUDIENCE, f"deal:{deal['id']}", *deal_member_tags(deal)]
+
+def reader_audience(current_user: dict) -> List[str]:
+    tags = [f"role:{current_user['role']}", f"user:{current_user['id']}"]
+    if current_user["role"] in [UserRole.CLIENT_B2B, UserRole.CLIENT_RESIDENTIAL]:
+        tags.append(f"client:{current_user['email']}")
+    return tags
+
+# Activity older than this is dropped by a TTL index on ``expires_at``; 0 keeps it forever
+ACTIVITY_RETENTION_DAYS = int(os.environ.get('ACTIVITY_RETENTION_DAYS', '365'))
+
+def activity_expiry(logged_at: datetime) -> dict:
+    if ACTIVITY_RETENTION_DAYS <= 0:
+        return {}
+    return {"expires_at": logged_at + timedelta(days=ACTIVITY_RETENTION_DAYS)}
+
+@traced("log_activity")
+async def log_activity(entity_id: str, action: str, description: str, user_id: str, session=None,
+                       audience: Optional[List[str]] = None):
+    """Record an activity entry; ``audience`` is looked up from the deal ``entity_id`` when not given."""
+    if audience is None:
+        deal = await db.deals.find_one({"id": entity_id}, DEAL_AUDIENCE_PROJECTION, session=session)
+        audience = deal_audience(deal)
+    now = datetime.now(timezone.utc)
     await db.activity_logs.insert_one({
         "id": str(uuid.uuid4()),
         "entity_id": entity_id,
         "action": action,
         "description": description,
         "user_id": user_id,
-        "timestamp": datetime.now(timezone.utc).isoformat()
-    })
+        "audience": audience,
+        "timestamp": now,
+        **activity_expiry(now)
+    }, session=session)
+
+async def backfill_activity_audience(batch_size: int = 1000):
+    """Tag activity written before audience tagging."""
+    while True:
+        logs = await db.activity_logs.find(
+            {"audience": {"$exists": False}}, {"_id": 1, "entity_id": 1}
+        ).limit(batch_size).to_list(batch_size)
+        if not logs:
+            break
+        deals = await db.deals.find(
+            {"id": {"$in": list({log["entity_id"] for log in logs})}},
+            DEAL_AUDIENCE_PROJECTION
+        ).to_list(None)
+        deals_by_id = {d["id"]: d for d in deals}
+        await db.activity_logs.bulk_write([
+            UpdateOne({"_id": log["_id"]}, {"$set": {"audience": deal_audience(deals_by_id.get(log["entity_id"]))}})
+            for log in logs
+        ], ordered=False)
+    logger.info("Activity audience backfill complete")
+
+async def backfill_activity_expiry(batch_size: int = 1000):
+    """Give activity written before retention existed an expiry from its timestamp."""
+    if ACTIVITY_RETENTION_DAYS <= 0:
+        return
+    while True:
+        logs = await db.activity_logs.find(
+            {"expires_at": {"$exists": False}}, {"_id": 1, "timestamp": 1}
+        ).limit(batch_size).to_list(batch_size)
+        if not logs:
+            break
+        await db.activity_logs.bulk_write([
+            UpdateOne({"_id": log["_id"]}, {"$set": activity_expiry(as_datetime(log["timestamp"]))})
+            for log in logs
+        ], ordered=False)
+    logger.info("Activity expiry backfill complete")
+
+# ==================== TRANSACTIONS ====================
+
+# auto: use transactions when connected to a replica set or mongos; on/off forces it
+MONGO_TRANSACTIONS = os.environ.get('MONGO_TRANSACTIONS', 'auto')
+_transactions_supported: Optional[bool] = None
+
+async def transactions_supported() -> bool:
+    global _transactions_supported
+    if _transactions_supported is None:
+        if MONGO_TRANSACTIONS in ("on", "off"):
+            _transactions_supported = MONGO_TRANSACTIONS == "on"
+        else:
+            hello = await client.admin.command("hello")
+            _transactions_supported = bool(hello.get("setName")) or hello.get("msg") == "isdbgrid"
+    return _transactions_supported
+
+async def run_in_transaction(callback):
+    """Run ``callback(session)`` in a transaction.
+
+    ``with_transaction`` retries the whole callback on TransientTransactionError and
+    retries the commit on UnknownTransactionCommitResult. Standalone servers have no
+    transactions, so there the callback runs once with ``session=None``.
+    """
+    if not await transactions_supported():
+        return await callback(None)
+    async with await client.start_session() as session:
+        return await session.with_transaction(callback)
+
+# ==================== OPTIMISTIC CONCURRENCY ====================
+# Deals, tasks and quotations carry a ``revision`` counter that every write bumps
+# (quotations already use ``version`` for the quote number). Clients send the
+# revision they last saw in If-Match; the write is then conditional on it.
+# Fields the server derives (deal progress recomputed from its tasks) bump
+# change_seq for sync but not the revision, so they never fail a user's edit.
+
+def parse_if_match(if_match: Optional[str]) -> Optional[int]:
+    if not if_match or if_match.strip() == "*":
+        return None
+    tag = if_match.strip()
+    if tag.startswith("W/"):
+        tag = tag[2:]
+    try:
+        return int(tag.strip('"'))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="If-Match must be a revision ETag")
+
+def with_revision(query: dict, expected: Optional[int]) -> dict:
+    if expected is None:
+        return query
+    # Documents written before revisions existed count as revision 0
+    return {**query, "revision": {"$in": [0, None]} if expected == 0 else expected}
+
+def set_etag(response: Response, doc: Optional[dict]):
+    if doc is not None:
+        response.headers["ETag"] = f'"{doc.get("revision", 0)}"'
+
+async def raise_write_conflict(collection, doc_id: str, label: str, session=None):
+    current = await collection.find_one({"id": doc_id}, {"_id": 0, "revision": 1}, session=session)
+    if not current:
+        raise HTTPException(status_code=404, detail=f"{label} not found")
+    raise HTTPException(
+        status_code=409,
+        detail=f"{label} was modified concurrently (current revision {current.get('revision', 0)}), please retry"
+    )
+
+# ==================== COORDINATION ====================
+# serve.py runs several worker processes, each with its own module state. State
+# that has to agree across workers goes through ``coordinator``:
+#   - invalidate(name) drops a registered cache here and bumps its version; the
+#     other workers drop their copy when their next poll sees the new version
+#   - is_leader(name) holds a lease, so a background job runs on one worker
+# COORDINATION_BACKEND=mongo keeps versions and leases in the ``coordination``
+# collection. "local" is the stand-in for a single process: invalidation stays
+# in-process and every lease is granted.
+
+COORDINATION_BACKEND = os.environ.get('COORDINATION_BACKEND', 'mongo')
+COORDINATION_POLL_SECONDS = float(os.environ.get('COORDINATION_POLL_SECONDS', '1'))
+LEADER_LEASE_SECONDS = float(os.environ.get('LEADER_LEASE_SECONDS', '30'))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+class LocalCoordinator:
+    def __init__(self):
+        self.caches: Dict[str, Callable[[], None]] = {}
+
+    def register_cache(self, name: str, drop: Callable[[], None]):
+        self.caches[name] = drop
+
+    async def invalidate(self, name: str):
+        self.caches[name]()
+
+    async def is_leader(self, name: str) -> bool:
+        return True
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+class MongoCoordinator(LocalCoordinator):
+    def __init__(self):
+        super().__init__()
+        self.versions: Dict[str, int] = {}
+        self.leases: Dict[str, datetime] = {}  # lease name -> when ours runs out
+        self._poller: Optional[asyncio.Task] = None
+
+    async def invalidate(self, name: str):
+        self.caches[name]()
+        doc = await db.coordination.find_one_and_update(
+            {"_id": f"cache:{name}"}, {"$inc": {"version": 1}}, upsert=True, return_document=ReturnDocument.AFTER
+        )
+        self.versions[name] = doc["version"]
+
+    async def is_leader(self, name: str) -> bool:
+        now = datetime.now(timezone.utc)
+        expires = self.leases.get(name)
+        if expires and (expires - now).total_seconds() > LEADER_LEASE_SECONDS / 2:
+            return True
+        expires = now + timedelta(seconds=LEADER_LEASE_SECONDS)
+        try:
+            # Matches only a lease that is ours or has run out; otherwise the upsert collides on _id
+            await db.coordination.update_one(
+                {"_id": f"leader:{name}", "$or": [{"owner": WORKER_ID}, {"expires_at": {"$lte": now}}]},
+                {"$set": {"owner": WORKER_ID, "expires_at": expires}}, upsert=True
+            )
+        except DuplicateKeyError:
+            self.leases.pop(name, None)
+            return False
+        self.leases[name] = expires
+        return True
+
+    async def poll(self):
+        names = {f"cache:{name}": name for name in self.caches}
+        for doc in await db.coordination.find({"_id": {"$in": list(names)}}).to_list(None):
+            name = names[doc["_id"]]
+            if self.versions.get(name) != doc["version"]:
+                self.caches[name]()
+                self.versions[name] = doc["version"]
+        for name in list(self.leases):
+            await self.is_leader(name)
+
+    async def _poll_loop(self):
+        while True:
+            await asyncio.sleep(COORDINATION_POLL_SECONDS)
+            try:
+                await self.poll()
+            except Exception:
+                logger.exception("Coordination poll failed")
+
+    async def start(self):
+        await self.poll()
+        self._poller = asyncio.create_task(self._poll_loop())
+
+    async def stop(self):
+        await cancel_tasks(self._poller)
+        self._poller = None
+        # Hand leadership over now rather than when the lease runs out
+        if self.leases:
+            await db.coordination.delete_many({"_id": {"$in": [f"leader:{n}" for n in self.leases]}, "owner": WORKER_ID})
+            self.leases.clear()
+
+coordinator = MongoCoordinator() if COORDINATION_BACKEND == "mongo" else LocalCoordinator()
+
+async def run_when_leader(name: str, job):
+    """Wait for the ``name`` lease, then run ``job()``; other workers keep waiting in case the leader dies."""
+    while not await coordinator.is_leader(name):
+        await asyncio.sleep(LEADER_LEASE_SECONDS)
+    await job()
+
+# ==================== LOGIN RATE LIMITING ====================
+# Failed logins are counted over a sliding window per client IP, per account
+# from one IP, and per account from every IP. The per-IP account limit is low and
+# stops guessing from one address quickly without letting anyone who knows an
+# email lock its owner out. The account-wide limit is much higher and its blocks
+# are short, so credential stuffing spread over many IPs is slowed down to a
+# trickle while the real user is only ever asked to retry a few minutes later.
+# A key that reaches its limit is blocked, and the block doubles each time the
+# key is blocked again (its strikes), up to its scope's maximum.
+# The client IP is only right behind a proxy listed in TRUSTED_PROXIES. Blocked attempts are turned away before
+# the user lookup or any bcrypt work. Counts live in one ``login_limits``
+# document per key, so all workers share them. Each worker also remembers the
+# blocks it has seen and rejects repeats without a database round trip.
+
+LOGIN_WINDOW_SECONDS = int(os.environ.get('LOGIN_WINDOW_SECONDS', '300'))
+LOGIN_IP_FAILURES = int(os.environ.get('LOGIN_IP_FAILURES', '20'))
+# Failures for one account from one IP
+LOGIN_ACCOUNT_FAILURES = int(os.environ.get('LOGIN_ACCOUNT_FAILURES', '5'))
+# Failures for one account from every IP
+LOGIN_ACCOUNT_TOTAL_FAILURES = int(os.environ.get('LOGIN_ACCOUNT_TOTAL_FAILURES', '50'))
+LOGIN_BACKOFF_SECONDS = int(os.environ.get('LOGIN_BACKOFF_SECONDS', '30'))
+LOGIN_BACKOFF_MAX_SECONDS = int(os.environ.get('LOGIN_BACKOFF_MAX_SECONDS', '3600'))
+LOGIN_ACCOUNT_TOTAL_BACKOFF_MAX_SECONDS = int(os.environ.get('LOGIN_ACCOUNT_TOTAL_BACKOFF_MAX_SECONDS', '300'))
+# A key's strikes are forgotten after this long without a failure
+LOGIN_STRIKE_MEMORY_SECONDS = int(os.environ.get('LOGIN_STRIKE_MEMORY_SECONDS', '86400'))
+LOGIN_LIMITS = {"ip": LOGIN_IP_FAILURES, "ip_account": LOGIN_ACCOUNT_FAILURES, "account": LOGIN_ACCOUNT_TOTAL_FAILURES}
+LOGIN_BACKOFF_MAX = {
+    "ip": LOGIN_BACKOFF_MAX_SECONDS,
+    "ip_account": LOGIN_BACKOFF_MAX_SECONDS,
+    "account": LOGIN_ACCOUNT_TOTAL_BACKOFF_MAX_SECONDS
+}
+
+def login_limit_keys(ip: str, email: str) -> Dict[str, str]:
+    account = email.strip().lower()
+    return {"ip": f"ip:{ip}", "ip_account": f"account:{account}|{ip}", "account": f"account:{account}"}
+
+def login_backoff_seconds(scope: str, strikes: int) -> int:
+    return min(LOGIN_BACKOFF_MAX[scope], LOGIN_BACKOFF_SECONDS * 2 ** max(strikes - 1, 0))
+
+class LoginLimiter:
+    def __init__(self):
+        self.blocked: Dict[str, datetime] = {}  # key -> blocked until, as last seen by this worker
+
+    def _remember(self, key: str, until: datetime):
+        self.blocked[key] = until
+        if len(self.blocked) > 10000:
+            now = datetime.now(timezone.utc)
+            self.blocked = {k: u for k, u in self.blocked.items() if u > now}
+
+    def local_block(self, keys: Dict[str, str], now: datetime) -> Optional[Tuple[str, datetime]]:
+        for scope, key in keys.items():
+            until = self.blocked.get(key)
+            if until and until > now:
+                return scope, until
+        return None
+
+    async def shared_block(self, keys: Dict[str, str], now: datetime) -> Optional[Tuple[str, datetime]]:
+        scopes = {key: scope for scope, key in keys.items()}
+        docs = await db.login_limits.find(
+            {"_id": {"$in": list(scopes)}, "blocked_until": {"$gt": now}}, {"blocked_until": 1}
+        ).to_list(None)
+        for doc in docs:
+            self._remember(doc["_id"], doc["blocked_until"])
+        return (scopes[docs[0]["_id"]], docs[0]["blocked_until"]) if docs else None
+
+    async def record_failure(self, keys: Dict[str, str], now: datetime):
+        for scope, key in keys.items():
+            limit = LOGIN_LIMITS[scope]
+            # Only the last ``limit`` failures matter: the key is over its limit
+            # when the oldest of them is still inside the window
+            doc = await db.login_limits.find_one_and_update(
+                {"_id": key},
+                {"$push": {"failures": {"$each": [now], "$slice": -limit}},
+                 "$set": {"expires_at": now + timedelta(seconds=LOGIN_STRIKE_MEMORY_SECONDS)}},
+                upsert=True, return_document=ReturnDocument.AFTER
+            )
+            failures = doc["failures"]
+            if len(failures) < limit or (now - failures[0]).total_seconds() > LOGIN_WINDOW_SECONDS:
+                continue
+            strikes = doc.get("strikes", 0) + 1
+            until = now + timedelta(seconds=login_backoff_seconds(scope, strikes))
+            await db.login_limits.update_one({"_id": key}, {"$set": {
+                "failures": [], "strikes": strikes, "blocked_until": until,
+                "expires_at": until + timedelta(seconds=LOGIN_STRIKE_MEMORY_SECONDS)
+            }})
+            self._remember(key, until)
+            LOGIN_BLOCKS.labels(scope).inc()
+            logger.warning(f"Login blocked for {key} until {until.isoformat()} (strike {strikes})")
+
+    async def reset(self, key: str):
+        self.blocked.pop(key, None)
+        await db.login_limits.delete_one({"_id": key})
+
+login_limiter = LoginLimiter()
+
+async def check_login_allowed(keys: Dict[str, str], now: datetime):
+    source, block = "local", login_limiter.local_block(keys, now)
+    if block is None:
+        source, block = "shared", await login_limiter.shared_block(keys, now)
+    if block is None:
+        return
+    scope, until = block
+    retry_after = max(1, int((until - now).total_seconds() + 0.999))
+    LOGIN_ATTEMPTS.labels("rate_limited").inc()
+    LOGIN_REJECTED.labels(scope, source).inc()
+    raise HTTPException(
+        status_code=429, detail=f"Too many failed logins, try again in {retry_after} seconds",
+        headers={"Retry-After": str(retry_after)}
+    )
 
 # ==================== AUTH ENDPOINTS ====================
 
@@ -209,12 +1224,12 @@ async def register_user(user_data: UserCreate, current_user: dict = Depends(requ
         raise HTTPException(status_code=400, detail="Email already registered")
     
     user_id = str(uuid.uuid4())
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
     
     user_doc = {
         "id": user_id,
         "email": user_data.email,
-        "password": hash_password(user_data.password),
+        "password": await run_bcrypt(hash_password, user_data.password),
         "name": user_data.name,
         "role": user_data.role,
         "phone": user_data.phone,
@@ -227,18 +1242,34 @@ async def register_user(user_data: UserCreate, current_user: dict = Depends(requ
     }
     
     await db.users.insert_one(user_doc)
-    await log_activity(user_id, "user_created", f"User {user_data.name} created", current_user["id"])
+    await log_activity(user_id, "user_created", f"User {user_data.name} created", current_user["id"], audience=deal_audience(None))
     
     return {k: v for k, v in user_doc.items() if k not in ["password", "_id"]}
 
 @api_router.post("/auth/login")
-async def login(credentials: UserLogin):
+async def login(credentials: UserLogin, request: Request):
+    now = datetime.now(timezone.utc)
+    # Behind a proxy listed in TRUSTED_PROXIES this is the forwarded client address
+    keys = login_limit_keys(request.client.host if request.client else "unknown", credentials.email)
+    await check_login_allowed(keys, now)
+
     user = await db.users.find_one({"email": credentials.email}, {"_id": 0})
-    if not user or not verify_password(credentials.password, user["password"]):
+    # Deactivated accounts are refused before any bcrypt work, with the same
+    # response as a wrong password so they can't be told apart
+    if user and not user.get("is_active", True):
+        outcome = "deactivated"
+    elif not user or not await run_bcrypt(verify_password, credentials.password, user["password"]):
+        outcome = "invalid"
+    else:
+        outcome = "success"
+    if outcome != "success":
+        LOGIN_ATTEMPTS.labels(outcome).inc()
+        await login_limiter.record_failure(keys, now)
         raise HTTPException(status_code=401, detail="Invalid credentials")
-    if not user.get("is_active", True):
-        raise HTTPException(status_code=401, detail="Account deactivated")
     
+    # The account-wide count is left alone: other IPs may still be guessing
+    await login_limiter.reset(keys["ip_account"])
+    LOGIN_ATTEMPTS.labels("success").inc()
     token = create_token(user["id"], user["role"])
     return {"token": token, "user": {k: v for k, v in user.items() if k != "password"}}
 
@@ -269,8 +1300,12 @@ async def update_user(user_id: str, user_update: UserUpdate, current_user: dict
     if not update_data:
         raise HTTPException(status_code=400, detail="No update data")
     
-    await db.users.update_one({"id": user_id}, {"$set": update_data})
-    user = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0})
+    user = await db.users.find_one_and_update(
+        {"id": user_id}, {"$set": update_data},
+        projection={"_id": 0, "password": 0}, return_document=ReturnDocument.AFTER
+    )
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
     return user
 
 @api_router.delete("/users/{user_id}")
@@ -278,12 +1313,396 @@ async def deactivate_user(user_id: str, current_user: dict = Depends(require_rol
     await db.users.update_one({"id": user_id}, {"$set": {"is_active": False}})
     return {"message": "User deactivated"}
 
+# ==================== CHANGE TRACKING ====================
+# Deals, tasks, progress updates and messages are stamped with a global change
+# sequence on every write, which drives the delta sync endpoint. The sequence
+# comes from a single counter document, taken outside any transaction so that
+# concurrent transactions don't conflict on it.
+
+async def next_change_seq() -> int:
+    counter = await db.counters.find_one_and_update(
+        {"_id": "change_seq"}, {"$inc": {"value": 1}},
+        upsert=True, return_document=ReturnDocument.AFTER
+    )
+    return counter["value"]
+
+async def change_stamp() -> dict:
+    return {"change_seq": await next_change_seq(), "changed_at": datetime.now(timezone.utc)}
+
+SYNCED_COLLECTIONS = ("deals", "tasks", "progress_updates", "messages")
+
+async def backfill_change_seq(batch_size: int = 1000):
+    """Give documents written before change tracking a distinct sequence number."""
+    for name in SYNCED_COLLECTIONS:
+        collection = getattr(db, name)
+        while True:
+            docs = await collection.find({"change_seq": {"$exists": False}}, {"_id": 1}).limit(batch_size).to_list(batch_size)
+            if not docs:
+                break
+            # Reserve a block of sequence numbers in one round trip
+            counter = await db.counters.find_one_and_update(
+                {"_id": "change_seq"}, {"$inc": {"value": len(docs)}},
+                upsert=True, return_document=ReturnDocument.AFTER
+            )
+            first = counter["value"] - len(docs) + 1
+            now = datetime.now(timezone.utc)
+            await collection.bulk_write([
+                UpdateOne({"_id": doc["_id"], "change_seq": {"$exists": False}}, {"$set": {"change_seq": first + i, "changed_at": now}})
+                for i, doc in enumerate(docs)
+            ], ordered=False)
+        logger.info("Change sequence backfill complete for %s", name)
+
+async def record_tombstones(entity: str, entity_id: str, user_ids: List[str]):
+    """Tell offline clients of ``user_ids`` that ``entity_id`` left their scope."""
+    if not user_ids:
+        return
+    await db.sync_tombstones.insert_many([
+        {"entity": entity, "entity_id": entity_id, "user_id": user_id, **await change_stamp()}
+        for user_id in user_ids
+    ])
+
+# ==================== DATETIMES ====================
+# Timestamps are written as native datetimes. Data written before that holds
+# ISO strings until migrate_datetimes converts it, and Mongo only compares
+# values of the same type, so range filters must match both forms. Sorting
+# by write time stays chronological in between: BSON orders strings before
+# dates, and every legacy string is older than every date.
+
+DATETIME_FIELDS = {
+    "users": ("created_at", "updated_at"),
+    "deals": ("created_at", "updated_at", "start_date", "end_date"),
+    "tasks": ("created_at", "start_date", "end_date"),
+    "quotations": ("created_at",),
+    "progress_updates": ("created_at",),
+    "documents": ("created_at",),
+    "messages": ("created_at",),
+    "commissions": ("created_at",),
+    "commission_releases": ("created_at",),
+    "payments": ("created_at",),
+    "notifications": ("created_at",),
+    "activity_logs": ("timestamp",)
+}
+
+def as_datetime(value) -> datetime:
+    """Read a timestamp stored either as a date or as a legacy ISO string."""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+def start_of_today() -> datetime:
+    return datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+
+def before(field: str, moment: datetime, legacy: Optional[str] = None) -> dict:
+    """Filter for ``field < moment`` that also matches legacy ISO strings."""
+    return {"$or": [{field: {"$lt": moment}}, {field: {"$lt": legacy or moment.isoformat()}}]}
+
+# ==================== MIGRATIONS ====================
+# Online, batched rewrites of fields still stored in a legacy representation.
+
+async def migrate_fields(migration: str, collections: Dict[str, Tuple[str, ...]], convert, batch_size: int = 500) -> Dict[str, int]:
+    """Rewrite string values of ``fields`` with ``convert``; returns documents converted per collection.
+
+    ``convert`` returns the new value, ``None`` to leave it, or raises ValueError
+    for a value it cannot parse. Each collection's position is checkpointed in
+    ``migrations`` so an interrupted pass resumes where it stopped. Updates are
+    conditional on the value that was read, so a concurrent write is never
+    overwritten with a stale one.
+    """
+    converted = {}
+    for name, fields in collections.items():
+        # The raw collection: this must see stored values, not decoded ones
+        collection = getattr(db.raw, name)
+        checkpoint_id = f"{migration}:{name}"
+        checkpoint = await db.migrations.find_one({"_id": checkpoint_id}) or {}
+        last_id = checkpoint.get("last_id")
+        converted[name] = 0
+        while True:
+            query = {"$or": [{field: {"$type": "string"}} for field in fields]}
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            docs = await collection.find(query, {field: 1 for field in fields}).sort("_id", 1).limit(batch_size).to_list(batch_size)
+            if not docs:
+                break
+            ops = []
+            for doc in docs:
+                updates = {}
+                for field in fields:
+                    if doc.get(field) is None:
+                        continue
+                    try:
+                        value = convert(doc[field])
+                    except ValueError:
+                        logger.warning("Skipping unparseable %s.%s on %s", name, field, doc["_id"])
+                        continue
+                    if value is not None:
+                        updates[field] = value
+                if updates:
+                    ops.append(UpdateOne({"_id": doc["_id"], **{f: doc[f] for f in updates}}, {"$set": updates}))
+            if ops:
+                converted[name] += (await collection.bulk_write(ops, ordered=False)).modified_count
+            last_id = docs[-1]["_id"]
+            await db.migrations.update_one({"_id": checkpoint_id}, {"$set": {"last_id": last_id}}, upsert=True)
+        # A finished pass starts from the beginning next time, picking up values
+        # written meanwhile by instances still running older code
+        await db.migrations.update_one(
+            {"_id": checkpoint_id},
+            {"$unset": {"last_id": ""}, "$set": {"completed_at": datetime.now(timezone.utc)}, "$inc": {"converted": converted[name]}},
+            upsert=True
+        )
+    logger.info("Migration %s complete: %d documents converted", migration, sum(converted.values()))
+    return converted
+
+def with_archives(collections: Dict[str, Tuple[str, ...]]) -> Dict[str, Tuple[str, ...]]:
+    return {**collections, **{f"archive_{n}": collections[n] for n in ("deals", *ARCHIVED_CHILDREN)}}
+
+async def migrate_datetimes(batch_size: int = 500) -> Dict[str, int]:
+    """Convert ISO-string timestamps to BSON dates."""
+    def convert(value):
+        return as_datetime(value) if isinstance(value, str) else None
+    return await migrate_fields("datetimes", with_archives(DATETIME_FIELDS), convert, batch_size)
+
+BINARY_ID_COLLECTIONS = (
+    "users", "deals", "tasks", "quotations", "progress_updates", "documents", "messages", "commissions",
+    "commission_releases", "payments", "notifications", "activity_logs", "sync_tombstones"
+)
+
+async def migrate_binary_ids(batch_size: int = 500) -> Dict[str, int]:
+    """Convert uuid strings in id fields to binary UUIDs."""
+    def convert(value):
+        if isinstance(value, list):
+            encoded = [to_binary_id(v) for v in value]
+            return encoded if any(e is not v for e, v in zip(encoded, value)) else None
+        encoded = to_binary_id(value)
+        return None if encoded is value else encoded
+    fields = tuple(sorted(ID_FIELDS))
+    return await migrate_fields("binary_ids", with_archives({name: fields for name in BINARY_ID_COLLECTIONS}), convert, batch_size)
+
+# ==================== DEAL STAGE TRANSITIONS ====================
+
+ALLOWED_TRANSITIONS = {
+    DealStage.INQUIRY: {DealStage.QUOTATION, DealStage.NEGOTIATION, DealStage.CLOSED},
+    DealStage.QUOTATION: {DealStage.INQUIRY, DealStage.NEGOTIATION, DealStage.CONTRACT, DealStage.CLOSED},
+    DealStage.NEGOTIATION: {DealStage.QUOTATION, DealStage.CONTRACT, DealStage.CLOSED},
+    DealStage.CONTRACT: {DealStage.EXECUTION, DealStage.CLOSED},
+    DealStage.EXECUTION: {DealStage.FABRICATION, DealStage.INSTALLATION, DealStage.HANDOVER, DealStage.CLOSED},
+    DealStage.FABRICATION: {DealStage.EXECUTION, DealStage.INSTALLATION, DealStage.CLOSED},
+    DealStage.INSTALLATION: {DealStage.FABRICATION, DealStage.HANDOVER, DealStage.CLOSED},
+    DealStage.HANDOVER: {DealStage.INSTALLATION, DealStage.COMPLETED},
+    DealStage.COMPLETED: {DealStage.CLOSED},
+    DealStage.CLOSED: set()
+}
+
+# Hooks run inside the transition's transaction as hook(transition, session).
+# transition: {"deal", "from_stage", "to_stage", "changes", "user_id"}
+# Caches are invalidated by the caller once the transaction has committed, so an
+# aborted or retried transaction never leaves a reader caching uncommitted state.
+STAGE_HOOKS = []
+
+def stage_hook(fn):
+    STAGE_HOOKS.append(fn)
+    return fn
+
+@stage_hook
+async def recompute_commissions_hook(transition: dict, session):
+    deal = transition["deal"]
+    entered_contract = transition["to_stage"] == DealStage.CONTRACT and transition["from_stage"] != DealStage.CONTRACT
+    if not deal.get("contract_value") or not (entered_contract or "contract_value" in transition["changes"]):
+        return
+    if STAGE_RANK.get(deal["stage"], -1) < STAGE_RANK[DealStage.CONTRACT]:
+        return
+    await db.commissions.update_many(
+        {"deal_id": deal["id"]},
+        [{"$set": {"earned_amount": {"$multiply": [deal["contract_value"], {"$divide": ["$rate", 100]}]}, "status": "active"}}],
+        session=session
+    )
+
+@stage_hook
+async def rollup_deals_won_hook(transition: dict, session):
+    deal = transition["deal"]
+    if transition["to_stage"] != DealStage.CONTRACT or transition["from_stage"] == DealStage.CONTRACT:
+        return
+    if deal.get("referral_agent_id"):
+        await db.users.update_one({"id": deal["referral_agent_id"]}, {"$inc": {"deals_won": 1}}, session=session)
+
+@stage_hook
+async def notify_stakeholders_hook(transition: dict, session):
+    if transition["from_stage"] == transition["to_stage"]:
+        return
+    deal = transition["deal"]
+    recipients = {deal.get("referral_agent_id"), deal.get("assigned_pm"), deal.get("assigned_supervisor")}
+    recipients.discard(None)
+    recipients.discard(transition["user_id"])
+    if not recipients:
+        return
+    now = datetime.now(timezone.utc)
+    await db.notifications.insert_many([
+        {
+            "id": str(uuid.uuid4()),
+            "user_id": recipient,
+            "deal_id": deal["id"],
+            "message": f"Deal '{deal.get('name')}' moved from {transition['from_stage']} to {transition['to_stage']}",
+            "is_read": False,
+            "created_at": now
+        }
+        for recipient in recipients
+    ], session=session)
+
+async def transition_deal_stage(deal_id: str, to_stage: str, user_id: str, changes: Optional[dict] = None,
+                                session=None, advance_only: bool = False,
+                                expected_revision: Optional[int] = None) -> Optional[dict]:
+    """Move a deal to ``to_stage`` with ``changes`` and run the stage hooks.
+
+    Must be called inside ``run_in_transaction`` so the deal write and the hook
+    side effects commit together. With ``advance_only`` a deal already at or past
+    ``to_stage`` keeps its stage but still gets ``changes`` (and the hooks see
+    them); with no changes it is left untouched and None is returned.
+    """
+    if to_stage not in STAGE_RANK:
+        raise HTTPException(status_code=400, detail=f"Unknown stage: {to_stage}")
+    current = await db.deals.find_one(with_revision({"id": deal_id}, expected_revision), {"_id": 0, "stage": 1}, session=session)
+    if not current:
+        await raise_write_conflict(db.deals, deal_id, "Deal", session=session)
+    from_stage = current["stage"]
+    if advance_only and STAGE_RANK.get(from_stage, -1) >= STAGE_RANK[to_stage]:
+        if not changes:
+            return None
+        to_stage = from_stage
+    if to_stage != from_stage and to_stage not in ALLOWED_TRANSITIONS.get(from_stage, set()):
+        raise HTTPException(status_code=400, detail=f"Invalid stage transition from {from_stage} to {to_stage}")
+
+    changes = dict(changes or {})
+    update = {**changes, "stage": to_stage, "updated_at": datetime.now(timezone.utc), **await change_stamp()}
+    # Conditional on the stage we validated against, so a concurrent transition can't be skipped over
+    deal = await db.deals.find_one_and_update(
+        with_revision({"id": deal_id, "stage": from_stage}, expected_revision),
+        {"$set": update, "$inc": {"revision": 1}},
+        projection={"_id": 0}, return_document=ReturnDocument.AFTER, session=session
+    )
+    if not deal:
+        await raise_write_conflict(db.deals, deal_id, "Deal", session=session)
+
+    transition = {"deal": deal, "from_stage": from_stage, "to_stage": to_stage, "changes": changes, "user_id": user_id}
+    for hook in STAGE_HOOKS:
+        await hook(transition, session)
+    if from_stage != to_stage:
+        await log_activity(deal_id, "stage_changed", f"Deal moved from {from_stage} to {to_stage}", user_id, session=session,
+                           audience=deal_audience(deal))
+    return deal
+
+# ==================== ACCESS SCOPES ====================
+# access_scope compiles (user, collection) into the Mongo filter and projection
+# every read must use, so role filtering always happens in the database on
+# indexed fields and hidden fields never leave it.
+
+CLIENT_ROLES = [UserRole.CLIENT_B2B, UserRole.CLIENT_RESIDENTIAL]
+MATCH_NOTHING = {"id": {"$in": []}}
+
+# Deal fields each role must not see
+DEAL_HIDDEN_FIELDS = {
+    UserRole.CLIENT_B2B: ["internal_notes", "referral_agent_id"],
+    UserRole.CLIENT_RESIDENTIAL: ["internal_notes", "referral_agent_id"],
+    UserRole.SALES_AGENT: ["internal_notes"]
+}
+
+def merge_filters(*filters: dict) -> dict:
+    """AND filters together, keeping them flat unless their keys collide."""
+    filters = [f for f in filters if f]
+    merged = {}
+    for f in filters:
+        if merged.keys() & f.keys():
+            return {"$and": filters}
+        merged.update(f)
+    return merged
+
+def deal_scope_query(current_user: dict) -> dict:
+    """Filter restricting deals to the ones the user's role may see."""
+    role = current_user["role"]
+    if role == UserRole.SALES_AGENT:
+        return {"referral_agent_id": current_user["id"]}
+    elif role == UserRole.PARTNER:
+        return {"partner_ids": current_user["id"]}
+    elif role == UserRole.PROJECT_MANAGER:
+        return {"assigned_pm": current_user["id"]}
+    elif role == UserRole.SUPERVISOR:
+        return {"assigned_supervisor": current_user["id"]}
+    elif role == UserRole.FABRICATOR:
+        return {"assigned_fabricators": current_user["id"]}
+    elif role in CLIENT_ROLES:
+        return {"$or": [
+            {"client_email": current_user["email"]},
+            {"client_id": current_user["id"]}
+        ]}
+    return {}
+
+async def deal_children_scope_query(current_user: dict, deal_id: Optional[str] = None) -> dict:
+    """Filter restricting deal-owned records (tasks, documents, ...) to visible deals."""
+    if current_user["role"] == UserRole.ADMIN:
+        return {"deal_id": deal_id} if deal_id else {}
+    if deal_id:
+        # One indexed lookup instead of listing every visible deal
+        query = merge_filters({"id": deal_id}, deal_scope_query(current_user))
+        visible = (await db.deals.find_one(query, {"_id": 0, "id": 1})
+                   or await db.archive_deals.find_one(query, {"_id": 0, "id": 1}))
+        return {"deal_id": deal_id} if visible else MATCH_NOTHING
+    deal_ids = await db.deals.find(deal_scope_query(current_user), {"_id": 0, "id": 1}).to_list(None)
+    return {"deal_id": {"$in": [d["id"] for d in deal_ids]}}
+
+async def access_scope(current_user: dict, collection: str, deal_id: Optional[str] = None) -> Tuple[dict, dict]:
+    """Return ``(filter, projection)`` for reading ``collection`` as ``current_user``.
+
+    ``deal_id`` narrows deal-owned collections to one deal, after checking the
+    user can see it.
+    """
+    role = current_user["role"]
+    projection = {"_id": 0}
+
+    if collection == "deals":
+        projection.update({field: 0 for field in DEAL_HIDDEN_FIELDS.get(role, [])})
+        return merge_filters({"id": deal_id} if deal_id else {}, deal_scope_query(current_user)), projection
+
+    if collection == "commissions":
+        if role == UserRole.ADMIN:
+            return ({"deal_id": deal_id} if deal_id else {}), projection
+        if role == UserRole.SALES_AGENT:
+            return merge_filters({"agent_id": current_user["id"]}, {"deal_id": deal_id} if deal_id else {}), projection
+        if role == UserRole.PROJECT_MANAGER:
+            return await deal_children_scope_query(current_user, deal_id), projection
+        return MATCH_NOTHING, projection
+
+    if collection == "tasks" and role in [UserRole.SUPERVISOR, UserRole.FABRICATOR]:
+        # Operational roles see the jobs assigned to them, wherever they sit
+        return merge_filters({"assigned_to": current_user["id"]}, {"deal_id": deal_id} if deal_id else {}), projection
+
+    if collection == "activity_logs":
+        projection["audience"] = 0
+        scope = {"audience": {"$in": reader_audience(current_user)}}
+        if deal_id:
+            if "deal_id" not in await deal_children_scope_query(current_user, deal_id):
+                return MATCH_NOTHING, projection
+            scope = {"$and": [scope, {"audience": f"deal:{deal_id}"}]}
+        return scope, projection
+
+    scope = await deal_children_scope_query(current_user, deal_id)
+    visibility = {}
+    if collection in ("tasks", "progress_updates") and role in CLIENT_ROLES:
+        visibility = {"is_client_visible": True}
+    elif collection == "documents":
+        if role in CLIENT_ROLES:
+            visibility = {"is_client_visible": True, "approval_status": "approved"}
+        elif role == UserRole.SALES_AGENT:
+            visibility = {"category": {"$ne": "internal"}}
+    elif collection == "quotations" and role in CLIENT_ROLES:
+        visibility = {"status": "sent"}
+    elif collection == "messages" and role != UserRole.ADMIN:
+        visibility = {"$or": [{"visible_to_roles": role}, {"sender_id": current_user["id"]}]}
+    return merge_filters(scope, visibility), projection
+
 # ==================== DEAL MANAGEMENT ====================
 
 @api_router.post("/deals")
 async def create_deal(deal: DealCreate, current_user: dict = Depends(get_current_user)):
     deal_id = str(uuid.uuid4())
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
     
     # Set referral agent based on who created or specified
     referral_agent_id = deal.referral_agent_id
@@ -293,8 +1712,11 @@ async def create_deal(deal: DealCreate, current_user: dict = Depends(get_current
     deal_doc = {
         "id": deal_id,
         "name": deal.name,
+        "name_lc": deal.name.lower(),
         "client_name": deal.client_name,
+        "client_name_lc": deal.client_name.lower(),
         "client_email": deal.client_email,
+        "client_email_lc": (deal.client_email or "").lower(),
         "client_phone": deal.client_phone,
         "client_type": deal.client_type,
         "service_types": deal.service_types,
@@ -310,6 +1732,8 @@ async def create_deal(deal: DealCreate, current_user: dict = Depends(get_current
         "start_date": None,
         "end_date": None,
         "progress_percentage": 0,
+        "revision": 1,
+        **await change_stamp(),
         "created_by": current_user["id"],
         "created_at": now,
         "updated_at": now,
@@ -317,109 +1741,102 @@ async def create_deal(deal: DealCreate, current_user: dict = Depends(get_current
         "internal_notes": []
     }
     
-    await db.deals.insert_one(deal_doc)
-    await log_activity(deal_id, "deal_created", f"Deal '{deal.name}' created", current_user["id"])
-    
-    # Create commission record if agent is assigned
-    if referral_agent_id:
-        agent = await db.users.find_one({"id": referral_agent_id}, {"_id": 0})
-        if agent and agent.get("commission_rate"):
-            await db.commissions.insert_one({
-                "id": str(uuid.uuid4()),
-                "deal_id": deal_id,
-                "agent_id": referral_agent_id,
-                "rate": agent["commission_rate"],
-                "status": "pending",
-                "earned_amount": 0,
-                "released_amount": 0,
-                "created_at": now
-            })
+    async def find_agent():
+        if referral_agent_id:
+            return await db.users.find_one({"id": referral_agent_id}, {"_id": 0, "commission_rate": 1})
+    
+    async def create_commission_record(rate: float):
+        await db.commissions.insert_one({
+            "id": str(uuid.uuid4()),
+            "deal_id": deal_id,
+            "agent_id": referral_agent_id,
+            "rate": rate,
+            "status": "pending",
+            "earned_amount": 0,
+            "released_amount": 0,
+            "created_at": now
+        })
+        await invalidate_commission_book()
+    
+    # The agent lookup doesn't depend on the deal write, and the activity entry
+    # and commission record (if the agent earns one) don't depend on each other
+    _, agent = await asyncio.gather(db.deals.insert_one(deal_doc), find_agent())
+    side_effects = [log_activity(deal_id, "deal_created", f"Deal '{deal.name}' created", current_user["id"], audience=deal_audience(deal_doc))]
+    if agent and agent.get("commission_rate"):
+        side_effects.append(create_commission_record(agent["commission_rate"]))
+    await asyncio.gather(*side_effects)
     
     return {k: v for k, v in deal_doc.items() if k != "_id"}
 
 @api_router.get("/deals")
 async def get_deals(stage: Optional[str] = None, current_user: dict = Depends(get_current_user)):
-    query = {}
-    role = current_user["role"]
-    
-    # Role-based filtering
-    if role == UserRole.SALES_AGENT:
-        query["referral_agent_id"] = current_user["id"]
-    elif role == UserRole.PARTNER:
-        query["partner_ids"] = current_user["id"]
-    elif role == UserRole.PROJECT_MANAGER:
-        query["assigned_pm"] = current_user["id"]
-    elif role == UserRole.SUPERVISOR:
-        query["assigned_supervisor"] = current_user["id"]
-    elif role == UserRole.FABRICATOR:
-        query["assigned_fabricators"] = current_user["id"]
-    elif role in [UserRole.CLIENT_B2B, UserRole.CLIENT_RESIDENTIAL]:
-        query["$or"] = [
-            {"client_email": current_user["email"]},
-            {"client_id": current_user["id"]}
-        ]
-    
+    query, projection = await access_scope(current_user, "deals")
     if stage:
-        query["stage"] = stage
-    
-    deals = await db.deals.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
+        query = merge_filters(query, {"stage": stage})
     
-    # Filter sensitive data for non-admin roles
-    if role not in [UserRole.ADMIN, UserRole.PROJECT_MANAGER]:
-        for deal in deals:
-            if role in [UserRole.CLIENT_B2B, UserRole.CLIENT_RESIDENTIAL]:
-                # Clients don't see internal costs
-                deal.pop("internal_notes", None)
-            elif role == UserRole.SALES_AGENT:
-                # Agents don't see margin data
-                deal.pop("internal_notes", None)
-    
-    return deals
+    return await db.deals.find(query, projection).sort("created_at", -1).to_list(1000)
 
 @api_router.get("/deals/{deal_id}")
-async def get_deal(deal_id: str, current_user: dict = Depends(get_current_user)):
-    deal = await db.deals.find_one({"id": deal_id}, {"_id": 0})
+async def get_deal(deal_id: str, response: Response, current_user: dict = Depends(get_current_user)):
+    query, projection = await access_scope(current_user, "deals", deal_id=deal_id)
+    deal = await db.deals.find_one(query, projection) or await db.archive_deals.find_one(query, projection)
     if not deal:
         raise HTTPException(status_code=404, detail="Deal not found")
-    
-    role = current_user["role"]
-    
-    # Filter based on role
-    if role in [UserRole.CLIENT_B2B, UserRole.CLIENT_RESIDENTIAL]:
-        deal.pop("internal_notes", None)
-        deal.pop("referral_agent_id", None)
-    elif role == UserRole.SALES_AGENT:
-        deal.pop("internal_notes", None)
-    elif role == UserRole.FABRICATOR:
-        # Fabricators only see assigned job details
-        pass
-    
+    set_etag(response, deal)
     return deal
 
 @api_router.put("/deals/{deal_id}")
-async def update_deal(deal_id: str, update: DealUpdate, current_user: dict = Depends(get_current_user)):
+async def update_deal(deal_id: str, update: DealUpdate, response: Response, if_match: Optional[str] = Header(None),
+                      current_user: dict = Depends(get_current_user)):
     allowed_roles = [UserRole.ADMIN, UserRole.PROJECT_MANAGER]
     if current_user["role"] not in allowed_roles:
         raise HTTPException(status_code=403, detail="Insufficient permissions")
     
     update_data = {k: v for k, v in update.model_dump().items() if v is not None}
-    update_data["updated_at"] = datetime.now(timezone.utc).isoformat()
-    
-    await db.deals.update_one({"id": deal_id}, {"$set": update_data})
-    
-    # Update commission if stage changed to contract
-    if update.stage == DealStage.CONTRACT and update.contract_value:
-        commission = await db.commissions.find_one({"deal_id": deal_id}, {"_id": 0})
-        if commission:
-            earned = update.contract_value * (commission["rate"] / 100)
-            await db.commissions.update_one(
-                {"deal_id": deal_id},
-                {"$set": {"earned_amount": earned, "status": "active"}}
+    for field in ("start_date", "end_date"):
+        if field in update_data:
+            update_data[field] = as_datetime(update_data[field])
+    update_data["updated_at"] = datetime.now(timezone.utc)
+    if update.name:
+        update_data["name_lc"] = update.name.lower()
+    expected_revision = parse_if_match(if_match)
+    
+    # Stage changes (and contract value changes, which move commissions) go through
+    # the transition engine so the deal and its side effects commit together
+    if update.stage or update.contract_value is not None:
+        changes = {k: v for k, v in update_data.items() if k not in ("stage", "updated_at")}
+        
+        async def apply(session):
+            to_stage = update.stage
+            if not to_stage:
+                current = await db.deals.find_one({"id": deal_id}, {"_id": 0, "stage": 1}, session=session)
+                if not current:
+                    raise HTTPException(status_code=404, detail="Deal not found")
+                to_stage = current["stage"]
+            deal = await transition_deal_stage(
+                deal_id, to_stage, current_user["id"], changes, session=session, expected_revision=expected_revision
             )
+            await log_activity(deal_id, "deal_updated", f"Deal updated to stage {deal['stage']}", current_user["id"], session=session,
+                               audience=deal_audience(deal))
+            return deal
+        
+        deal = await run_in_transaction(apply)
+        await invalidate_commission_book()
+        set_etag(response, deal)
+        return deal
     
-    await log_activity(deal_id, "deal_updated", f"Deal updated to stage {update.stage}", current_user["id"])
+    deal = await db.deals.find_one_and_update(
+        with_revision({"id": deal_id}, expected_revision), {"$set": {**update_data, **await change_stamp()}, "$inc": {"revision": 1}},
+        projection={"_id": 0}, return_document=ReturnDocument.AFTER
+    )
+    if not deal:
+        await raise_write_conflict(db.deals, deal_id, "Deal")
+    set_etag(response, deal)
     
-    deal = await db.deals.find_one({"id": deal_id}, {"_id": 0})
+    side_effects = [log_activity(deal_id, "deal_updated", f"Deal updated to stage {deal['stage']}", current_user["id"], audience=deal_audience(deal))]
+    if update.estimated_value is not None:
+        side_effects.append(invalidate_commission_book())
+    await asyncio.gather(*side_effects)
     return deal
 
 @api_router.post("/deals/{deal_id}/assign")
@@ -428,6 +1845,7 @@ async def assign_team(
     pm_id: Optional[str] = None,
     supervisor_id: Optional[str] = None,
     fabricator_ids: Optional[List[str]] = None,
+    if_match: Optional[str] = Header(None),
     current_user: dict = Depends(require_roles([UserRole.ADMIN, UserRole.PROJECT_MANAGER]))
 ):
     update = {}
@@ -439,8 +1857,40 @@ async def assign_team(
         update["assigned_fabricators"] = fabricator_ids
     
     if update:
-        update["updated_at"] = datetime.now(timezone.utc).isoformat()
-        await db.deals.update_one({"id": deal_id}, {"$set": update})
+        update["updated_at"] = datetime.now(timezone.utc)
+        previous = await db.deals.find_one_and_update(
+            with_revision({"id": deal_id}, parse_if_match(if_match)),
+            {"$set": {**update, **await change_stamp()}, "$inc": {"revision": 1}},
+            projection={"_id": 0, "assigned_pm": 1, "assigned_supervisor": 1, "assigned_fabricators": 1},
+            return_document=ReturnDocument.BEFORE
+        )
+        if not previous:
+            await raise_write_conflict(db.deals, deal_id, "Deal")
+        
+        # Whoever was replaced loses the deal from their synced scope
+        removed = set()
+        for field in ("assigned_pm", "assigned_supervisor"):
+            if field in update and previous.get(field) and previous[field] != update[field]:
+                removed.add(previous[field])
+        if "assigned_fabricators" in update:
+            removed |= set(previous.get("assigned_fabricators") or []) - set(update["assigned_fabricators"])
+        
+        # Past activity follows the deal to its new team
+        added = set(update.get("assigned_fabricators", [])) - set(previous.get("assigned_fabricators") or [])
+        added |= {update[f] for f in ("assigned_pm", "assigned_supervisor") if f in update}
+        
+        async def retag_activity():
+            # In this order: someone moved to another role on the deal is both removed and added
+            if removed:
+                await db.activity_logs.update_many(
+                    {"audience": f"deal:{deal_id}"}, {"$pull": {"audience": {"$in": [f"user:{u}" for u in removed]}}}
+                )
+            if added:
+                await db.activity_logs.update_many(
+                    {"audience": f"deal:{deal_id}"}, {"$addToSet": {"audience": {"$each": [f"user:{u}" for u in added]}}}
+                )
+        
+        await asyncio.gather(record_tombstones("deal", deal_id, sorted(removed)), retag_activity())
     
     return {"message": "Team assigned"}
 
@@ -449,7 +1899,7 @@ async def assign_team(
 @api_router.post("/quotations")
 async def create_quotation(quotation: QuotationCreate, current_user: dict = Depends(require_roles([UserRole.ADMIN, UserRole.PROJECT_MANAGER]))):
     quot_id = str(uuid.uuid4())
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
     
     quot_doc = {
         "id": quot_id,
@@ -461,49 +1911,71 @@ async def create_quotation(quotation: QuotationCreate, current_user: dict = Depe
         "validity_days": quotation.validity_days,
         "status": "draft",
         "client_approved": False,
+        "revision": 1,
         "created_by": current_user["id"],
         "created_at": now
     }
     
-    await db.quotations.insert_one(quot_doc)
+    async def apply(session):
+        # Move the deal into quotation unless it is already further along
+        await transition_deal_stage(quotation.deal_id, DealStage.QUOTATION, current_user["id"], session=session, advance_only=True)
+        await db.quotations.insert_one(quot_doc, session=session)
     
-    # Update deal stage
-    await db.deals.update_one({"id": quotation.deal_id}, {"$set": {"stage": DealStage.QUOTATION}})
+    await run_in_transaction(apply)
     
     return {k: v for k, v in quot_doc.items() if k != "_id"}
 
 @api_router.get("/quotations")
 async def get_quotations(deal_id: Optional[str] = None, current_user: dict = Depends(get_current_user)):
-    query = {}
+    query, projection = await access_scope(current_user, "quotations", deal_id=deal_id)
     if deal_id:
-        query["deal_id"] = deal_id
-    
-    quotations = await db.quotations.find(query, {"_id": 0}).sort("created_at", -1).to_list(100)
-    
-    # For clients, only show sent quotations
-    if current_user["role"] in [UserRole.CLIENT_B2B, UserRole.CLIENT_RESIDENTIAL]:
-        quotations = [q for q in quotations if q["status"] == "sent"]
-    
+        return await find_deal_records("quotations", query, projection, [("created_at", -1)], 100)
+    quotations = await db.quotations.find(query, projection).sort("created_at", -1).to_list(100)
     return quotations
 
 @api_router.put("/quotations/{quot_id}/send")
-async def send_quotation(quot_id: str, current_user: dict = Depends(require_roles([UserRole.ADMIN, UserRole.PROJECT_MANAGER]))):
-    await db.quotations.update_one({"id": quot_id}, {"$set": {"status": "sent"}})
-    return {"message": "Quotation sent to client"}
+async def send_quotation(quot_id: str, response: Response, if_match: Optional[str] = Header(None),
+                         current_user: dict = Depends(require_roles([UserRole.ADMIN, UserRole.PROJECT_MANAGER]))):
+    quot = await db.quotations.find_one_and_update(
+        with_revision({"id": quot_id}, parse_if_match(if_match)), {"$set": {"status": "sent"}, "$inc": {"revision": 1}},
+        projection={"_id": 0, "revision": 1}, return_document=ReturnDocument.AFTER
+    )
+    if not quot:
+        await raise_write_conflict(db.quotations, quot_id, "Quotation")
+    set_etag(response, quot)
+    return {"message": "Quotation sent to client", "revision": quot["revision"]}
 
 @api_router.put("/quotations/{quot_id}/approve")
-async def approve_quotation(quot_id: str, approved: bool, current_user: dict = Depends(get_current_user)):
+async def approve_quotation(quot_id: str, approved: bool, response: Response, if_match: Optional[str] = Header(None),
+                            current_user: dict = Depends(get_current_user)):
     # Clients or admin can approve
     status = "approved" if approved else "rejected"
-    await db.quotations.update_one({"id": quot_id}, {"$set": {"status": status, "client_approved": approved}})
+    expected_revision = parse_if_match(if_match)
     
-    if approved:
-        quot = await db.quotations.find_one({"id": quot_id}, {"_id": 0})
-        if quot:
-            await db.deals.update_one(
-                {"id": quot["deal_id"]},
-                {"$set": {"stage": DealStage.CONTRACT, "contract_value": quot["total_amount"]}}
+    async def apply(session):
+        quot = await db.quotations.find_one(
+            with_revision({"id": quot_id}, expected_revision), {"_id": 0, "deal_id": 1, "total_amount": 1, "revision": 1}, session=session
+        )
+        if not quot:
+            await raise_write_conflict(db.quotations, quot_id, "Quotation", session=session)
+        if approved:
+            await transition_deal_stage(
+                quot["deal_id"], DealStage.CONTRACT, current_user["id"],
+                {"contract_value": quot["total_amount"]}, session=session, advance_only=True
             )
+        return await db.quotations.find_one_and_update(
+            with_revision({"id": quot_id}, quot.get("revision", 0)),
+            {"$set": {"status": status, "client_approved": approved}, "$inc": {"revision": 1}},
+            projection={"_id": 0, "revision": 1}, return_document=ReturnDocument.AFTER, session=session
+        )
+    
+    quot = await run_in_transaction(apply)
+    if not quot:
+        await raise_write_conflict(db.quotations, quot_id, "Quotation")
+    if approved:
+        # Approval sets the deal's contract value, which moves commissions
+        await invalidate_commission_book()
+    set_etag(response, quot)
     
     return {"message": f"Quotation {status}"}
 
@@ -512,18 +1984,20 @@ async def approve_quotation(quot_id: str, approved: bool, current_user: dict = D
 @api_router.post("/tasks")
 async def create_task(task: TaskCreate, current_user: dict = Depends(require_roles([UserRole.ADMIN, UserRole.PROJECT_MANAGER]))):
     task_id = str(uuid.uuid4())
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
     
     task_doc = {
         "id": task_id,
         "deal_id": task.deal_id,
         "name": task.name,
         "description": task.description,
-        "start_date": task.start_date,
-        "end_date": task.end_date,
+        "start_date": as_datetime(task.start_date),
+        "end_date": as_datetime(task.end_date),
         "assigned_to": task.assigned_to,
         "status": "pending",
         "progress": 0,
+        "revision": 1,
+        **await change_stamp(),
         "is_milestone": task.is_milestone,
         "is_client_visible": task.is_client_visible,
         "created_at": now
@@ -534,24 +2008,15 @@ async def create_task(task: TaskCreate, current_user: dict = Depends(require_rol
 
 @api_router.get("/tasks")
 async def get_tasks(deal_id: Optional[str] = None, current_user: dict = Depends(get_current_user)):
-    query = {}
+    query, projection = await access_scope(current_user, "tasks", deal_id=deal_id)
     if deal_id:
-        query["deal_id"] = deal_id
-    
-    # Filter by assignment for operational roles
-    if current_user["role"] in [UserRole.SUPERVISOR, UserRole.FABRICATOR]:
-        query["assigned_to"] = current_user["id"]
-    
-    tasks = await db.tasks.find(query, {"_id": 0}).sort("start_date", 1).to_list(1000)
-    
-    # Clients only see client-visible tasks
-    if current_user["role"] in [UserRole.CLIENT_B2B, UserRole.CLIENT_RESIDENTIAL]:
-        tasks = [t for t in tasks if t.get("is_client_visible", False)]
-    
+        return await find_deal_records("tasks", query, projection, [("start_date", 1)], 1000)
+    tasks = await db.tasks.find(query, projection).sort("start_date", 1).to_list(1000)
     return tasks
 
 @api_router.put("/tasks/{task_id}")
-async def update_task(task_id: str, status: Optional[str] = None, progress: Optional[float] = None, current_user: dict = Depends(get_current_user)):
+async def update_task(task_id: str, response: Response, status: Optional[str] = None, progress: Optional[float] = None,
+                      if_match: Optional[str] = Header(None), current_user: dict = Depends(get_current_user)):
     update = {}
     if status:
         update["status"] = status
@@ -559,47 +2024,72 @@ async def update_task(task_id: str, status: Optional[str] = None, progress: Opti
         update["progress"] = progress
     
     if update:
-        await db.tasks.update_one({"id": task_id}, {"$set": update})
-    
-    task = await db.tasks.find_one({"id": task_id}, {"_id": 0})
+        task = await db.tasks.find_one_and_update(
+            with_revision({"id": task_id}, parse_if_match(if_match)), {"$set": {**update, **await change_stamp()}, "$inc": {"revision": 1}},
+            projection={"_id": 0}, return_document=ReturnDocument.AFTER
+        )
+        if not task:
+            await raise_write_conflict(db.tasks, task_id, "Task")
+    else:
+        task = await db.tasks.find_one({"id": task_id}, {"_id": 0})
+        if not task:
+            raise HTTPException(status_code=404, detail="Task not found")
+    set_etag(response, task)
     
     # Update deal progress
-    if task:
-        await update_deal_progress(task["deal_id"])
+    await update_deal_progress(task["deal_id"])
     
     return task
 
 async def update_deal_progress(deal_id: str):
-    tasks = await db.tasks.find({"deal_id": deal_id}, {"_id": 0}).to_list(100)
-    if tasks:
-        total = sum(t.get("progress", 0) for t in tasks) / len(tasks)
-        await db.deals.update_one({"id": deal_id}, {"$set": {"progress_percentage": round(total, 2)}})
+    result = await db.tasks.aggregate([
+        {"$match": {"deal_id": deal_id}},
+        {"$group": {"_id": None, "progress": {"$avg": {"$ifNull": ["$progress", 0]}}}}
+    ]).to_list(1)
+    if result:
+        await db.deals.update_one(
+            {"id": deal_id},
+            {"$set": {"progress_percentage": round(result[0]["progress"], 2), **await change_stamp()}}
+        )
 
 # ==================== PROGRESS UPDATES ====================
 
 @api_router.post("/progress-updates")
 async def create_progress_update(
+    response: Response,
     deal_id: str = Form(...),
     notes: str = Form(...),
     progress_percentage: float = Form(...),
     is_client_visible: bool = Form(True),
     task_id: Optional[str] = Form(None),
     photos: List[UploadFile] = File(default=[]),
+    if_match: Optional[str] = Header(None),
     current_user: dict = Depends(get_current_user)
 ):
     update_id = str(uuid.uuid4())
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
+    expected_revision = parse_if_match(if_match)
+    
+    # A stale If-Match is rejected before any photo is written
+    if not await db.deals.find_one(with_revision({"id": deal_id}, expected_revision), {"_id": 0, "id": 1}):
+        await raise_write_conflict(db.deals, deal_id, "Deal")
     
     # Save photos
-    photo_paths = []
-    for photo in photos:
-        ext = photo.filename.split(".")[-1] if "." in photo.filename else "jpg"
-        fname = f"{update_id}_{len(photo_paths)}.{ext}"
-        fpath = UPLOAD_DIR / fname
-        content = await photo.read()
-        with open(fpath, "wb") as f:
-            f.write(content)
-        photo_paths.append(f"/uploads/{fname}")
+    written = []
+    try:
+        for photo in photos:
+            ext = photo.filename.split(".")[-1] if "." in photo.filename else "jpg"
+            fpath = UPLOAD_DIR / f"{update_id}_{len(written)}.{ext}"
+            content = await photo.read()
+            UPLOAD_BYTES.labels("progress_updates").inc(len(content))
+            with tracer.start_as_current_span("file write", attributes={"file.size": len(content)}), open(fpath, "wb") as f:
+                written.append(fpath)
+                f.write(content)
+    except Exception:
+        for fpath in written:
+            fpath.unlink(missing_ok=True)
+        raise
+    photo_paths = [f"/uploads/{fpath.name}" for fpath in written]
     
     update_doc = {
         "id": update_id,
@@ -611,28 +2101,44 @@ async def create_progress_update(
         "task_id": task_id,
         "created_by": current_user["id"],
         "created_by_name": current_user["name"],
-        "created_at": now
+        "created_at": now,
+        **await change_stamp()
     }
     
-    await db.progress_updates.insert_one(update_doc)
     
-    # Update task if specified
-    if task_id:
-        await db.tasks.update_one({"id": task_id}, {"$set": {"progress": progress_percentage}})
+    # The deal moves last, so a failure before it leaves the deal's revision untouched
+    async def apply(session):
+        await db.progress_updates.insert_one(update_doc, session=session)
+        if task_id:
+            await db.tasks.update_one(
+                {"id": task_id}, {"$set": {"progress": progress_percentage, **await change_stamp()}, "$inc": {"revision": 1}},
+                session=session
+            )
+        deal = await db.deals.find_one_and_update(
+            with_revision({"id": deal_id}, expected_revision),
+            {"$set": {"progress_percentage": progress_percentage, **await change_stamp()}, "$inc": {"revision": 1}},
+            projection={"_id": 0, "revision": 1}, return_document=ReturnDocument.AFTER, session=session
+        )
+        if not deal:
+            await raise_write_conflict(db.deals, deal_id, "Deal", session=session)
+        return deal
     
-    # Update deal progress
-    await db.deals.update_one({"id": deal_id}, {"$set": {"progress_percentage": progress_percentage}})
+    try:
+        deal = await run_in_transaction(apply)
+    except Exception:
+        # Without transactions the update may already be stored
+        await db.progress_updates.delete_one({"id": update_id})
+        for fpath in written:
+            fpath.unlink(missing_ok=True)
+        raise
+    set_etag(response, deal)
     
     return {k: v for k, v in update_doc.items() if k != "_id"}
 
 @api_router.get("/progress-updates")
 async def get_progress_updates(deal_id: str, current_user: dict = Depends(get_current_user)):
-    updates = await db.progress_updates.find({"deal_id": deal_id}, {"_id": 0}).sort("created_at", -1).to_list(100)
-    
-    # Filter for clients
-    if current_user["role"] in [UserRole.CLIENT_B2B, UserRole.CLIENT_RESIDENTIAL]:
-        updates = [u for u in updates if u.get("is_client_visible", False)]
-    
+    query, projection = await access_scope(current_user, "progress_updates", deal_id=deal_id)
+    updates = await find_deal_records("progress_updates", query, projection, [("created_at", -1)], 100)
     return updates
 
 # ==================== DOCUMENT MANAGEMENT ====================
@@ -648,13 +2154,14 @@ async def upload_document(
     current_user: dict = Depends(get_current_user)
 ):
     doc_id = str(uuid.uuid4())
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
     
     ext = file.filename.split(".")[-1] if "." in file.filename else "bin"
     fname = f"{doc_id}.{ext}"
     fpath = UPLOAD_DIR / fname
     content = await file.read()
-    with open(fpath, "wb") as f:
+    UPLOAD_BYTES.labels("documents").inc(len(content))
+    with tracer.start_as_current_span("file write", attributes={"file.size": len(content)}), open(fpath, "wb") as f:
         f.write(content)
     
     # Check version
@@ -665,6 +2172,7 @@ async def upload_document(
         "id": doc_id,
         "deal_id": deal_id,
         "name": name,
+        "name_lc": name.lower(),
         "doc_type": doc_type,
         "category": category,  # client_facing, internal, deal_relationship
         "file_path": f"/uploads/{fname}",
@@ -681,22 +2189,13 @@ async def upload_document(
 
 @api_router.get("/documents")
 async def get_documents(deal_id: Optional[str] = None, category: Optional[str] = None, current_user: dict = Depends(get_current_user)):
-    query = {}
-    if deal_id:
-        query["deal_id"] = deal_id
+    query, projection = await access_scope(current_user, "documents", deal_id=deal_id)
     if category:
-        query["category"] = category
-    
-    docs = await db.documents.find(query, {"_id": 0}).sort("created_at", -1).to_list(500)
-    
-    # Filter for clients
-    if current_user["role"] in [UserRole.CLIENT_B2B, UserRole.CLIENT_RESIDENTIAL]:
-        docs = [d for d in docs if d.get("is_client_visible", False) and d.get("approval_status") == "approved"]
-    
-    # Filter for agents
-    if current_user["role"] == UserRole.SALES_AGENT:
-        docs = [d for d in docs if d.get("category") != "internal"]
+        query = merge_filters(query, {"category": category})
     
+    if deal_id:
+        return await find_deal_records("documents", query, projection, [("created_at", -1)], 500)
+    docs = await db.documents.find(query, projection).sort("created_at", -1).to_list(500)
     return docs
 
 @api_router.put("/documents/{doc_id}/approve")
@@ -709,16 +2208,17 @@ async def approve_document(doc_id: str, approved: bool, current_user: dict = Dep
 
 @api_router.get("/commissions")
 async def get_commissions(current_user: dict = Depends(get_current_user)):
-    query = {}
-    
-    if current_user["role"] == UserRole.SALES_AGENT:
-        query["agent_id"] = current_user["id"]
+    query, projection = await access_scope(current_user, "commissions")
+    commissions = await db.reporting.commissions.find(query, projection).to_list(500)
     
-    commissions = await db.commissions.find(query, {"_id": 0}).to_list(500)
-    
-    # Enrich with deal info
+    # Enrich with deal info, including deals that have been archived
+    deal_ids = list({comm["deal_id"] for comm in commissions})
+    deals = await find_deals_by_id(
+        db.reporting, deal_ids, {"_id": 0, "id": 1, "name": 1, "stage": 1, "contract_value": 1, "estimated_value": 1}
+    )
+    deals_by_id = {d["id"]: d for d in deals}
     for comm in commissions:
-        deal = await db.deals.find_one({"id": comm["deal_id"]}, {"_id": 0})
+        deal = deals_by_id.get(comm["deal_id"])
         if deal:
             comm["deal_name"] = deal.get("name")
             comm["deal_stage"] = deal.get("stage")
@@ -737,6 +2237,7 @@ async def release_commission(comm_id: str, amount: float, current_user: dict = D
         {"id": comm_id},
         {"$set": {"released_amount": new_released}}
     )
+    await invalidate_commission_book()
     
     # Update agent stats
     await db.users.update_one(
@@ -746,12 +2247,437 @@ async def release_commission(comm_id: str, amount: float, current_user: dict = D
     
     return {"message": f"Released ${amount}"}
 
+# ==================== COMMISSION TRIGGER ENGINE ====================
+# Milestone triggers release a percentage of the earned commission once the deal
+# reaches a stage, a progress percentage, or a paid percentage of contract value:
+#   {"type": "stage", "stage": "execution", "percentage": 30}
+#   {"type": "progress", "threshold": 50, "percentage": 30}
+#   {"type": "payment", "threshold": 100, "percentage": 40}
+
+TRIGGER_STAGE = 0
+TRIGGER_PROGRESS = 1
+TRIGGER_PAYMENT = 2
+TRIGGER_TYPES = {"stage": TRIGGER_STAGE, "progress": TRIGGER_PROGRESS, "payment": TRIGGER_PAYMENT}
+
+def validate_milestone_triggers(triggers: List[Dict[str, Any]]):
+    """Check triggers and give new ones an id; a trigger's releases are keyed by its id."""
+    total = 0
+    seen = set()
+    for trigger in triggers:
+        trigger["id"] = str(trigger.get("id") or uuid.uuid4())
+        if trigger["id"] in seen:
+            raise HTTPException(status_code=400, detail=f"Duplicate trigger id: {trigger['id']}")
+        seen.add(trigger["id"])
+        kind = trigger.get("type")
+        if kind not in TRIGGER_TYPES:
+            raise HTTPException(status_code=400, detail=f"Unknown trigger type: {kind}")
+        if kind == "stage" and trigger.get("stage") not in STAGE_RANK:
+            raise HTTPException(status_code=400, detail=f"Unknown stage: {trigger.get('stage')}")
+        if kind != "stage" and not isinstance(trigger.get("threshold"), (int, float)):
+            raise HTTPException(status_code=400, detail=f"Trigger '{kind}' needs a numeric threshold")
+        total += float(trigger.get("percentage", 0))
+    if total > 100:
+        raise HTTPException(status_code=400, detail="Trigger percentages exceed 100%")
+
+def trigger_terms(trigger: dict) -> dict:
+    return {k: v for k, v in trigger.items() if k != "id"}
+
+async def backfill_trigger_ids(batch_size: int = 500):
+    """Give triggers stored before they had ids their list index as id.
+
+    The index is the key their releases were recorded under, so nothing already
+    released changes key.
+    """
+    while True:
+        commissions = await db.commissions.find(
+            {"milestone_triggers": {"$elemMatch": {"id": {"$exists": False}}}}, {"_id": 1, "milestone_triggers": 1}
+        ).limit(batch_size).to_list(batch_size)
+        if not commissions:
+            break
+        # Conditional on the list we read, so a concurrent edit is picked up on the next pass
+        await db.commissions.bulk_write([
+            UpdateOne(
+                {"_id": c["_id"], "milestone_triggers": c["milestone_triggers"]},
+                {"$set": {"milestone_triggers": [{**t, "id": str(t.get("id", i))} for i, t in enumerate(c["milestone_triggers"])]}}
+            )
+            for c in commissions
+        ], ordered=False)
+    logger.info("Commission trigger id backfill complete")
+
+def evaluate_commission_triggers(commissions: List[dict], deals: Dict[str, dict]) -> List[dict]:
+    """Return the releases that are due for the given commissions.
+
+    All triggers are flattened into parallel arrays so the whole book is evaluated
+    with a handful of NumPy operations instead of a Python loop per commission.
+    """
+    # NumPy is the heaviest import in the process and only the commission
+    # engine needs it, so it is imported at first use
+    import numpy as np
+    comm_idx, kinds, thresholds, percentages, keys = [], [], [], [], []
+    base = np.zeros(len(commissions))
+    stage_rank = np.full(len(commissions), -1.0)
+    progress = np.zeros(len(commissions))
+    paid_pct = np.zeros(len(commissions))
+    released_keys = []
+
+    for i, comm in enumerate(commissions):
+        deal = deals.get(comm["deal_id"])
+        if not deal:
+            continue
+        contract_value = deal.get("contract_value") or 0
+        base[i] = contract_value * (comm["rate"] / 100)
+        stage_rank[i] = STAGE_RANK.get(deal.get("stage"), -1)
+        progress[i] = deal.get("progress_percentage") or 0
+        if contract_value:
+            paid_pct[i] = (deal.get("amount_paid") or 0) / contract_value * 100
+        released_keys.extend(comm.get("released_triggers", []))
+        for t_index, trigger in enumerate(comm.get("milestone_triggers") or []):
+            kind = TRIGGER_TYPES.get(trigger.get("type"))
+            if kind is None:
+                continue
+            comm_idx.append(i)
+            kinds.append(kind)
+            if kind == TRIGGER_STAGE:
+                thresholds.append(STAGE_RANK.get(trigger.get("stage"), len(STAGE_ORDER)))
+            else:
+                thresholds.append(float(trigger.get("threshold", 0)))
+            percentages.append(float(trigger.get("percentage", 0)))
+            keys.append(f"{comm['id']}:{trigger.get('id', t_index)}")
+
+    if not keys:
+        return []
+
+    comm_idx = np.asarray(comm_idx)
+    kinds = np.asarray(kinds)
+    thresholds = np.asarray(thresholds, dtype=float)
+    keys = np.asarray(keys)
+
+    # Pick the deal metric each trigger compares against, then test all at once
+    metric = np.select(
+        [kinds == TRIGGER_STAGE, kinds == TRIGGER_PROGRESS],
+        [stage_rank[comm_idx], progress[comm_idx]],
+        default=paid_pct[comm_idx]
+    )
+    amounts = base[comm_idx] * np.asarray(percentages) / 100
+    due = (metric >= thresholds) & (amounts > 0) & ~np.isin(keys, released_keys)
+
+    releases = []
+    for j in np.flatnonzero(due):
+        comm = commissions[comm_idx[j]]
+        trigger_index = keys[j].rsplit(":", 1)[1]
+        releases.append({
+            "id": str(keys[j]),
+            "commission_id": comm["id"],
+            "deal_id": comm["deal_id"],
+            "agent_id": comm["agent_id"],
+            "trigger": trigger_index,
+            "amount": round(float(amounts[j]), 2)
+        })
+    return releases
+
+async def load_commission_book():
+    commissions = await db.commissions.find(
+        {"milestone_triggers.0": {"$exists": True}},
+        {"_id": 0, "id": 1, "deal_id": 1, "agent_id": 1, "rate": 1, "milestone_triggers": 1, "released_triggers": 1}
+    ).to_list(None)
+    deal_ids = list({c["deal_id"] for c in commissions})
+    deals = await db.deals.find(
+        {"id": {"$in": deal_ids}},
+        {"_id": 0, "id": 1, "name": 1, "stage": 1, "contract_value": 1, "progress_percentage": 1, "amount_paid": 1}
+    ).to_list(None)
+    return commissions, {d["id"]: d for d in deals}
+
+def summarize_releases(releases: List[dict]) -> dict:
+    by_agent: Dict[str, float] = {}
+    for r in releases:
+        by_agent[r["agent_id"]] = round(by_agent.get(r["agent_id"], 0) + r["amount"], 2)
+    return {
+        "count": len(releases),
+        "total_amount": round(sum(r["amount"] for r in releases), 2),
+        "by_agent": by_agent,
+        "releases": releases
+    }
+
+async def apply_commission_releases(releases: List[dict], user_id: str) -> List[dict]:
+    """Write releases idempotently; returns only the releases applied by this call.
+
+    The release id is derived from the commission and trigger, so re-running the
+    engine upserts onto existing ledger entries and never pays a trigger twice.
+    The ledger, commission and agent writes commit together. Without transactions,
+    a ledger entry its commission has not recorded yet (a run that stopped part
+    way) is applied by the next run, at the amount first written to the ledger.
+    """
+    if not releases:
+        return []
+    now = datetime.now(timezone.utc)
+
+    async def apply(session):
+        await db.commission_releases.bulk_write([
+            UpdateOne({"id": r["id"]}, {"$setOnInsert": {**r, "released_by": user_id, "created_at": now}}, upsert=True)
+            for r in releases
+        ], ordered=False, session=session)
+        ledger = await db.commission_releases.find(
+            {"id": {"$in": [r["id"] for r in releases]}}, {"_id": 0, "id": 1, "amount": 1}, session=session
+        ).to_list(None)
+        commissions = await db.commissions.find(
+            {"id": {"$in": list({r["commission_id"] for r in releases})}}, {"_id": 0, "released_triggers": 1}, session=session
+        ).to_list(None)
+        recorded = {key for c in commissions for key in c.get("released_triggers", [])}
+        amounts = {row["id"]: row["amount"] for row in ledger}
+        applied = [{**r, "amount": amounts[r["id"]]} for r in releases if r["id"] in amounts and r["id"] not in recorded]
+        if not applied:
+            return []
+
+        await db.commissions.bulk_write([
+            UpdateOne(
+                {"id": r["commission_id"], "released_triggers": {"$ne": r["id"]}},
+                {"$inc": {"released_amount": r["amount"]}, "$push": {"released_triggers": r["id"]}, "$set": {"status": "active"}}
+            )
+            for r in applied
+        ], ordered=False, session=session)
+
+        by_agent = summarize_releases(applied)["by_agent"]
+        await db.users.bulk_write([
+            UpdateOne({"id": agent_id}, {"$inc": {"total_commission_earned": amount}})
+            for agent_id, amount in by_agent.items()
+        ], ordered=False, session=session)
+        return applied
+
+    applied = await run_in_transaction(apply)
+    if applied:
+        await invalidate_commission_book()
+    return applied
+
+@api_router.post("/commissions")
+async def create_commission(commission: CommissionCreate, current_user: dict = Depends(require_roles([UserRole.ADMIN]))):
+    validate_milestone_triggers(commission.milestone_triggers)
+    comm_doc = {
+        "id": str(uuid.uuid4()),
+        "deal_id": commission.deal_id,
+        "agent_id": commission.agent_id,
+        "rate": commission.rate,
+        "milestone_triggers": commission.milestone_triggers,
+        "released_triggers": [],
+        "status": "pending",
+        "earned_amount": 0,
+        "released_amount": 0,
+        "created_at": datetime.now(timezone.utc)
+    }
+    await db.commissions.insert_one(comm_doc)
+    await invalidate_commission_book()
+    return {k: v for k, v in comm_doc.items() if k != "_id"}
+
+@api_router.put("/commissions/{comm_id}/triggers")
+async def set_commission_triggers(comm_id: str, triggers: List[Dict[str, Any]], current_user: dict = Depends(require_roles([UserRole.ADMIN]))):
+    """Replace a commission's triggers. Send existing triggers back with their ids;
+    triggers that have already been released must be kept unchanged."""
+    validate_milestone_triggers(triggers)
+    comm = await db.commissions.find_one({"id": comm_id}, {"_id": 0, "milestone_triggers": 1, "released_triggers": 1})
+    if not comm:
+        raise HTTPException(status_code=404, detail="Commission not found")
+    current = {str(t.get("id", i)): t for i, t in enumerate(comm.get("milestone_triggers") or [])}
+    incoming = {t["id"]: t for t in triggers}
+    released = comm.get("released_triggers")  # None on commissions that predate the field
+    for key in released or []:
+        trigger_id = key.split(":", 1)[1]
+        if trigger_id in current and (
+            trigger_id not in incoming or trigger_terms(incoming[trigger_id]) != trigger_terms(current[trigger_id])
+        ):
+            raise HTTPException(status_code=409, detail=f"Trigger {trigger_id} has been released and cannot be changed or removed")
+    # Conditional on the releases we checked against, so a release run in between is not overwritten
+    result = await db.commissions.update_one(
+        {"id": comm_id, "released_triggers": released}, {"$set": {"milestone_triggers": triggers}}
+    )
+    if not result.matched_count:
+        raise HTTPException(status_code=409, detail="Commission was released meanwhile, reload and retry")
+    await invalidate_commission_book()
+    return {"message": "Triggers updated", "milestone_triggers": triggers}
+
+@api_router.get("/commissions/releases/preview")
+async def preview_commission_releases(current_user: dict = Depends(require_roles([UserRole.ADMIN]))):
+    """Dry run: what the engine would release if it ran now."""
+    commissions, deals = await load_commission_book()
+    return summarize_releases(evaluate_commission_triggers(commissions, deals))
+
+@api_router.post("/commissions/releases/run")
+async def run_commission_releases(current_user: dict = Depends(require_roles([UserRole.ADMIN]))):
+    commissions, deals = await load_commission_book()
+    releases = evaluate_commission_triggers(commissions, deals)
+    applied = await apply_commission_releases(releases, current_user["id"])
+    await log_activity("commissions", "commissions_released", f"Released {len(applied)} commission milestones", current_user["id"],
+                       audience=deal_audience(None))
+    return summarize_releases(applied)
+
+# ==================== COMMISSION SIMULATION ====================
+# The commission book is loaded once into NumPy arrays and reused across what-if
+# scenarios. Any write to commissions (or to the deal values they are based on)
+# drops the cache on every worker; the TTL only bounds staleness from writes made elsewhere.
+# The book is read through db.reporting, so it may also lag a write by the
+# secondary's replication delay.
+
+COMMISSION_BOOK_TTL_SECONDS = int(os.environ.get('COMMISSION_BOOK_TTL_SECONDS', '300'))
+_commission_book: Optional[dict] = None
+_commission_book_lock = asyncio.Lock()
+# Bumped on every invalidation; a load that an invalidation overtook is not cached
+_commission_book_generation = 0
+
+def drop_commission_book():
+    global _commission_book, _commission_book_generation
+    _commission_book = None
+    _commission_book_generation += 1
+
+coordinator.register_cache("commission_book", drop_commission_book)
+
+async def invalidate_commission_book():
+    await coordinator.invalidate("commission_book")
+
+async def get_commission_book_arrays() -> dict:
+    global _commission_book
+    import numpy as np
+    book = _commission_book
+    if book and (datetime.now(timezone.utc) - book["loaded_at"]).total_seconds() < COMMISSION_BOOK_TTL_SECONDS:
+        return book
+
+    async with _commission_book_lock:
+        if _commission_book is not None and _commission_book is not book:
+            return _commission_book
+
+        generation = _commission_book_generation
+        commissions = await db.reporting.commissions.find({}, {"_id": 0, "deal_id": 1, "agent_id": 1, "rate": 1}).to_list(None)
+        deal_projection = {"_id": 0, "id": 1, "contract_value": 1, "estimated_value": 1, "stage": 1}
+        deals = await db.reporting.deals.find({}, deal_projection).to_list(None)
+        deal_index = {d["id"]: d for d in deals}
+        # Commissions stay hot when their deal is archived and remain part of the book
+        archived_ids = list({c["deal_id"] for c in commissions} - deal_index.keys())
+        if archived_ids:
+            archived = await db.reporting.archive_deals.find({"id": {"$in": archived_ids}}, deal_projection).to_list(None)
+            deal_index.update((d["id"], d) for d in archived)
+        commissions = [c for c in commissions if c["deal_id"] in deal_index]
+
+        agent_ids, agent_codes = np.unique(
+            np.asarray([c["agent_id"] for c in commissions], dtype=object).astype(str), return_inverse=True
+        )
+        agents = await db.reporting.users.find({"id": {"$in": agent_ids.tolist()}}, {"_id": 0, "id": 1, "name": 1}).to_list(None)
+
+        book = {
+            "agent_ids": agent_ids,
+            "agent_names": {a["id"]: a.get("name") for a in agents},
+            "agent_codes": agent_codes,
+            "rates": np.asarray([c.get("rate") or 0 for c in commissions], dtype=float),
+            "values": np.asarray([
+                deal_index[c["deal_id"]].get("contract_value") or deal_index[c["deal_id"]].get("estimated_value") or 0
+                for c in commissions
+            ], dtype=float),
+            "stage_codes": np.asarray([STAGE_RANK.get(deal_index[c["deal_id"]].get("stage"), -1) for c in commissions]),
+            "loaded_at": datetime.now(timezone.utc)
+        }
+        if generation == _commission_book_generation:
+            _commission_book = book
+        return book
+
+def simulate_commission_rules(book: dict, rules: List[RateRule]) -> dict:
+    import numpy as np
+    values = book["values"]
+    current = values * book["rates"] / 100
+    new_rates = book["rates"].copy()
+
+    for rule in rules:
+        mask = values >= rule.min_deal_value
+        if rule.max_deal_value is not None:
+            mask &= values < rule.max_deal_value
+        if rule.agent_ids is not None:
+            codes = np.flatnonzero(np.isin(book["agent_ids"], rule.agent_ids))
+            mask &= np.isin(book["agent_codes"], codes)
+        if rule.stages is not None:
+            mask &= np.isin(book["stage_codes"], [STAGE_RANK.get(s, -2) for s in rule.stages])
+        new_rates = np.where(mask, rule.rate, new_rates)
+
+    simulated = values * new_rates / 100
+    n_agents = len(book["agent_ids"])
+    current_by_agent = np.bincount(book["agent_codes"], weights=current, minlength=n_agents)
+    simulated_by_agent = np.bincount(book["agent_codes"], weights=simulated, minlength=n_agents)
+    affected_by_agent = np.bincount(book["agent_codes"], weights=(new_rates != book["rates"]), minlength=n_agents)
+
+    by_agent = [
+        {
+            "agent_id": agent_id,
+            "agent_name": book["agent_names"].get(agent_id),
+            "current": round(float(current_by_agent[i]), 2),
+            "simulated": round(float(simulated_by_agent[i]), 2),
+            "delta": round(float(simulated_by_agent[i] - current_by_agent[i]), 2),
+            "affected_commissions": int(affected_by_agent[i])
+        }
+        for i, agent_id in enumerate(book["agent_ids"].tolist())
+    ]
+    by_agent.sort(key=lambda a: abs(a["delta"]), reverse=True)
+
+    return {
+        "commissions": int(len(values)),
+        "affected_commissions": int(np.count_nonzero(new_rates != book["rates"])),
+        "current_total": round(float(current.sum()), 2),
+        "simulated_total": round(float(simulated.sum()), 2),
+        "delta_total": round(float(simulated.sum() - current.sum()), 2),
+        "by_agent": by_agent,
+        "book_loaded_at": book["loaded_at"].isoformat()
+    }
+
+@api_router.post("/commissions/simulate")
+async def simulate_commissions(scenario: CommissionSimulation, current_user: dict = Depends(require_roles([UserRole.ADMIN]))):
+    for rule in scenario.rules:
+        if rule.stages and any(s not in STAGE_RANK for s in rule.stages):
+            raise HTTPException(status_code=400, detail="Unknown stage in rule")
+    book = await get_commission_book_arrays()
+    return simulate_commission_rules(book, scenario.rules)
+
+# ==================== PAYMENTS ====================
+
+@api_router.post("/deals/{deal_id}/payments")
+async def record_payment(deal_id: str, payment: PaymentCreate, current_user: dict = Depends(require_roles([UserRole.ADMIN]))):
+    if payment.amount <= 0:
+        raise HTTPException(status_code=400, detail="Payment amount must be positive")
+    deal = await db.deals.find_one_and_update(
+        {"id": deal_id}, {"$set": await change_stamp(), "$inc": {"amount_paid": payment.amount, "revision": 1}},
+        projection=DEAL_AUDIENCE_PROJECTION, return_document=ReturnDocument.AFTER
+    )
+    if not deal:
+        raise HTTPException(status_code=404, detail="Deal not found")
+
+    payment_doc = {
+        "id": str(uuid.uuid4()),
+        "deal_id": deal_id,
+        "amount": payment.amount,
+        "reference": payment.reference,
+        "notes": payment.notes,
+        "recorded_by": current_user["id"],
+        "created_at": datetime.now(timezone.utc)
+    }
+    await db.payments.insert_one(payment_doc)
+    await log_activity(deal_id, "payment_recorded", f"Payment of ${payment.amount} recorded", current_user["id"], audience=deal_audience(deal))
+    return {k: v for k, v in payment_doc.items() if k != "_id"}
+
+@api_router.get("/deals/{deal_id}/payments")
+async def get_payments(deal_id: str, current_user: dict = Depends(require_roles([UserRole.ADMIN, UserRole.PROJECT_MANAGER]))):
+    return await db.payments.find({"deal_id": deal_id}, {"_id": 0}).sort("created_at", -1).to_list(500)
+
+# ==================== NOTIFICATIONS ====================
+
+@api_router.get("/notifications")
+async def get_notifications(current_user: dict = Depends(get_current_user)):
+    return await db.notifications.find({"user_id": current_user["id"]}, {"_id": 0}).sort("created_at", -1).to_list(100)
+
+@api_router.put("/notifications/{notification_id}/read")
+async def mark_notification_read(notification_id: str, current_user: dict = Depends(get_current_user)):
+    result = await db.notifications.update_one({"id": notification_id, "user_id": current_user["id"]}, {"$set": {"is_read": True}})
+    if not result.matched_count:
+        raise HTTPException(status_code=404, detail="Notification not found")
+    return {"message": "Notification marked as read"}
+
 # ==================== MESSAGES ====================
 
 @api_router.post("/messages")
 async def create_message(message: MessageCreate, current_user: dict = Depends(get_current_user)):
     msg_id = str(uuid.uuid4())
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
     
     msg_doc = {
         "id": msg_id,
@@ -761,7 +2687,8 @@ async def create_message(message: MessageCreate, current_user: dict = Depends(ge
         "sender_id": current_user["id"],
         "sender_name": current_user["name"],
         "sender_role": current_user["role"],
-        "created_at": now
+        "created_at": now,
+        **await change_stamp()
     }
     
     await db.messages.insert_one(msg_doc)
@@ -769,92 +2696,293 @@ async def create_message(message: MessageCreate, current_user: dict = Depends(ge
 
 @api_router.get("/messages")
 async def get_messages(deal_id: str, current_user: dict = Depends(get_current_user)):
-    messages = await db.messages.find({"deal_id": deal_id}, {"_id": 0}).sort("created_at", 1).to_list(500)
-    
-    # Filter by role visibility
-    role = current_user["role"]
-    messages = [m for m in messages if role in m.get("visible_to_roles", []) or m["sender_id"] == current_user["id"]]
-    
+    query, projection = await access_scope(current_user, "messages", deal_id=deal_id)
+    messages = await find_deal_records("messages", query, projection, [("created_at", 1)], 500)
     return messages
 
+# ==================== DELTA SYNC ====================
+# Offline clients keep a token and ask only for what changed since. Changes
+# younger than SYNC_SETTLE_SECONDS are returned but the token is not advanced
+# past them: a write may take its sequence number before an earlier-numbered
+# write commits, and holding the token back means the client re-reads that window
+# instead of skipping it. Clients upsert by id, so repeated items are harmless.
+
+SYNC_PAGE_SIZE = int(os.environ.get('SYNC_PAGE_SIZE', '500'))
+SYNC_SETTLE_SECONDS = float(os.environ.get('SYNC_SETTLE_SECONDS', '5'))
+
+def parse_sync_token(since: Optional[str]) -> int:
+    if not since:
+        return 0
+    try:
+        return max(int(since), 0)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid sync token")
+
+async def sync_queries(current_user: dict) -> Dict[str, Tuple[dict, dict]]:
+    """(filter, projection) per synced collection, from the shared access scopes."""
+    return {name: await access_scope(current_user, name) for name in SYNCED_COLLECTIONS}
+
+@api_router.get("/sync")
+async def delta_sync(since: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    """Changed deals, tasks, progress updates and messages since ``since``.
+
+    ``tombstones`` lists entities that left the caller's scope (e.g. after a team
+    reassignment or archival); clients should drop them together with their child records.
+    """
+    since_seq = parse_sync_token(since)
+    queries = await sync_queries(current_user)
+    queries["tombstones"] = ({"user_id": current_user["id"]}, {"_id": 0})
+    settle_cutoff = datetime.now(timezone.utc) - timedelta(seconds=SYNC_SETTLE_SECONDS)
+
+    async def fetch(name: str, query: dict, projection: dict):
+        return await getattr(db, "sync_tombstones" if name == "tombstones" else name).find(
+            merge_filters(query, {"change_seq": {"$gt": since_seq}}), projection
+        ).sort("change_seq", 1).limit(SYNC_PAGE_SIZE).to_list(SYNC_PAGE_SIZE)
+
+    names = list(queries)
+    results = dict(zip(names, await asyncio.gather(*[fetch(n, *queries[n]) for n in names])))
+
+    # The token may only advance to the lowest high-water mark of any page that
+    # was cut short, and never past a change that is still settling
+    token = max([since_seq] + [docs[-1]["change_seq"] for docs in results.values() if docs])
+    has_more = False
+    for docs in results.values():
+        if len(docs) == SYNC_PAGE_SIZE:
+            has_more = True
+            token = min(token, docs[-1]["change_seq"])
+        for doc in docs:
+            if doc["changed_at"].replace(tzinfo=timezone.utc) > settle_cutoff:
+                token = min(token, doc["change_seq"] - 1)
+                break
+    token = max(token, since_seq)
+
+    results["tombstones"] = [{"entity": t["entity"], "id": t["entity_id"]} for t in results["tombstones"]]
+    return {"token": str(token), "has_more": has_more, **results}
+
+# ==================== SEARCH ====================
+# Full-text search uses one text index per collection and ranks by textScore.
+# Typeahead matches an anchored prefix on the lowercased name fields, which a
+# regular index can serve. Role scoping comes from access_scope.
+
+SEARCH_TYPES = ("deals", "documents", "messages")
+# Typeahead type -> lowercased fields matched, in the order results are listed
+TYPEAHEAD_FIELDS = {
+    "deals": ("name_lc", "client_name_lc", "client_email_lc"),
+    "documents": ("name_lc",)
+}
+TYPEAHEAD_PROJECTIONS = {
+    "deals": {"_id": 0, "id": 1, "name": 1, "client_name": 1, "client_email": 1, "stage": 1},
+    "documents": {"_id": 0, "id": 1, "deal_id": 1, "name": 1, "doc_type": 1, "category": 1}
+}
+
+@api_router.get("/search")
+async def search(q: str, types: Optional[str] = None, page: int = 1, limit: int = 20,
+                 current_user: dict = Depends(get_current_user)):
+    q = q.strip()
+    if not q:
+        raise HTTPException(status_code=400, detail="Query must not be empty")
+    limit = min(max(limit, 1), 100)
+    page = max(page, 1)
+    requested = [t for t in (types.split(",") if types else SEARCH_TYPES) if t in SEARCH_TYPES]
+
+    projections = {
+        "deals": {"_id": 0, "id": 1, "name": 1, "client_name": 1, "stage": 1},
+        "documents": {"_id": 0, "id": 1, "deal_id": 1, "name": 1, "doc_type": 1, "category": 1, "file_path": 1},
+        "messages": {"_id": 0, "id": 1, "deal_id": 1, "content": 1, "sender_name": 1, "created_at": 1}
+    }
+
+    async def run(collection: str):
+        scope, _ = await access_scope(current_user, collection)
+        query = merge_filters({"$text": {"$search": q}}, scope)
+        projection = {**projections[collection], "score": {"$meta": "textScore"}}
+        return await getattr(db, collection).find(query, projection).sort(
+            [("score", {"$meta": "textScore"})]
+        ).skip((page - 1) * limit).limit(limit).to_list(limit)
+
+    results = await asyncio.gather(*[run(c) for c in requested])
+    return {"query": q, "page": page, "limit": limit, **dict(zip(requested, results))}
+
+@api_router.get("/search/typeahead")
+async def search_typeahead(q: str, limit: int = 10, type: str = "deals", current_user: dict = Depends(get_current_user)):
+    """Deals whose name, client name or client email starts with ``q``, in that
+    order; with ``type=documents``, documents whose name does.
+
+    Each field is read on its own so its index serves both the prefix and the
+    order; an $or over them would have to merge and sort the matches in memory.
+    """
+    if type not in TYPEAHEAD_FIELDS:
+        raise HTTPException(status_code=400, detail=f"Unknown typeahead type: {type}")
+    prefix = q.strip().lower()
+    if not prefix:
+        return []
+    limit = min(max(limit, 1), 50)
+    pattern = {"$regex": "^" + re.escape(prefix)}
+    scope, _ = await access_scope(current_user, type)
+    collection = getattr(db, type)
+    matches = await asyncio.gather(*[
+        collection.find(merge_filters(scope, {field: pattern}), TYPEAHEAD_PROJECTIONS[type]).sort(field, 1).limit(limit).to_list(limit)
+        for field in TYPEAHEAD_FIELDS[type]
+    ])
+    results, listed = [], set()
+    for docs in matches:
+        results += [d for d in docs if d["id"] not in listed]
+        listed.update(d["id"] for d in docs)
+    return results[:limit]
+
+# Typeahead field -> the field it lowercases
+TYPEAHEAD_SOURCES = {"name_lc": "name", "client_name_lc": "client_name", "client_email_lc": "client_email"}
+
+async def backfill_typeahead_fields(batch_size: int = 500) -> Dict[str, int]:
+    """Give deals and documents written before typeahead covered them their lowercased fields."""
+    filled = {}
+    for name, fields in TYPEAHEAD_FIELDS.items():
+        collection = getattr(db, name)
+        filled[name] = 0
+        missing = {"$or": [{field: {"$exists": False}} for field in fields]}
+        while True:
+            docs = await collection.find(missing, {"_id": 1}).limit(batch_size).to_list(batch_size)
+            if not docs:
+                break
+            result = await collection.update_many(
+                {"_id": {"$in": [d["_id"] for d in docs]}},
+                [{"$set": {field: {"$toLower": f"${TYPEAHEAD_SOURCES[field]}"} for field in fields}}]
+            )
+            filled[name] += result.modified_count
+        logger.info("Typeahead field backfill complete for %s: %d", name, filled[name])
+    return filled
+
 # ==================== DASHBOARD ENDPOINTS ====================
+# Dashboards read through db.reporting, so they are served by a secondary when
+# the deployment has one and get the longer reporting time limit.
+
+def count_where(condition: dict) -> dict:
+    return {"$sum": {"$cond": [condition, 1, 0]}}
+
+def count_unless(condition: dict) -> dict:
+    return {"$sum": {"$cond": [condition, 0, 1]}}
+
+FINISHED_STAGES = [DealStage.COMPLETED, DealStage.CLOSED]
+# One pass over the caller's deals computes every figure a dashboard shows
+DEAL_SUMMARY = {
+    "total": {"$sum": 1},
+    "active": count_unless({"$in": ["$stage", FINISHED_STAGES]}),
+    "completed": count_where({"$eq": ["$stage", DealStage.COMPLETED]}),
+    "in_progress": count_unless({"$in": ["$stage", FINISHED_STAGES + [DealStage.INQUIRY]]}),
+    "in_execution": count_where({"$in": ["$stage", [DealStage.EXECUTION, DealStage.FABRICATION, DealStage.INSTALLATION]]}),
+    "pending_handover": count_where({"$eq": ["$stage", DealStage.HANDOVER]}),
+    "won": count_where({"$gt": [{"$ifNull": ["$contract_value", 0]}, 0]}),
+    "value": {"$sum": {"$ifNull": ["$contract_value", {"$ifNull": ["$estimated_value", 0]}]}},
+    "active_estimated_value": {"$sum": {"$cond": [
+        {"$in": ["$stage", FINISHED_STAGES]}, 0, {"$ifNull": ["$estimated_value", 0]}
+    ]}}
+}
+TASK_SUMMARY = {
+    "total": {"$sum": 1},
+    "pending": count_where({"$ne": ["$status", "completed"]}),
+    "completed": count_where({"$eq": ["$status", "completed"]})
+}
+COMMISSION_SUMMARY = {
+    "earned": {"$sum": {"$ifNull": ["$earned_amount", 0]}},
+    "released": {"$sum": {"$ifNull": ["$released_amount", 0]}}
+}
+
+async def summarize(collection: str, query: dict, summary: dict) -> dict:
+    """Group ``query``'s matches in ``collection`` into one row of ``summary`` fields."""
+    rows = await getattr(db.reporting, collection).aggregate([
+        {"$match": query}, {"$group": {"_id": None, **summary}}
+    ]).to_list(1)
+    return rows[0] if rows else {field: 0 for field in summary}
 
 @api_router.get("/dashboard/stats")
 async def get_dashboard_stats(current_user: dict = Depends(get_current_user)):
     role = current_user["role"]
+    deal_scope, _ = await access_scope(current_user, "deals")
     stats = {}
     
     if role == UserRole.ADMIN:
-        total_deals = await db.deals.count_documents({})
-        active_deals = await db.deals.count_documents({"stage": {"$nin": [DealStage.COMPLETED, DealStage.CLOSED]}})
-        total_value = 0
-        deals = await db.deals.find({}, {"_id": 0}).to_list(1000)
-        for d in deals:
-            total_value += d.get("contract_value") or d.get("estimated_value") or 0
-        
+        document_scope, _ = await access_scope(current_user, "documents")
+        deals, pending_approvals, total_agents, total_partners = await asyncio.gather(
+            summarize("deals", deal_scope, DEAL_SUMMARY),
+            db.reporting.documents.count_documents(merge_filters(document_scope, {"approval_status": "pending"})),
+            db.reporting.users.count_documents({"role": UserRole.SALES_AGENT}),
+            db.reporting.users.count_documents({"role": UserRole.PARTNER})
+        )
         stats = {
-            "total_deals": total_deals,
-            "active_deals": active_deals,
-            "completed_deals": await db.deals.count_documents({"stage": DealStage.COMPLETED}),
-            "total_pipeline_value": total_value,
-            "pending_approvals": await db.documents.count_documents({"approval_status": "pending"}),
-            "total_agents": await db.users.count_documents({"role": UserRole.SALES_AGENT}),
-            "total_partners": await db.users.count_documents({"role": UserRole.PARTNER})
+            "total_deals": deals["total"],
+            "active_deals": deals["active"],
+            "completed_deals": deals["completed"],
+            "total_pipeline_value": deals["value"],
+            "pending_approvals": pending_approvals,
+            "total_agents": total_agents,
+            "total_partners": total_partners
         }
     
     elif role == UserRole.SALES_AGENT:
-        my_deals = await db.deals.find({"referral_agent_id": current_user["id"]}, {"_id": 0}).to_list(100)
-        commissions = await db.commissions.find({"agent_id": current_user["id"]}, {"_id": 0}).to_list(100)
-        
-        total_earned = sum(c.get("earned_amount", 0) for c in commissions)
-        total_released = sum(c.get("released_amount", 0) for c in commissions)
-        
+        commission_scope, _ = await access_scope(current_user, "commissions")
+        deals, commissions = await asyncio.gather(
+            summarize("deals", deal_scope, DEAL_SUMMARY),
+            summarize("commissions", commission_scope, COMMISSION_SUMMARY)
+        )
         stats = {
-            "total_deals": len(my_deals),
-            "active_deals": len([d for d in my_deals if d["stage"] not in [DealStage.COMPLETED, DealStage.CLOSED]]),
-            "deals_won": len([d for d in my_deals if d.get("contract_value")]),
-            "total_commission_earned": total_earned,
-            "commission_released": total_released,
-            "commission_pending": total_earned - total_released,
-            "pipeline_value": sum(d.get("estimated_value", 0) for d in my_deals if d["stage"] not in [DealStage.COMPLETED, DealStage.CLOSED])
+            "total_deals": deals["total"],
+            "active_deals": deals["active"],
+            "deals_won": deals["won"],
+            "total_commission_earned": commissions["earned"],
+            "commission_released": commissions["released"],
+            "commission_pending": commissions["earned"] - commissions["released"],
+            "pipeline_value": deals["active_estimated_value"]
         }
     
     elif role == UserRole.PROJECT_MANAGER:
-        my_deals = await db.deals.find({"assigned_pm": current_user["id"]}, {"_id": 0}).to_list(100)
+        task_scope, _ = await access_scope(current_user, "tasks")
+        today = start_of_today()
+        deals, overdue_tasks = await asyncio.gather(
+            summarize("deals", deal_scope, DEAL_SUMMARY),
+            db.reporting.tasks.count_documents(merge_filters(
+                task_scope, {"assigned_to": {"$exists": True}, "status": {"$ne": "completed"}},
+                before("end_date", today, legacy=today.date().isoformat())
+            ))
+        )
         stats = {
-            "assigned_deals": len(my_deals),
-            "in_execution": len([d for d in my_deals if d["stage"] in [DealStage.EXECUTION, DealStage.FABRICATION, DealStage.INSTALLATION]]),
-            "pending_handover": len([d for d in my_deals if d["stage"] == DealStage.HANDOVER]),
-            "overdue_tasks": await db.tasks.count_documents({"assigned_to": {"$exists": True}, "status": {"$ne": "completed"}, "end_date": {"$lt": datetime.now(timezone.utc).isoformat()[:10]}})
+            "assigned_deals": deals["total"],
+            "in_execution": deals["in_execution"],
+            "pending_handover": deals["pending_handover"],
+            "overdue_tasks": overdue_tasks
         }
     
-    elif role in [UserRole.CLIENT_B2B, UserRole.CLIENT_RESIDENTIAL]:
-        my_deals = await db.deals.find({"$or": [{"client_email": current_user["email"]}, {"client_id": current_user["id"]}]}, {"_id": 0}).to_list(50)
+    elif role in CLIENT_ROLES:
+        deals = await summarize("deals", deal_scope, DEAL_SUMMARY)
         stats = {
-            "my_projects": len(my_deals),
-            "in_progress": len([d for d in my_deals if d["stage"] not in [DealStage.COMPLETED, DealStage.CLOSED, DealStage.INQUIRY]]),
-            "completed": len([d for d in my_deals if d["stage"] == DealStage.COMPLETED])
+            "my_projects": deals["total"],
+            "in_progress": deals["in_progress"],
+            "completed": deals["completed"]
         }
     
     elif role == UserRole.SUPERVISOR:
+        task_scope, _ = await access_scope(current_user, "tasks")
+        assigned_sites, pending_updates = await asyncio.gather(
+            db.reporting.deals.count_documents(deal_scope),
+            db.reporting.tasks.count_documents(merge_filters(task_scope, {"status": {"$ne": "completed"}}))
+        )
         stats = {
-            "assigned_sites": await db.deals.count_documents({"assigned_supervisor": current_user["id"]}),
-            "pending_updates": await db.tasks.count_documents({"assigned_to": current_user["id"], "status": {"$ne": "completed"}})
+            "assigned_sites": assigned_sites,
+            "pending_updates": pending_updates
         }
     
     elif role == UserRole.FABRICATOR:
-        tasks = await db.tasks.find({"assigned_to": current_user["id"]}, {"_id": 0}).to_list(100)
+        task_scope, _ = await access_scope(current_user, "tasks")
+        tasks = await summarize("tasks", task_scope, TASK_SUMMARY)
         stats = {
-            "assigned_jobs": len(tasks),
-            "pending_jobs": len([t for t in tasks if t["status"] != "completed"]),
-            "completed_jobs": len([t for t in tasks if t["status"] == "completed"])
+            "assigned_jobs": tasks["total"],
+            "pending_jobs": tasks["pending"],
+            "completed_jobs": tasks["completed"]
         }
     
     elif role == UserRole.PARTNER:
-        my_deals = await db.deals.find({"partner_ids": current_user["id"]}, {"_id": 0}).to_list(100)
+        deals = await summarize("deals", deal_scope, DEAL_SUMMARY)
         stats = {
-            "involved_deals": len(my_deals),
-            "active_collaborations": len([d for d in my_deals if d["stage"] not in [DealStage.COMPLETED, DealStage.CLOSED]])
+            "involved_deals": deals["total"],
+            "active_collaborations": deals["active"]
         }
     
     return stats
@@ -864,19 +2992,509 @@ async def get_pipeline(current_user: dict = Depends(get_current_user)):
     stages = [DealStage.INQUIRY, DealStage.QUOTATION, DealStage.NEGOTIATION, DealStage.CONTRACT, 
               DealStage.EXECUTION, DealStage.FABRICATION, DealStage.INSTALLATION, DealStage.HANDOVER, DealStage.COMPLETED]
     
-    pipeline = []
-    for stage in stages:
-        count = await db.deals.count_documents({"stage": stage})
-        deals_in_stage = await db.deals.find({"stage": stage}, {"_id": 0}).to_list(100)
-        value = sum(d.get("contract_value") or d.get("estimated_value") or 0 for d in deals_in_stage)
-        pipeline.append({"stage": stage, "count": count, "value": value})
+    query, _ = await access_scope(current_user, "deals")
+    totals = await db.reporting.deals.aggregate([
+        {"$match": merge_filters(query, {"stage": {"$in": stages}})},
+        {"$group": {
+            "_id": "$stage",
+            "count": {"$sum": 1},
+            "value": {"$sum": {"$ifNull": ["$contract_value", {"$ifNull": ["$estimated_value", 0]}]}}
+        }}
+    ]).to_list(None)
+    by_stage = {t["_id"]: t for t in totals}
     
-    return pipeline
+    return [
+        {"stage": stage, "count": by_stage.get(stage, {}).get("count", 0), "value": by_stage.get(stage, {}).get("value", 0)}
+        for stage in stages
+    ]
 
 @api_router.get("/dashboard/recent-activity")
 async def get_recent_activity(limit: int = 20, current_user: dict = Depends(get_current_user)):
-    activities = await db.activity_logs.find({}, {"_id": 0}).sort("timestamp", -1).limit(limit).to_list(limit)
-    return activities
+    feed = await read_activity_feed(current_user, limit)
+    return feed["items"]
+
+# ==================== ACTIVITY FEED ====================
+# Pages are keyed on (timestamp, id) rather than skip/offset, so every page is
+# a bounded range scan of the (audience, timestamp, id) index.
+
+ACTIVITY_PAGE_MAX = 100
+
+def encode_activity_cursor(entry: dict) -> str:
+    # The cursor remembers whether the timestamp was a date or a legacy string
+    timestamp = entry["timestamp"]
+    kind, value = ("s", timestamp) if isinstance(timestamp, str) else ("d", timestamp.isoformat())
+    return base64.urlsafe_b64encode(f"{kind}|{value}|{entry['id']}".encode()).decode()
+
+def decode_activity_cursor(cursor: str) -> dict:
+    """Filter for entries after the cursor in (timestamp, id) descending order."""
+    try:
+        kind, value, entry_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 2)
+        timestamp = as_datetime(value) if kind == "d" else value
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    after = [{"timestamp": {"$lt": timestamp}}, {"timestamp": timestamp, "id": {"$lt": entry_id}}]
+    if kind == "d":
+        # Legacy string timestamps sort below every date
+        after.append({"timestamp": {"$type": "string"}})
+    return {"$or": after}
+
+async def read_activity_feed(current_user: dict, limit: int, before: Optional[str] = None, deal_id: Optional[str] = None) -> dict:
+    limit = min(max(limit, 1), ACTIVITY_PAGE_MAX)
+    query, projection = await access_scope(current_user, "activity_logs", deal_id=deal_id)
+    if before:
+        query = merge_filters(query, decode_activity_cursor(before))
+    items = await db.activity_logs.find(query, projection).sort(
+        [("timestamp", -1), ("id", -1)]
+    ).limit(limit).to_list(limit)
+    return {"items": items, "next_cursor": encode_activity_cursor(items[-1]) if len(items) == limit else None}
+
+@api_router.get("/activity")
+async def get_activity_feed(limit: int = 20, before: Optional[str] = None, deal_id: Optional[str] = None,
+                            current_user: dict = Depends(get_current_user)):
+    """Activity visible to the caller, newest first. Pass ``next_cursor`` back as ``before``."""
+    return await read_activity_feed(current_user, limit, before, deal_id)
+
+# ==================== RETENTION AND ARCHIVAL ====================
+# Deals that have been COMPLETED or CLOSED for ARCHIVE_AFTER_DAYS move, with
+# their child records, into archive_* collections so the hot collections and
+# their indexes only hold live work. Reads for a single deal merge the hot and
+# archived records, since an archived deal can still gain new ones. Delta sync
+# only reads hot collections, so everyone who could see an archived deal gets a
+# tombstone for it. Commissions and payments stay hot for agent totals and payouts.
+
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '180'))
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', '50'))
+# Run the archival job in the background this often; 0 leaves it to the admin endpoint
+ARCHIVE_INTERVAL_HOURS = float(os.environ.get('ARCHIVE_INTERVAL_HOURS', '0'))
+ARCHIVED_CHILDREN = ("tasks", "progress_updates", "documents", "messages", "quotations")
+
+def sort_records(records: List[dict], sort: List[Tuple[str, int]]) -> List[dict]:
+    """Sort like Mongo does for ``sort``, with missing values first."""
+    for field, direction in reversed(sort):
+        records.sort(key=lambda r: (r.get(field) is not None, r.get(field)), reverse=direction < 0)
+    return records
+
+async def find_deal_records(collection: str, query: dict, projection: dict, sort: List[Tuple[str, int]], limit: int) -> List[dict]:
+    """Read one deal's records from both the hot collection and its archive."""
+    hot, archived = await asyncio.gather(
+        getattr(db, collection).find(query, projection).sort(sort).to_list(limit),
+        getattr(db, f"archive_{collection}").find(query, projection).sort(sort).to_list(limit)
+    )
+    # A rerun after a partial archive can leave a record in both; the hot copy wins
+    hot_ids = {r.get("id") for r in hot}
+    return sort_records(hot + [r for r in archived if r.get("id") not in hot_ids], sort)[:limit]
+
+async def find_deals_by_id(database: BinaryIdDatabase, deal_ids: List[str], projection: dict) -> List[dict]:
+    """Read deals by id, looking in the archive for any that are no longer hot."""
+    deals = await database.deals.find({"id": {"$in": deal_ids}}, projection).to_list(None)
+    missing = set(deal_ids) - {d["id"] for d in deals}
+    if missing:
+        deals += await database.archive_deals.find({"id": {"$in": list(missing)}}, projection).to_list(None)
+    return deals
+
+async def move_to_archive(collection: str, query: dict, archived_at: datetime, session=None) -> int:
+    docs = await getattr(db, collection).find(query, session=session).to_list(None)
+    if not docs:
+        return 0
+    # Upserts keyed on _id make a rerun after a partial failure harmless
+    await getattr(db, f"archive_{collection}").bulk_write(
+        [ReplaceOne({"_id": doc["_id"]}, {**doc, "archived_at": archived_at}, upsert=True) for doc in docs],
+        ordered=False, session=session
+    )
+    await getattr(db, collection).delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}}, session=session)
+    return len(docs)
+
+async def deal_readers(deal_id: str) -> List[str]:
+    """Ids of every user whose synced scope includes the deal or its tasks."""
+    deal = await db.deals.find_one(
+        {"id": deal_id}, {"_id": 0, "client_id": 1, "client_email": 1, **{f: 1 for f in DEAL_MEMBER_FIELDS}}
+    )
+    if not deal:
+        return []
+    readers = {deal.get("client_id")}
+    for field in DEAL_MEMBER_FIELDS:
+        value = deal.get(field)
+        readers.update(value if isinstance(value, list) else [value])
+    users = [{"role": UserRole.ADMIN}]
+    if deal.get("client_email"):
+        users.append({"email": deal["client_email"]})
+    readers.update(u["id"] for u in await db.users.find({"$or": users}, {"_id": 0, "id": 1}).to_list(None))
+    tasks = await db.tasks.find({"deal_id": deal_id, "assigned_to": {"$ne": None}}, {"_id": 0, "assigned_to": 1}).to_list(None)
+    readers.update(t["assigned_to"] for t in tasks)
+    return sorted(r for r in readers if r)
+
+async def archive_deal(deal_id: str) -> Dict[str, int]:
+    archived_at = datetime.now(timezone.utc)
+    readers = await deal_readers(deal_id)
+
+    async def apply(session):
+        # Children first: if this is interrupted without a transaction the deal
+        # is still hot and the next run picks it up again
+        moved = {name: await move_to_archive(name, {"deal_id": deal_id}, archived_at, session) for name in ARCHIVED_CHILDREN}
+        moved["deals"] = await move_to_archive("deals", {"id": deal_id}, archived_at, session)
+        return moved
+
+    moved = await run_in_transaction(apply)
+    if moved["deals"]:
+        await record_tombstones("deal", deal_id, readers)
+    return moved
+
+async def run_archival() -> dict:
+    cutoff = datetime.now(timezone.utc) - timedelta(days=ARCHIVE_AFTER_DAYS)
+    totals = {name: 0 for name in ("deals", *ARCHIVED_CHILDREN)}
+    while True:
+        batch = await db.deals.find(
+            {"stage": {"$in": [DealStage.COMPLETED, DealStage.CLOSED]}, **before("updated_at", cutoff)},
+            {"_id": 0, "id": 1}
+        ).limit(ARCHIVE_BATCH_SIZE).to_list(ARCHIVE_BATCH_SIZE)
+        if not batch:
+            break
+        for deal in batch:
+            for name, count in (await archive_deal(deal["id"])).items():
+                totals[name] += count
+    if totals["deals"]:
+        await invalidate_commission_book()
+        logger.info("Archived %d deals", totals["deals"])
+    return totals
+
+async def archival_loop():
+    while True:
+        await asyncio.sleep(ARCHIVE_INTERVAL_HOURS * 3600)
+        try:
+            if await coordinator.is_leader("archival"):
+                await run_archival()
+        except Exception:
+            logger.exception("Archival run failed")
+
+@api_router.post("/admin/archive/run")
+async def run_archive(current_user: dict = Depends(require_roles([UserRole.ADMIN]))):
+    totals = await run_archival()
+    await log_activity("archive", "deals_archived", f"Archived {totals['deals']} deals", current_user["id"], audience=deal_audience(None))
+    return {"archived": totals, "cutoff_days": ARCHIVE_AFTER_DAYS}
+
+# ==================== SLOW QUERIES ====================
+# SlowQueryListener hands slow commands to record_slow_query(), which stores
+# them in the capped ``slow_queries`` collection. Filters are stored as shapes
+# (values replaced by "?") so no user data lands in the log. A sample of them is
+# re-run through explain to show COLLSCANs and how many documents were examined
+# per document returned.
+
+SLOW_QUERY_EXPLAIN_RATE = float(os.environ.get('SLOW_QUERY_EXPLAIN_RATE', '0.2'))
+SLOW_QUERY_LOG_BYTES = int(os.environ.get('SLOW_QUERY_LOG_BYTES', str(16 * 1024 * 1024)))
+SLOW_QUERY_MAX_EXPLAINS = 2
+# Command fields that describe the query, per command
+SHAPE_FIELDS = {
+    "find": ("filter", "sort"), "aggregate": ("pipeline",), "count": ("query",), "distinct": ("key", "query"),
+    "findAndModify": ("query", "sort"), "update": ("updates",), "delete": ("deletes",)
+}
+# Session and transaction fields the driver adds, which explain rejects
+DRIVER_FIELDS = {"lsid", "txnNumber", "autocommit", "startTransaction", "readConcern", "writeConcern"}
+explains_running = 0
+
+def query_shape(value, key: str = ""):
+    if key in ("sort", "key"):
+        return value
+    if isinstance(value, dict):
+        return {k: query_shape(v, k) for k, v in value.items()}
+    if isinstance(value, list) and value and all(isinstance(v, dict) for v in value):
+        return [query_shape(v) for v in value]
+    return "?"
+
+def command_shape(command_name: str, command: dict) -> dict:
+    shape = {}
+    for field in SHAPE_FIELDS.get(command_name, ()):
+        if field in ("updates", "deletes"):
+            shape["q"] = query_shape(command.get(field, [{}])[0].get("q", {}))
+        elif field in command:
+            shape[field] = query_shape(command[field], field)
+    return shape
+
+def collect_values(value, key: str):
+    if isinstance(value, dict):
+        for k, v in value.items():
+            if k == key:
+                yield v
+            yield from collect_values(v, key)
+    elif isinstance(value, list):
+        for v in value:
+            yield from collect_values(v, key)
+
+def analyze_explain(explain: dict) -> dict:
+    stages = sorted(set(collect_values(explain, "stage")))
+    stats = next(collect_values(explain, "executionStats"), {})
+    examined = stats.get("totalDocsExamined", 0)
+    returned = stats.get("nReturned", 0)
+    return {
+        "plan_stages": stages,
+        "indexes": sorted(set(collect_values(explain, "indexName"))),
+        "collscan": "COLLSCAN" in stages,
+        "docs_examined": examined,
+        "keys_examined": stats.get("totalKeysExamined", 0),
+        "returned": returned,
+        "examined_per_returned": round(examined / max(returned, 1), 1)
+    }
+
+async def explain_command(database_name: str, command_name: str, command: dict) -> dict:
+    explained = {k: v for k, v in command.items() if not k.startswith("$") and k not in DRIVER_FIELDS}
+    if command_name in ("update", "delete"):
+        field = f"{command_name}s"
+        explained[field] = explained[field][:1]
+    return await client[database_name].command({"explain": explained, "verbosity": "executionStats"})
+
+async def record_slow_query(database_name: str, collection: str, command_name: str, command: dict,
+                            duration_ms: float, scope: Optional[dict]):
+    global explains_running
+    shape = json.dumps(command_shape(command_name, command), sort_keys=True, default=str)
+    entry = {
+        "id": str(uuid.uuid4()),
+        "collection": collection,
+        "command": command_name,
+        "shape": shape,
+        "shape_hash": hashlib.sha1(f"{collection}:{command_name}:{shape}".encode()).hexdigest()[:16],
+        "duration_ms": round(duration_ms, 1),
+        "method": scope["method"] if scope else None,
+        "route": route_template(scope) if scope else None,
+        "at": datetime.now(timezone.utc)
+    }
+    logger.warning("Slow query %s.%s %.0fms from %s %s", collection, command_name, duration_ms, entry["method"], entry["route"])
+    if (command_name in SHAPE_FIELDS and random.random() < SLOW_QUERY_EXPLAIN_RATE
+            and explains_running < SLOW_QUERY_MAX_EXPLAINS):
+        explains_running += 1
+        try:
+            entry["explain"] = analyze_explain(await explain_command(database_name, command_name, command))
+        except Exception as e:
+            entry["explain_error"] = str(e)
+        finally:
+            explains_running -= 1
+    try:
+        await db.slow_queries.insert_one(entry)
+    except Exception:
+        logger.exception("Could not record slow query")
+
+async def create_slow_query_log():
+    slow_query_listener.loop = asyncio.get_running_loop()
+    try:
+        await db.raw.create_collection("slow_queries", capped=True, size=SLOW_QUERY_LOG_BYTES)
+    except CollectionInvalid:
+        pass
+    except Exception:
+        # Some hosted tiers have no capped collections; the log then grows uncapped
+        logger.warning("Could not create capped slow_queries collection", exc_info=True)
+
+@api_router.get("/admin/slow-queries")
+async def get_slow_queries(hours: float = 24, limit: int = 20, current_user: dict = Depends(require_roles([UserRole.ADMIN]))):
+    """Slow query shapes since ``hours`` ago, worst total time first, each with its latest explain."""
+    since = datetime.now(timezone.utc) - timedelta(hours=hours)
+    offenders = await db.slow_queries.aggregate([
+        {"$match": {"at": {"$gte": since}}},
+        {"$sort": {"at": -1}},
+        {"$group": {
+            "_id": {"shape_hash": "$shape_hash", "method": "$method", "route": "$route"},
+            "collection": {"$first": "$collection"},
+            "command": {"$first": "$command"},
+            "shape": {"$first": "$shape"},
+            "count": {"$sum": 1},
+            "total_ms": {"$sum": "$duration_ms"},
+            "avg_ms": {"$avg": "$duration_ms"},
+            "max_ms": {"$max": "$duration_ms"},
+            "last_seen": {"$first": "$at"},
+            "collscan": {"$max": "$explain.collscan"},
+            "worst_examined_per_returned": {"$max": "$explain.examined_per_returned"}
+        }},
+        {"$sort": {"total_ms": -1}},
+        {"$limit": min(limit, 100)}
+    ]).to_list(100)
+    for offender in offenders:
+        key = offender.pop("_id")
+        offender.update(key)
+        offender["avg_ms"] = round(offender["avg_ms"], 1)
+        sample = await db.slow_queries.find_one(
+            {"shape_hash": key["shape_hash"], "explain": {"$exists": True}}, {"_id": 0, "explain": 1}, sort=[("at", -1)]
+        )
+        offender["explain"] = sample["explain"] if sample else None
+    return {"threshold_ms": SLOW_QUERY_MS, "since": since, "offenders": offenders}
+
+# ==================== PROFILING ====================
+# POST /api/admin/profile samples the event loop thread's stack from a helper
+# thread for a few seconds and returns collapsed stacks, which flamegraph.pl
+# and speedscope read directly. A heartbeat coroutine measures loop lag at the
+# same time. Whenever the heartbeat stops for ``blocked_ms`` the stack at that
+# moment is reported as a stall, which is how synchronous work on the loop shows
+# up. Only the worker that serves the request is profiled.
+
+PROFILE_MAX_SECONDS = 60
+PROFILE_HEARTBEAT_SECONDS = 0.01
+profile_lock = asyncio.Lock()
+
+def frame_label(frame) -> str:
+    return f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})"
+
+def frame_stack(frame) -> List[str]:
+    """Root-first labels for ``frame`` and its callers."""
+    stack = []
+    while frame is not None:
+        stack.append(frame_label(frame))
+        frame = frame.f_back
+    return stack[::-1]
+
+class StackSampler(threading.Thread):
+    def __init__(self, thread_id: int, interval: float, blocked_ms: float, heartbeat: List[float]):
+        super().__init__(name="stack-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.blocked_ms = blocked_ms
+        self.heartbeat = heartbeat
+        self.stop = threading.Event()
+        self.stacks: collections.Counter = collections.Counter()
+        self.stalls: List[dict] = []
+
+    def run(self):
+        stall = None
+        while not self.stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            stack = frame_stack(frame)
+            del frame
+            self.stacks[";".join(stack)] += 1
+            blocked_ms = (time.perf_counter() - self.heartbeat[0] - PROFILE_HEARTBEAT_SECONDS) * 1000
+            if blocked_ms >= self.blocked_ms:
+                if stall is None:
+                    stall = {"stack": stack, "stacks": collections.Counter()}
+                    self.stalls.append(stall)
+                stall["duration_ms"] = round(blocked_ms, 1)
+                stall["stacks"][";".join(stack)] += 1
+            else:
+                stall = None
+
+async def profile_event_loop(seconds: float, interval_ms: float, blocked_ms: float) -> dict:
+    heartbeat = [time.perf_counter()]
+    sampler = StackSampler(threading.get_ident(), interval_ms / 1000, blocked_ms, heartbeat)
+    sampler.start()
+    lags = []
+    deadline = heartbeat[0] + seconds
+    while heartbeat[0] < deadline:
+        before = time.perf_counter()
+        await asyncio.sleep(PROFILE_HEARTBEAT_SECONDS)
+        heartbeat[0] = time.perf_counter()
+        lags.append(max(0.0, (heartbeat[0] - before - PROFILE_HEARTBEAT_SECONDS) * 1000))
+    sampler.stop.set()
+    await asyncio.to_thread(sampler.join)
+
+    # quantiles needs two points; a very short profile may only have one
+    cuts = statistics.quantiles(lags if len(lags) > 1 else lags * 2, n=100, method="inclusive")
+    stalls = []
+    for stall in sampler.stalls:
+        # The stack seen most often while blocked is the one doing the blocking
+        stack = stall["stacks"].most_common(1)[0][0].split(";")
+        stalls.append({"duration_ms": stall["duration_ms"], "stack": stack[-12:]})
+    return {
+        "seconds": seconds,
+        "samples": sum(sampler.stacks.values()),
+        "collapsed": "\n".join(f"{stack} {count}" for stack, count in sampler.stacks.most_common()),
+        "loop_lag_ms": {
+            "mean": round(statistics.fmean(lags), 2),
+            "p50": round(cuts[49], 2),
+            "p99": round(cuts[98], 2),
+            "max": round(max(lags), 2)
+        },
+        "stalls": sorted(stalls, key=lambda s: s["duration_ms"], reverse=True)
+    }
+
+@api_router.post("/admin/profile")
+async def profile_worker(seconds: float = 10, interval_ms: float = 5, blocked_ms: float = 100, format: str = "json",
+                         current_user: dict = Depends(require_roles([UserRole.ADMIN]))):
+    """Profile this worker for ``seconds``; ``format=collapsed`` returns just the collapsed-stack file."""
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be between 0 and {PROFILE_MAX_SECONDS}")
+    if profile_lock.locked():
+        raise HTTPException(status_code=409, detail="A profile is already running on this worker")
+    async with profile_lock:
+        result = await profile_event_loop(seconds, max(interval_ms, 1), blocked_ms)
+    if format == "collapsed":
+        return Response(result["collapsed"] + "\n", media_type="text/plain", headers={
+            "Content-Disposition": f'attachment; filename="profile-{os.getpid()}.collapsed"'
+        })
+    return {"pid": os.getpid(), **result}
+
+# ==================== EVENT LOOP WATCHDOG ====================
+# A heartbeat coroutine wakes every LOOP_WATCHDOG_INTERVAL_MS and records how
+# late it was. A watchdog thread watches the heartbeat; when it stops for
+# LOOP_BLOCK_THRESHOLD_MS the loop thread's stack is captured. Once the loop is
+# free again the stall is logged with that stack and counted against the
+# endpoint whose handler was on it.
+
+LOOP_BLOCK_THRESHOLD_MS = float(os.environ.get('LOOP_BLOCK_THRESHOLD_MS', '100'))
+# 0 turns the watchdog off
+LOOP_WATCHDOG_INTERVAL_MS = float(os.environ.get('LOOP_WATCHDOG_INTERVAL_MS', '50'))
+endpoint_labels: Dict[Any, str] = {}
+loop_watchdog: Optional["LoopWatchdog"] = None
+
+def stall_route(frame) -> str:
+    """Label the stalled code by the endpoint on its stack, or the server.py task running it."""
+    if not endpoint_labels:
+        for route in app.routes:
+            if hasattr(route, "endpoint") and getattr(route, "methods", None):
+                endpoint_labels[route.endpoint.__code__] = f"{','.join(sorted(route.methods))} {route.path}"
+    outermost = None
+    while frame is not None:
+        if frame.f_code in endpoint_labels:
+            return endpoint_labels[frame.f_code]
+        if frame.f_code.co_filename == __file__:
+            outermost = frame.f_code.co_name
+        frame = frame.f_back
+    return f"task:{outermost}" if outermost else "unknown"
+
+class LoopWatchdog(threading.Thread):
+    def __init__(self, thread_id: int, threshold_ms: float, interval_ms: float):
+        super().__init__(name="loop-watchdog", daemon=True)
+        self.thread_id = thread_id
+        self.threshold = threshold_ms / 1000
+        self.interval = interval_ms / 1000
+        self.heartbeat = time.perf_counter()
+        self.stop = threading.Event()
+
+    def run(self):
+        stall = None
+        while not self.stop.wait(self.interval / 2):
+            blocked = time.perf_counter() - self.heartbeat - self.interval
+            if blocked >= self.threshold:
+                if stall is None:
+                    frame = sys._current_frames().get(self.thread_id)
+                    if frame is None:
+                        return
+                    stall = {"route": stall_route(frame), "stack": "".join(traceback.format_stack(frame))}
+                    del frame
+                stall["blocked"] = blocked
+            elif stall is not None:
+                self.report(stall)
+                stall = None
+
+    @staticmethod
+    def report(stall: dict):
+        EVENT_LOOP_STALLS.labels(stall["route"]).inc()
+        EVENT_LOOP_STALL_SECONDS.labels(stall["route"]).observe(stall["blocked"])
+        logger.warning("Event loop blocked for %.0fms by %s\n%s", stall["blocked"] * 1000, stall["route"], stall["stack"])
+
+async def loop_heartbeat(watchdog: LoopWatchdog):
+    while not watchdog.stop.is_set():
+        before = time.perf_counter()
+        await asyncio.sleep(watchdog.interval)
+        watchdog.heartbeat = time.perf_counter()
+        EVENT_LOOP_LAG_SECONDS.observe(max(0.0, watchdog.heartbeat - before - watchdog.interval))
+
+def start_loop_watchdog() -> Optional[asyncio.Task]:
+    """Start the watchdog thread; returns the heartbeat task that feeds it."""
+    global loop_watchdog
+    if LOOP_WATCHDOG_INTERVAL_MS <= 0:
+        return None
+    loop_watchdog = LoopWatchdog(threading.get_ident(), LOOP_BLOCK_THRESHOLD_MS, LOOP_WATCHDOG_INTERVAL_MS)
+    loop_watchdog.start()
+    return asyncio.create_task(loop_heartbeat(loop_watchdog))
+
+def stop_loop_watchdog():
+    if loop_watchdog is not None:
+        loop_watchdog.stop.set()
 
 # ==================== INIT ADMIN ====================
 
@@ -887,13 +3505,13 @@ async def init_admin():
         return {"message": "Admin exists", "created": False}
     
     admin_id = str(uuid.uuid4())
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
     
     # Create Admin
     await db.users.insert_one({
         "id": admin_id,
         "email": "admin@dealcentric.com",
-        "password": hash_password("Admin@123"),
+        "password": await run_bcrypt(hash_password, "Admin@123"),
         "name": "System Administrator",
         "role": UserRole.ADMIN,
         "is_active": True,
@@ -905,7 +3523,7 @@ async def init_admin():
     await db.users.insert_one({
         "id": agent_id,
         "email": "agent@dealcentric.com",
-        "password": hash_password("Agent@123"),
+        "password": await run_bcrypt(hash_password, "Agent@123"),
         "name": "John Agent",
         "role": UserRole.SALES_AGENT,
         "commission_rate": 5.0,
@@ -920,7 +3538,7 @@ async def init_admin():
     await db.users.insert_one({
         "id": pm_id,
         "email": "pm@dealcentric.com",
-        "password": hash_password("PM@123"),
+        "password": await run_bcrypt(hash_password, "PM@123"),
         "name": "Sarah Manager",
         "role": UserRole.PROJECT_MANAGER,
         "is_active": True,
@@ -932,7 +3550,7 @@ async def init_admin():
     await db.users.insert_one({
         "id": supervisor_id,
         "email": "supervisor@dealcentric.com",
-        "password": hash_password("Super@123"),
+        "password": await run_bcrypt(hash_password, "Super@123"),
         "name": "Mike Supervisor",
         "role": UserRole.SUPERVISOR,
         "is_active": True,
@@ -944,7 +3562,7 @@ async def init_admin():
     await db.users.insert_one({
         "id": fabricator_id,
         "email": "fab@dealcentric.com",
-        "password": hash_password("Fab@123"),
+        "password": await run_bcrypt(hash_password, "Fab@123"),
         "name": "Tony Fabricator",
         "role": UserRole.FABRICATOR,
         "is_active": True,
@@ -956,7 +3574,7 @@ async def init_admin():
     await db.users.insert_one({
         "id": partner_id,
         "email": "partner@dealcentric.com",
-        "password": hash_password("Partner@123"),
+        "password": await run_bcrypt(hash_password, "Partner@123"),
         "name": "Lisa Partner",
         "role": UserRole.PARTNER,
         "company": "Partner Corp",
@@ -969,7 +3587,7 @@ async def init_admin():
     await db.users.insert_one({
         "id": client_b2b_id,
         "email": "client@dealcentric.com",
-        "password": hash_password("Client@123"),
+        "password": await run_bcrypt(hash_password, "Client@123"),
         "name": "ABC Corporation",
         "role": UserRole.CLIENT_B2B,
         "company": "ABC Corp",
@@ -982,7 +3600,7 @@ async def init_admin():
     await db.users.insert_one({
         "id": client_res_id,
         "email": "homeowner@dealcentric.com",
-        "password": hash_password("Home@123"),
+        "password": await run_bcrypt(hash_password, "Home@123"),
         "name": "David Homeowner",
         "role": UserRole.CLIENT_RESIDENTIAL,
         "is_active": True,
@@ -1007,7 +3625,7 @@ async def init_admin():
 @api_router.post("/seed-demo")
 async def seed_demo_users():
     """Seed demo users if they don't exist - useful for testing all roles"""
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
     created = []
     
     demo_users = [
@@ -1025,7 +3643,7 @@ async def seed_demo_users():
             user_doc = {
                 "id": user_id,
                 "email": user_data["email"],
-                "password": hash_password(user_data["password"]),
+                "password": await run_bcrypt(hash_password, user_data["password"]),
                 "name": user_data["name"],
                 "role": user_data["role"],
                 "company": user_data.get("company"),
@@ -1045,17 +3663,448 @@ async def seed_demo_users():
 async def root():
     return {"message": "Deal-Centric PMS API", "version": "2.0.0"}
 
+# ==================== IDEMPOTENCY ====================
+# POST requests carrying an Idempotency-Key header are recorded per user in
+# ``idempotency_keys``. A retry with the same key replays the stored response
+# instead of running the handler again; a duplicate that arrives while the first
+# request is still running waits for it, and a reuse of the key for a different
+# request is refused with 422. Entries expire through a TTL index on
+# ``created_at``, which is stored as a native datetime for that reason.
+
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', str(24 * 3600)))
+IDEMPOTENCY_WAIT_SECONDS = float(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', '30'))
+IDEMPOTENCY_LOCK_SECONDS = int(os.environ.get('IDEMPOTENCY_LOCK_SECONDS', '300'))
+IDEMPOTENCY_MAX_BODY_BYTES = 1024 * 1024
+# Request bodies are held until the app reads them; past this size they spill to a temp file
+IDEMPOTENCY_SPOOL_BYTES = int(os.environ.get('IDEMPOTENCY_SPOOL_BYTES', str(1024 * 1024)))
+IDEMPOTENCY_CHUNK_BYTES = 64 * 1024
+# Not replayed: per-connection headers, and ones describing the original run rather than the result
+IDEMPOTENCY_SKIPPED_HEADERS = {
+    b"connection", b"keep-alive", b"proxy-authenticate", b"proxy-authorization", b"te", b"trailer",
+    b"transfer-encoding", b"upgrade", b"date", b"server", b"server-timing"
+}
+
+class RequestFingerprint:
+    """SHA-256 of a request, computed as its body streams in.
+
+    Multipart bodies are hashed per part (field name, filename and content) so
+    the random boundary a client picks on every retry doesn't change the result.
+    """
+
+    def __init__(self, scope, content_type: str):
+        self.digest = hashlib.sha256(scope["path"].encode("utf-8") + b"?" + scope.get("query_string", b""))
+        self.parts: List[Tuple[str, str, str]] = []
+        self.parser = None
+        mime, options = parse_options_header(content_type)
+        if mime == b"multipart/form-data" and options.get(b"boundary"):
+            self.parser = MultipartParser(options[b"boundary"], {
+                "on_part_begin": self._part_begin,
+                "on_part_data": lambda data, start, end: self._part[2].update(data[start:end]),
+                "on_part_end": self._part_end,
+                "on_header_field": lambda data, start, end: self._header[0].extend(data[start:end]),
+                "on_header_value": lambda data, start, end: self._header[1].extend(data[start:end]),
+                "on_header_end": self._header_end
+            })
+
+    def _part_begin(self):
+        self._part = ["", "", hashlib.sha256()]
+        self._header = (bytearray(), bytearray())
+
+    def _header_end(self):
+        field, value = self._header
+        if bytes(field).lower() == b"content-disposition":
+            _, options = parse_options_header(bytes(value))
+            self._part[0] = options.get(b"name", b"").decode("utf-8", "replace")
+            self._part[1] = options.get(b"filename", b"").decode("utf-8", "replace")
+        self._header = (bytearray(), bytearray())
+
+    def _part_end(self):
+        name, filename, content = self._part
+        self.parts.append((name, filename, content.hexdigest()))
+
+    def update(self, chunk: bytes):
+        if self.parser:
+            self.parser.write(chunk)
+        else:
+            self.digest.update(chunk)
+
+    def hexdigest(self) -> str:
+        if self.parser:
+            self.parser.finalize()
+            # Fields are matched by name, whatever order the client sent them in
+            self.digest.update(json.dumps(sorted(self.parts)).encode("utf-8"))
+        return self.digest.hexdigest()
+
+class IdempotencyMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self._inflight: Dict[str, asyncio.Event] = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            return await self.app(scope, receive, send)
+        headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+        idem_key = headers.get("idempotency-key")
+        user_id = self._user_id(headers.get("authorization", ""))
+        if not idem_key or not user_id:
+            return await self.app(scope, receive, send)
+
+        # Fingerprint the body as it arrives, keeping it to hand to the app
+        # unchanged; large uploads spill to disk rather than sit in memory
+        body = SpooledTemporaryFile(max_size=IDEMPOTENCY_SPOOL_BYTES)
+        try:
+            fingerprinter = RequestFingerprint(scope, headers.get("content-type", ""))
+            while True:
+                message = await receive()
+                chunk = message.get("body", b"")
+                fingerprinter.update(chunk)
+                body.write(chunk)
+                if not message.get("more_body"):
+                    break
+            fingerprint = fingerprinter.hexdigest()
+            body.seek(0)
+        except Exception:
+            body.close()
+            return await self._send_json(send, 400, {"detail": "Malformed request body"})
+
+        key = f"{user_id}:{scope['path']}:{idem_key}"
+        try:
+            await db.idempotency_keys.insert_one({
+                "key": key,
+                "fingerprint": fingerprint,
+                "state": "in_progress",
+                "created_at": datetime.now(timezone.utc)
+            })
+        except DuplicateKeyError:
+            body.close()
+            return await self._replay(key, fingerprint, send)
+
+        self._inflight[key] = asyncio.Event()
+        captured = {"status": 500, "headers": [], "body": []}
+
+        async def replay_receive():
+            if not body.closed:
+                chunk = body.read(IDEMPOTENCY_CHUNK_BYTES)
+                more_body = len(chunk) == IDEMPOTENCY_CHUNK_BYTES
+                if not more_body:
+                    body.close()
+                return {"type": "http.request", "body": chunk, "more_body": more_body}
+            return await receive()
+
+        async def capture_send(message):
+            if message["type"] == "http.response.start":
+                captured["status"] = message["status"]
+                captured["headers"] = message.get("headers", [])
+            elif message["type"] == "http.response.body":
+                captured["body"].append(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, replay_receive, capture_send)
+        finally:
+            body.close()
+            response_body = b"".join(captured["body"])
+            if captured["status"] >= 500 or len(response_body) > IDEMPOTENCY_MAX_BODY_BYTES:
+                # Failed (or unreplayable) attempts release the key so the client can retry
+                await db.idempotency_keys.delete_one({"key": key})
+            else:
+                content_type = dict(captured["headers"]).get(b"content-type", b"application/json")
+                await db.idempotency_keys.update_one({"key": key}, {"$set": {
+                    "state": "completed",
+                    "status_code": captured["status"],
+                    "content_type": content_type.decode("latin-1"),
+                    "headers": [
+                        [name.decode("latin-1"), value.decode("latin-1")] for name, value in captured["headers"]
+                        if name.lower() not in IDEMPOTENCY_SKIPPED_HEADERS
+                    ],
+                    "body": response_body
+                }})
+            self._inflight.pop(key).set()
+
+    def _user_id(self, authorization: str) -> Optional[str]:
+        if not authorization.lower().startswith("bearer "):
+            return None
+        try:
+            return jwt.decode(authorization[7:], JWT_SECRET, algorithms=[JWT_ALGORITHM])["user_id"]
+        except jwt.InvalidTokenError:
+            return None
+
+    async def _replay(self, key: str, fingerprint: str, send):
+        deadline = asyncio.get_running_loop().time() + IDEMPOTENCY_WAIT_SECONDS
+        while True:
+            record = await db.idempotency_keys.find_one({"key": key}, {"_id": 0})
+            if record is None:
+                # The first attempt failed and released the key
+                return await self._send_json(send, 409, {"detail": "Original request failed, retry with the same key"})
+            if record["fingerprint"] != fingerprint:
+                return await self._send_json(send, 422, {"detail": "Idempotency-Key was reused with a different request"})
+            if record["state"] == "completed":
+                # Records stored before headers were kept only have the content type
+                stored = record.get("headers") or [["content-type", record["content_type"]]]
+                await send({"type": "http.response.start", "status": record["status_code"], "headers": [
+                    *[(name.encode("latin-1"), value.encode("latin-1")) for name, value in stored],
+                    (b"idempotent-replayed", b"true")
+                ]})
+                return await send({"type": "http.response.body", "body": record["body"]})
+
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                started = record["created_at"].replace(tzinfo=timezone.utc)
+                if (datetime.now(timezone.utc) - started).total_seconds() > IDEMPOTENCY_LOCK_SECONDS:
+                    # The worker that claimed the key died; release it so the next retry runs
+                    await db.idempotency_keys.delete_one({"key": key, "state": "in_progress"})
+                return await self._send_json(send, 409, {"detail": "A request with this Idempotency-Key is still in progress"})
+            # Same-worker duplicates wake as soon as the first finishes; others poll
+            event = self._inflight.get(key)
+            try:
+                await asyncio.wait_for(event.wait() if event else asyncio.sleep(0.1), timeout=min(remaining, 1.0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send_json(self, send, status_code: int, payload: dict):
+        body = json.dumps(payload).encode("utf-8")
+        await send({"type": "http.response.start", "status": status_code, "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": body})
+
+# ==================== HEALTH ====================
+# For load balancers and uptime checks, so it needs no token. A failed ping is a
+# 503. A pool with operations queued for a connection, or nearly all of its
+# connections checked out, reports "degraded" but still answers 200.
+
+HEALTH_PING_TIMEOUT_SECONDS = float(os.environ.get('HEALTH_PING_TIMEOUT_SECONDS', '2'))
+HEALTH_POOL_DEGRADED_RATIO = float(os.environ.get('HEALTH_POOL_DEGRADED_RATIO', '0.9'))
+
+def pool_health() -> List[dict]:
+    pools = []
+    for address, pool in sorted(mongo_pool_metrics.snapshot().items()):
+        utilisation = pool["checked_out"] / pool["max_size"] if pool["max_size"] else 0
+        pools.append({"address": address, **pool, "utilisation": round(utilisation, 3)})
+    return pools
+
+@api_router.get("/health")
+async def health(response: Response):
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(client.admin.command("ping"), HEALTH_PING_TIMEOUT_SECONDS)
+        mongo = {"ok": True, "ping_ms": round((time.perf_counter() - started) * 1000, 2)}
+    except Exception as e:
+        mongo = {"ok": False, "error": str(e) or type(e).__name__}
+
+    pools = pool_health()
+    if not mongo["ok"]:
+        status_text = "down"
+        response.status_code = 503
+    elif any(p["waiting"] > 0 or p["utilisation"] >= HEALTH_POOL_DEGRADED_RATIO for p in pools):
+        status_text = "degraded"
+    else:
+        status_text = "ok"
+    return {"status": status_text, "mongo": mongo, "pools": pools}
+
+@app.exception_handler(ExecutionTimeout)
+async def query_timeout_handler(request, exc: ExecutionTimeout):
+    # A read hit its maxTimeMS; the server has already killed the operation
+    logger.warning(f"Query exceeded its time limit on {request.method} {request.url.path}: {exc}")
+    return JSONResponse(status_code=503, content={"detail": "Query took too long, try again or narrow the request"})
+
+# ==================== METRICS ENDPOINT ====================
+
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+class MetricsMiddleware:
+    """Observes request latency labelled by the matched route template, not the raw path."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = asyncio.get_running_loop().time()
+        status_code = 500
+        # Lets the slow query listener attribute commands to this request
+        scope_token = request_scope.set(scope)
+
+        async def record_send(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, record_send)
+        finally:
+            HTTP_REQUEST_SECONDS.labels(scope["method"], route_template(scope), str(status_code)).observe(
+                asyncio.get_running_loop().time() - started
+            )
+            request_scope.reset(scope_token)
+
+def route_template(scope) -> str:
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    if scope["path"].startswith("/uploads/"):
+        return "/uploads"
+    return "unmatched"
+
+class TracingMiddleware:
+    """Root span per request, continuing an incoming traceparent, plus Server-Timing on sampled responses."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+        span = tracer.start_span(
+            f"{scope['method']} {scope['path']}", context=propagate.extract(headers), kind=trace.SpanKind.SERVER,
+            attributes={"http.method": scope["method"], "http.target": scope["path"]}
+        )
+        if not span.is_recording():
+            with trace.use_span(span, end_on_exit=True):
+                return await self.app(scope, receive, send)
+
+        timings = []
+        timings_token = server_timings.set(timings)
+        started = time.perf_counter()
+
+        async def timed_send(message):
+            if message["type"] == "http.response.start":
+                span.set_attribute("http.status_code", message["status"])
+                header = server_timing_header(timings, (time.perf_counter() - started) * 1000, span)
+                message = {**message, "headers": [*message.get("headers", []), (b"server-timing", header.encode("latin-1"))]}
+            await send(message)
+
+        try:
+            with trace.use_span(span, end_on_exit=False, record_exception=True):
+                await self.app(scope, receive, timed_send)
+        finally:
+            span.update_name(f"{scope['method']} {route_template(scope)}")
+            span.set_attribute("http.route", route_template(scope))
+            span.end()
+            server_timings.reset(timings_token)
+
+def server_timing_header(timings: List[Tuple[str, float]], total_ms: float, span) -> str:
+    """Child span durations summed per span name, e.g. ``mongo-find-deals;desc="mongo find deals x3";dur=4.2``."""
+    by_name: Dict[str, List[float]] = {}
+    for name, duration in timings:
+        by_name.setdefault(name, []).append(duration)
+    entries = [
+        f'{re.sub(r"[^A-Za-z0-9_.-]", "-", name)};desc="{name} x{len(durations)}";dur={sum(durations):.1f}'
+        for name, durations in by_name.items()
+    ]
+    entries.append(f"total;dur={total_ms:.1f}")
+    entries.append(f'trace;desc="{trace.format_trace_id(span.get_span_context().trace_id)}"')
+    return ", ".join(entries)
+
+@api_router.get("/admin/traces")
+async def get_traces(limit: int = 20, min_ms: float = 0, current_user: dict = Depends(require_roles([UserRole.ADMIN]))):
+    """Most recent sampled traces from the in-process buffer, slowest spans first within each."""
+    traces: Dict[int, dict] = {}
+    for span in reversed(recent_spans.spans):
+        entry = traces.setdefault(span.context.trace_id, {"trace_id": trace.format_trace_id(span.context.trace_id), "spans": []})
+        duration_ms = round((span.end_time - span.start_time) / 1e6, 2)
+        if is_root_span(span):
+            entry.update({"name": span.name, "duration_ms": duration_ms,
+                          "start": datetime.fromtimestamp(span.start_time / 1e9, timezone.utc)})
+        else:
+            entry["spans"].append({"name": span.name, "duration_ms": duration_ms, "attributes": dict(span.attributes)})
+    result = [t for t in traces.values() if "name" in t and t["duration_ms"] >= min_ms][:min(limit, 200)]
+    for t in result:
+        t["spans"].sort(key=lambda s: s["duration_ms"], reverse=True)
+    return result
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics(authorization: Optional[str] = Header(None)):
+    if METRICS_TOKEN and authorization != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        # Set by serve.py: aggregate every worker's samples, not just this one's
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 # Include router
 app.include_router(api_router)
 
+app.add_middleware(IdempotencyMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "Idempotent-Replayed", "Server-Timing"],
 )
 
-@app.on_event("shutdown")
+app.add_middleware(MetricsMiddleware)
+
+app.add_middleware(TracingMiddleware)
+
+# Proxies whose X-Forwarded-For and X-Forwarded-Proto are believed: comma-separated
+# IPs, or "*" when nothing can reach the app except through the proxy. Login rate
+# limits key on the client address, so a reverse proxy or ingress must be listed
+# here; otherwise every user shares the proxy's address and its limits. Added
+# last so it runs first and every middleware sees the real client.
+TRUSTED_PROXIES = os.environ.get('TRUSTED_PROXIES', '127.0.0.1')
+app.add_middleware(ProxyHeadersMiddleware, trusted_hosts=TRUSTED_PROXIES)
+
+async def create_indexes():
+    await db.commission_releases.create_index("id", unique=True)
+    for collection in (db.users, db.deals, db.tasks, db.quotations, db.documents, db.commissions):
+        await collection.create_index("id")
+    await db.users.create_index("email")
+    await db.users.create_index("role")
+    await db.commissions.create_index("deal_id")
+    await db.commissions.create_index("agent_id")
+    await db.quotations.create_index("deal_id")
+    await db.documents.create_index("deal_id")
+    await db.documents.create_index("approval_status")
+    await db.tasks.create_index([("end_date", 1), ("status", 1)])
+    await db.payments.create_index("deal_id")
+    await db.notifications.create_index([("user_id", 1), ("created_at", -1)])
+    await db.idempotency_keys.create_index("key", unique=True)
+    await db.login_limits.create_index("expires_at", expireAfterSeconds=0)
+    for collection in (db.deals, db.tasks):
+        await collection.create_index("change_seq")
+    for field in ("assigned_pm", "assigned_supervisor", "assigned_fabricators", "referral_agent_id", "partner_ids",
+                  "client_email", "client_id"):
+        await db.deals.create_index([(field, 1), ("change_seq", 1)])
+    await db.tasks.create_index([("assigned_to", 1), ("change_seq", 1)])
+    await db.tasks.create_index([("deal_id", 1), ("change_seq", 1)])
+    await db.progress_updates.create_index([("deal_id", 1), ("change_seq", 1)])
+    await db.messages.create_index([("deal_id", 1), ("change_seq", 1)])
+    await db.sync_tombstones.create_index([("user_id", 1), ("change_seq", 1)])
+    await db.activity_logs.create_index([("audience", 1), ("timestamp", -1), ("id", -1)])
+    await db.activity_logs.create_index("expires_at", expireAfterSeconds=0)
+    await db.deals.create_index([("stage", 1), ("updated_at", 1)])
+    await db.archive_deals.create_index("id")
+    for name in ARCHIVED_CHILDREN:
+        await getattr(db, f"archive_{name}").create_index("deal_id")
+    await db.deals.create_index(
+        [("name", "text"), ("client_name", "text"), ("client_email", "text")],
+        weights={"name": 10, "client_name": 5, "client_email": 3}, name="deals_text"
+    )
+    await db.deals.create_index("name_lc")
+    await db.deals.create_index("client_name_lc")
+    await db.deals.create_index("client_email_lc")
+    await db.documents.create_index("name_lc")
+    await db.documents.create_index([("name", "text")], name="documents_text")
+    await db.messages.create_index([("content", "text")], name="messages_text")
+    await db.idempotency_keys.create_index("created_at", expireAfterSeconds=IDEMPOTENCY_TTL_SECONDS)
+
+async def run_startup_migrations():
+    await asyncio.gather(
+        backfill_change_seq(),
+        backfill_activity_audience(),
+        migrate_datetimes(),
+        migrate_binary_ids(),
+        backfill_activity_expiry(),
+        backfill_trigger_ids(),
+        backfill_typeahead_fields()
+    )
+
 async def shutdown_db_client():
+    stop_loop_watchdog()
+    await coordinator.stop()
     client.close()
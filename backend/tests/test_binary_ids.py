@@ -0,0 +1,70 @@
+"""
+Binary id encoding tests - uuid strings in bulk write requests become binary UUIDs
+Runs in-process; nothing connects to MongoDB.
+    pytest tests/test_binary_ids.py
+"""
+import os
+import sys
+import uuid
+from pathlib import Path
+
+import pytest
+from bson import Binary
+from pymongo import InsertOne, UpdateOne, UpdateMany, ReplaceOne, DeleteOne, DeleteMany
+from pymongo.operations import IndexModel
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "binary_ids")
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import server  # noqa: E402
+
+DEAL_ID = str(uuid.uuid4())
+USER_ID = str(uuid.uuid4())
+BINARY_USER_ID = Binary.from_uuid(uuid.UUID(USER_ID))
+
+
+class TestEncodeIdOperation:
+    """Test every bulk write request type has its id fields encoded"""
+
+    def test_insert_one(self):
+        """Test an inserted document's ids are encoded"""
+        op = server.encode_id_operation(InsertOne({"id": USER_ID, "name": "n"}))
+        assert op._doc == {"id": BINARY_USER_ID, "name": "n"}
+        print("✓ InsertOne document encoded")
+
+    @pytest.mark.parametrize("request_type", [UpdateOne, UpdateMany])
+    def test_updates(self, request_type):
+        """Test an update's filter and the ids it sets are encoded"""
+        op = server.encode_id_operation(request_type({"deal_id": DEAL_ID}, {"$set": {"assigned_pm": USER_ID, "name": "n"}}))
+        assert op._filter == server.encode_id_filter({"deal_id": DEAL_ID})
+        assert op._doc == {"$set": {"assigned_pm": BINARY_USER_ID, "name": "n"}}
+        print(f"✓ {request_type.__name__} filter and update encoded")
+
+    def test_replace_one(self):
+        """Test a replacement's filter and document are encoded"""
+        op = server.encode_id_operation(ReplaceOne({"id": DEAL_ID}, {"id": DEAL_ID, "assigned_pm": USER_ID}))
+        assert op._filter == server.encode_id_filter({"id": DEAL_ID})
+        assert op._doc["assigned_pm"] == BINARY_USER_ID
+        print("✓ ReplaceOne filter and document encoded")
+
+    @pytest.mark.parametrize("request_type", [DeleteOne, DeleteMany])
+    def test_deletes(self, request_type):
+        """Test a delete's filter is encoded"""
+        op = server.encode_id_operation(request_type({"user_id": USER_ID}))
+        assert op._filter == server.encode_id_filter({"user_id": USER_ID})
+        assert op._filter != {"user_id": USER_ID}
+        print(f"✓ {request_type.__name__} filter encoded")
+
+    def test_original_request_unchanged(self):
+        """Test the caller's request object is left as it was"""
+        original = UpdateMany({"deal_id": DEAL_ID}, {"$set": {"assigned_pm": USER_ID}})
+        server.encode_id_operation(original)
+        assert original._doc == {"$set": {"assigned_pm": USER_ID}}
+        print("✓ Original request untouched")
+
+    def test_unknown_request_rejected(self):
+        """Test a request type with no encoding raises instead of passing ids through"""
+        with pytest.raises(TypeError):
+            server.encode_id_operation(IndexModel("id"))
+        print("✓ Unknown request type rejected")
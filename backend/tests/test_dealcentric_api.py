@@ -5,6 +5,8 @@ Tests all user roles, authentication, deals, messages, documents, and dashboard
 import pytest
 import requests
 import os
+import uuid
+import time
 
 BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', 'https://pmsdash-2.preview.emergentagent.com')
 
@@ -515,6 +517,89 @@ class TestCommissions:
         print(f"✓ Get commissions: {len(commissions)} commission records")
 
 
+class TestCommissionEngine:
+    """Test milestone trigger evaluation for commissions"""
+    
+    @pytest.fixture(scope="class")
+    def admin_token(self):
+        response = requests.post(f"{BASE_URL}/api/auth/login", json=TEST_USERS["admin"])
+        if response.status_code == 200:
+            return response.json()["token"]
+        pytest.skip("Admin login failed")
+    
+    @pytest.fixture(scope="class")
+    def agent_token(self):
+        response = requests.post(f"{BASE_URL}/api/auth/login", json=TEST_USERS["sales_agent"])
+        if response.status_code == 200:
+            return response.json()["token"]
+        pytest.skip("Agent login failed")
+    
+    def test_release_preview(self, admin_token):
+        """Test dry-run report of releases due today"""
+        response = requests.get(f"{BASE_URL}/api/commissions/releases/preview", headers={
+            "Authorization": f"Bearer {admin_token}"
+        })
+        assert response.status_code == 200
+        report = response.json()
+        assert "total_amount" in report
+        assert isinstance(report["releases"], list)
+        print(f"✓ Release preview: {report['count']} releases due")
+    
+    def test_release_run_is_idempotent(self, admin_token):
+        """Test that running the engine twice releases nothing the second time"""
+        headers = {"Authorization": f"Bearer {admin_token}"}
+        requests.post(f"{BASE_URL}/api/commissions/releases/run", headers=headers)
+        response = requests.post(f"{BASE_URL}/api/commissions/releases/run", headers=headers)
+        assert response.status_code == 200
+        assert response.json()["count"] == 0
+        print("✓ Second release run applied nothing")
+    
+    def test_invalid_trigger_rejected(self, admin_token):
+        """Test that unknown trigger types are rejected"""
+        response = requests.post(f"{BASE_URL}/api/commissions", json={
+            "deal_id": "missing",
+            "agent_id": "missing",
+            "rate": 5,
+            "milestone_triggers": [{"type": "bogus", "percentage": 10}]
+        }, headers={"Authorization": f"Bearer {admin_token}"})
+        assert response.status_code == 400
+        print("✓ Invalid trigger rejected")
+    
+    def test_trigger_ids_survive_reordering(self, admin_token):
+        """Test that triggers get ids and keep them when the list is reordered"""
+        headers = {"Authorization": f"Bearer {admin_token}"}
+        deals = requests.get(f"{BASE_URL}/api/deals", headers=headers).json()
+        if not deals:
+            pytest.skip("No deals to attach a commission to")
+        me = requests.get(f"{BASE_URL}/api/auth/me", headers=headers).json()
+        response = requests.post(f"{BASE_URL}/api/commissions", json={
+            "deal_id": deals[0]["id"],
+            "agent_id": me["id"],
+            "rate": 1,
+            "milestone_triggers": [
+                {"type": "progress", "threshold": 101, "percentage": 10},
+                {"type": "payment", "threshold": 101, "percentage": 10}
+            ]
+        }, headers=headers)
+        assert response.status_code == 200
+        comm = response.json()
+        triggers = comm["milestone_triggers"]
+        assert all(t.get("id") for t in triggers)
+        
+        response = requests.put(f"{BASE_URL}/api/commissions/{comm['id']}/triggers", json=triggers[::-1], headers=headers)
+        assert response.status_code == 200
+        assert [t["id"] for t in response.json()["milestone_triggers"]] == [t["id"] for t in triggers[::-1]]
+        print("✓ Trigger ids kept across reordering")
+    
+    def test_agent_cannot_run_releases(self, agent_token):
+        """Test that only admins can run the engine"""
+        response = requests.post(f"{BASE_URL}/api/commissions/releases/run", headers={
+            "Authorization": f"Bearer {agent_token}"
+        })
+        assert response.status_code == 403
+        print("✓ Agent correctly denied release run")
+
+
 class TestDocuments:
     """Test document management"""
     
@@ -572,5 +657,726 @@ class TestRoleBasedAccess:
         print(f"✓ Fabricator stats: {stats.get('assigned_jobs', 0)} assigned jobs")
 
 
+class TestCommissionSimulation:
+    """Test what-if commission rate simulation"""
+    
+    @pytest.fixture(scope="class")
+    def admin_token(self):
+        response = requests.post(f"{BASE_URL}/api/auth/login", json=TEST_USERS["admin"])
+        if response.status_code == 200:
+            return response.json()["token"]
+        pytest.skip("Admin login failed")
+    
+    def test_simulate_rate_change(self, admin_token):
+        """Test raising rates on large deals returns per-agent deltas"""
+        response = requests.post(f"{BASE_URL}/api/commissions/simulate", json={
+            "rules": [{"rate": 6, "min_deal_value": 10000}]
+        }, headers={"Authorization": f"Bearer {admin_token}"})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["delta_total"] >= 0
+        assert isinstance(data["by_agent"], list)
+        print(f"✓ Simulation delta: {data['delta_total']} over {data['commissions']} commissions")
+    
+    def test_simulate_unknown_stage(self, admin_token):
+        """Test that rules with unknown stages are rejected"""
+        response = requests.post(f"{BASE_URL}/api/commissions/simulate", json={
+            "rules": [{"rate": 6, "stages": ["nowhere"]}]
+        }, headers={"Authorization": f"Bearer {admin_token}"})
+        assert response.status_code == 400
+        print("✓ Unknown stage rejected")
+
+
+class TestStageTransitions:
+    """Test the deal stage state machine"""
+    
+    @pytest.fixture(scope="class")
+    def admin_token(self):
+        response = requests.post(f"{BASE_URL}/api/auth/login", json=TEST_USERS["admin"])
+        if response.status_code == 200:
+            return response.json()["token"]
+        pytest.skip("Admin login failed")
+    
+    @pytest.fixture(scope="class")
+    def deal_id(self, admin_token):
+        response = requests.post(f"{BASE_URL}/api/deals", json={
+            "name": "TEST_Stage Transition Deal",
+            "client_name": "Transition Client",
+            "client_type": "B2B",
+            "service_types": ["fabrication"],
+            "estimated_value": 10000
+        }, headers={"Authorization": f"Bearer {admin_token}"})
+        if response.status_code == 200:
+            return response.json()["id"]
+        pytest.skip("Deal creation failed")
+    
+    def test_invalid_transition_rejected(self, admin_token, deal_id):
+        """Test that an inquiry cannot jump straight to completed"""
+        response = requests.put(f"{BASE_URL}/api/deals/{deal_id}", json={
+            "stage": "completed"
+        }, headers={"Authorization": f"Bearer {admin_token}"})
+        assert response.status_code == 400
+        print("✓ inquiry -> completed rejected")
+    
+    def test_contract_transition_sets_value(self, admin_token, deal_id):
+        """Test moving through quotation into contract"""
+        headers = {"Authorization": f"Bearer {admin_token}"}
+        response = requests.put(f"{BASE_URL}/api/deals/{deal_id}", json={"stage": "quotation"}, headers=headers)
+        assert response.status_code == 200
+        response = requests.put(f"{BASE_URL}/api/deals/{deal_id}", json={
+            "stage": "contract",
+            "contract_value": 12000
+        }, headers=headers)
+        assert response.status_code == 200
+        data = response.json()
+        assert data["stage"] == "contract"
+        assert data["contract_value"] == 12000
+        print("✓ Deal moved to contract")
+    
+    def test_get_notifications(self, admin_token):
+        """Test listing notifications for the current user"""
+        response = requests.get(f"{BASE_URL}/api/notifications", headers={
+            "Authorization": f"Bearer {admin_token}"
+        })
+        assert response.status_code == 200
+        assert isinstance(response.json(), list)
+        print("✓ Notifications listed")
+
+
+class TestOptimisticConcurrency:
+    """Test revision-based conditional writes"""
+    
+    @pytest.fixture(scope="class")
+    def admin_token(self):
+        response = requests.post(f"{BASE_URL}/api/auth/login", json=TEST_USERS["admin"])
+        if response.status_code == 200:
+            return response.json()["token"]
+        pytest.skip("Admin login failed")
+    
+    @pytest.fixture(scope="class")
+    def deal(self, admin_token):
+        response = requests.post(f"{BASE_URL}/api/deals", json={
+            "name": "TEST_Concurrency Deal",
+            "client_name": "Concurrency Client",
+            "client_type": "B2B",
+            "service_types": ["fabrication"],
+            "estimated_value": 10000
+        }, headers={"Authorization": f"Bearer {admin_token}"})
+        if response.status_code == 200:
+            return response.json()
+        pytest.skip("Deal creation failed")
+    
+    def test_deal_has_etag(self, admin_token, deal):
+        """Test that reading a deal returns its revision as ETag"""
+        response = requests.get(f"{BASE_URL}/api/deals/{deal['id']}", headers={
+            "Authorization": f"Bearer {admin_token}"
+        })
+        assert response.status_code == 200
+        assert response.headers.get("ETag") == f'"{deal["revision"]}"'
+        print(f"✓ Deal ETag: {response.headers.get('ETag')}")
+    
+    def test_stale_if_match_conflicts(self, admin_token, deal):
+        """Test that a write with a stale revision returns 409"""
+        headers = {"Authorization": f"Bearer {admin_token}", "If-Match": f'"{deal["revision"]}"'}
+        response = requests.put(f"{BASE_URL}/api/deals/{deal['id']}", json={"name": "TEST_First Writer"}, headers=headers)
+        assert response.status_code == 200
+        response = requests.put(f"{BASE_URL}/api/deals/{deal['id']}", json={"name": "TEST_Second Writer"}, headers=headers)
+        assert response.status_code == 409
+        print("✓ Stale If-Match rejected with 409")
+
+
+class TestIdempotency:
+    """Test Idempotency-Key replay on POST endpoints"""
+    
+    @pytest.fixture(scope="class")
+    def admin_token(self):
+        response = requests.post(f"{BASE_URL}/api/auth/login", json=TEST_USERS["admin"])
+        if response.status_code == 200:
+            return response.json()["token"]
+        pytest.skip("Admin login failed")
+    
+    def test_retry_replays_response(self, admin_token):
+        """Test that retrying with the same key returns the same deal"""
+        headers = {"Authorization": f"Bearer {admin_token}", "Idempotency-Key": f"TEST_{uuid.uuid4()}"}
+        deal_data = {
+            "name": "TEST_Idempotent Deal",
+            "client_name": "Retry Client",
+            "client_type": "B2B",
+            "service_types": ["fabrication"],
+            "estimated_value": 10000
+        }
+        first = requests.post(f"{BASE_URL}/api/deals", json=deal_data, headers=headers)
+        second = requests.post(f"{BASE_URL}/api/deals", json=deal_data, headers=headers)
+        assert first.status_code == 200
+        assert second.status_code == 200
+        assert first.json()["id"] == second.json()["id"]
+        assert second.headers.get("Idempotent-Replayed") == "true"
+        print(f"✓ Retry replayed deal {first.json()['id'][:8]}...")
+    
+    def test_key_reuse_with_different_body(self, admin_token):
+        """Test that reusing a key for a different request is rejected"""
+        headers = {"Authorization": f"Bearer {admin_token}", "Idempotency-Key": f"TEST_{uuid.uuid4()}"}
+        deal_data = {
+            "name": "TEST_Idempotent Deal A",
+            "client_name": "Retry Client",
+            "client_type": "B2B",
+            "service_types": ["fabrication"],
+            "estimated_value": 10000
+        }
+        requests.post(f"{BASE_URL}/api/deals", json=deal_data, headers=headers)
+        response = requests.post(f"{BASE_URL}/api/deals", json={**deal_data, "name": "TEST_Idempotent Deal B"}, headers=headers)
+        assert response.status_code == 422
+        print("✓ Key reuse with different body rejected")
+    
+    def test_replay_keeps_etag(self, admin_token):
+        """Test that a replayed response carries the original ETag"""
+        auth = {"Authorization": f"Bearer {admin_token}"}
+        deals = requests.get(f"{BASE_URL}/api/deals", headers=auth).json()
+        if not deals:
+            pytest.skip("No deals to update")
+        headers = {**auth, "Idempotency-Key": f"TEST_{uuid.uuid4()}"}
+        data = {"deal_id": deals[0]["id"], "notes": "TEST_Idempotent progress", "progress_percentage": "10"}
+        first = requests.post(f"{BASE_URL}/api/progress-updates", data=data, headers=headers)
+        second = requests.post(f"{BASE_URL}/api/progress-updates", data=data, headers=headers)
+        assert first.status_code == 200
+        assert second.headers.get("Idempotent-Replayed") == "true"
+        assert second.headers.get("ETag") == first.headers.get("ETag")
+        print(f"✓ Replay kept ETag {first.headers.get('ETag')}")
+
+
+class TestDeltaSync:
+    """Test delta sync for offline clients"""
+    
+    @pytest.fixture(scope="class")
+    def supervisor_token(self):
+        response = requests.post(f"{BASE_URL}/api/auth/login", json=TEST_USERS["supervisor"])
+        if response.status_code == 200:
+            return response.json()["token"]
+        pytest.skip("Supervisor login failed")
+    
+    def test_initial_sync(self, supervisor_token):
+        """Test a full sync returns every collection and a token"""
+        response = requests.get(f"{BASE_URL}/api/sync", headers={
+            "Authorization": f"Bearer {supervisor_token}"
+        })
+        assert response.status_code == 200
+        data = response.json()
+        for key in ["token", "deals", "tasks", "progress_updates", "messages", "tombstones"]:
+            assert key in data
+        print(f"✓ Initial sync: {len(data['deals'])} deals, token {data['token']}")
+    
+    def test_incremental_sync(self, supervisor_token):
+        """Test that syncing from the returned token never goes backwards"""
+        headers = {"Authorization": f"Bearer {supervisor_token}"}
+        token = requests.get(f"{BASE_URL}/api/sync", headers=headers).json()["token"]
+        response = requests.get(f"{BASE_URL}/api/sync?since={token}", headers=headers)
+        assert response.status_code == 200
+        assert int(response.json()["token"]) >= int(token)
+        print(f"✓ Incremental sync: {len(response.json()['deals'])} changed deals")
+    
+    def test_invalid_token(self, supervisor_token):
+        """Test that a malformed token is rejected"""
+        response = requests.get(f"{BASE_URL}/api/sync?since=abc", headers={
+            "Authorization": f"Bearer {supervisor_token}"
+        })
+        assert response.status_code == 400
+        print("✓ Invalid sync token rejected")
+
+
+class TestSearch:
+    """Test full-text search and typeahead"""
+    
+    @pytest.fixture(scope="class")
+    def admin_token(self):
+        response = requests.post(f"{BASE_URL}/api/auth/login", json=TEST_USERS["admin"])
+        if response.status_code == 200:
+            return response.json()["token"]
+        pytest.skip("Admin login failed")
+    
+    def test_full_text_search(self, admin_token):
+        """Test searching deals, documents and messages"""
+        response = requests.get(f"{BASE_URL}/api/search?q=TEST", headers={
+            "Authorization": f"Bearer {admin_token}"
+        })
+        assert response.status_code == 200
+        data = response.json()
+        for key in ["deals", "documents", "messages"]:
+            assert isinstance(data[key], list)
+        print(f"✓ Search: {len(data['deals'])} deals matched")
+    
+    def test_typeahead_prefix(self, admin_token):
+        """Test typeahead returns deals whose name starts with the prefix"""
+        response = requests.get(f"{BASE_URL}/api/search/typeahead?q=test_", headers={
+            "Authorization": f"Bearer {admin_token}"
+        })
+        assert response.status_code == 200
+        for deal in response.json():
+            fields = (deal["name"], deal["client_name"], deal.get("client_email") or "")
+            assert any(field.lower().startswith("test_") for field in fields)
+        print(f"✓ Typeahead: {len(response.json())} suggestions")
+    
+    def test_typeahead_documents(self, admin_token):
+        """Test document typeahead returns documents whose name starts with the prefix"""
+        response = requests.get(f"{BASE_URL}/api/search/typeahead?q=test_&type=documents", headers={
+            "Authorization": f"Bearer {admin_token}"
+        })
+        assert response.status_code == 200
+        for document in response.json():
+            assert document["name"].lower().startswith("test_")
+        print(f"✓ Document typeahead: {len(response.json())} suggestions")
+    
+    def test_empty_query_rejected(self, admin_token):
+        """Test that an empty search query is rejected"""
+        response = requests.get(f"{BASE_URL}/api/search?q=%20", headers={
+            "Authorization": f"Bearer {admin_token}"
+        })
+        assert response.status_code == 400
+        print("✓ Empty search rejected")
+
+
+class TestAccessScopes:
+    """Test role scoping is applied consistently across list endpoints"""
+    
+    @pytest.fixture(scope="class")
+    def admin_token(self):
+        response = requests.post(f"{BASE_URL}/api/auth/login", json=TEST_USERS["admin"])
+        if response.status_code == 200:
+            return response.json()["token"]
+        pytest.skip("Admin login failed")
+    
+    @pytest.fixture(scope="class")
+    def client_token(self):
+        response = requests.post(f"{BASE_URL}/api/auth/login", json=TEST_USERS["client_b2b"])
+        if response.status_code == 200:
+            return response.json()["token"]
+        pytest.skip("Client login failed")
+    
+    def test_client_cannot_read_other_deal(self, admin_token, client_token):
+        """Test a deal outside the client's scope is not found"""
+        response = requests.post(f"{BASE_URL}/api/deals", json={
+            "name": "TEST_Scoped Deal",
+            "client_name": "TEST_Other Client",
+            "client_email": "other@example.com",
+            "client_type": "B2B",
+            "service_types": ["Interior Fit-out"],
+            "estimated_value": 1000
+        }, headers={"Authorization": f"Bearer {admin_token}"})
+        assert response.status_code == 200
+        deal_id = response.json()["id"]
+        
+        response = requests.get(f"{BASE_URL}/api/deals/{deal_id}", headers={
+            "Authorization": f"Bearer {client_token}"
+        })
+        assert response.status_code == 404
+        
+        response = requests.get(f"{BASE_URL}/api/messages?deal_id={deal_id}", headers={
+            "Authorization": f"Bearer {client_token}"
+        })
+        assert response.status_code == 200
+        assert response.json() == []
+        print("✓ Client cannot read deals outside its scope")
+    
+    def test_client_lists_hide_internal_fields(self, client_token):
+        """Test hidden deal fields never reach clients"""
+        response = requests.get(f"{BASE_URL}/api/deals", headers={
+            "Authorization": f"Bearer {client_token}"
+        })
+        assert response.status_code == 200
+        for deal in response.json():
+            assert "internal_notes" not in deal
+            assert "referral_agent_id" not in deal
+        print(f"✓ Client sees {len(response.json())} deals without internal fields")
+    
+    def test_client_pipeline_scoped(self, admin_token, client_token):
+        """Test the pipeline only counts deals the user can see"""
+        admin = requests.get(f"{BASE_URL}/api/dashboard/pipeline", headers={
+            "Authorization": f"Bearer {admin_token}"
+        }).json()
+        client = requests.get(f"{BASE_URL}/api/dashboard/pipeline", headers={
+            "Authorization": f"Bearer {client_token}"
+        }).json()
+        assert sum(s["count"] for s in client) <= sum(s["count"] for s in admin)
+        print(f"✓ Pipeline scoped: {sum(s['count'] for s in client)} of {sum(s['count'] for s in admin)} deals")
+
+
+class TestActivityFeed:
+    """Test the role-aware activity feed"""
+    
+    @pytest.fixture(scope="class")
+    def agent_token(self):
+        response = requests.post(f"{BASE_URL}/api/auth/login", json=TEST_USERS["sales_agent"])
+        if response.status_code == 200:
+            return response.json()["token"]
+        pytest.skip("Agent login failed")
+    
+    def test_feed_pagination(self, agent_token):
+        """Test paging through the feed with the keyset cursor"""
+        headers = {"Authorization": f"Bearer {agent_token}"}
+        response = requests.get(f"{BASE_URL}/api/activity?limit=2", headers=headers)
+        assert response.status_code == 200
+        first = response.json()
+        assert len(first["items"]) <= 2
+        for entry in first["items"]:
+            assert "audience" not in entry
+        
+        if first["next_cursor"]:
+            response = requests.get(f"{BASE_URL}/api/activity", params={"limit": 2, "before": first["next_cursor"]}, headers=headers)
+            assert response.status_code == 200
+            second = response.json()
+            first_ids = {e["id"] for e in first["items"]}
+            assert not first_ids & {e["id"] for e in second["items"]}
+        print(f"✓ Activity feed: {len(first['items'])} entries on first page")
+    
+    def test_invalid_cursor_rejected(self, agent_token):
+        """Test that a malformed cursor is rejected"""
+        response = requests.get(f"{BASE_URL}/api/activity?before=not-a-cursor", headers={
+            "Authorization": f"Bearer {agent_token}"
+        })
+        assert response.status_code == 400
+        print("✓ Invalid activity cursor rejected")
+
+
+class TestArchival:
+    """Test deal archival"""
+    
+    @pytest.fixture(scope="class")
+    def admin_token(self):
+        response = requests.post(f"{BASE_URL}/api/auth/login", json=TEST_USERS["admin"])
+        if response.status_code == 200:
+            return response.json()["token"]
+        pytest.skip("Admin login failed")
+    
+    @pytest.fixture(scope="class")
+    def agent_token(self):
+        response = requests.post(f"{BASE_URL}/api/auth/login", json=TEST_USERS["sales_agent"])
+        if response.status_code == 200:
+            return response.json()["token"]
+        pytest.skip("Agent login failed")
+    
+    def test_run_archival(self, admin_token):
+        """Test the archival job reports what it moved"""
+        response = requests.post(f"{BASE_URL}/api/admin/archive/run", headers={
+            "Authorization": f"Bearer {admin_token}"
+        })
+        assert response.status_code == 200
+        archived = response.json()["archived"]
+        for key in ["deals", "tasks", "progress_updates", "documents", "messages", "quotations"]:
+            assert key in archived
+        print(f"✓ Archived {archived['deals']} deals")
+    
+    def test_archival_requires_admin(self, agent_token):
+        """Test non-admins cannot run archival"""
+        response = requests.post(f"{BASE_URL}/api/admin/archive/run", headers={
+            "Authorization": f"Bearer {agent_token}"
+        })
+        assert response.status_code == 403
+        print("✓ Agent denied archival run")
+
+
+class TestDatetimes:
+    """Test timestamps are accepted and returned as ISO datetimes"""
+    
+    @pytest.fixture(scope="class")
+    def admin_token(self):
+        response = requests.post(f"{BASE_URL}/api/auth/login", json=TEST_USERS["admin"])
+        if response.status_code == 200:
+            return response.json()["token"]
+        pytest.skip("Admin login failed")
+    
+    def test_task_dates_round_trip(self, admin_token):
+        """Test date-only task dates come back as UTC datetimes"""
+        headers = {"Authorization": f"Bearer {admin_token}"}
+        deals = requests.get(f"{BASE_URL}/api/deals", headers=headers).json()
+        if not deals:
+            pytest.skip("No deals available")
+        
+        response = requests.post(f"{BASE_URL}/api/tasks", json={
+            "deal_id": deals[0]["id"],
+            "name": "TEST_Dated Task",
+            "start_date": "2025-03-01",
+            "end_date": "2025-03-05"
+        }, headers=headers)
+        assert response.status_code == 200
+        task = response.json()
+        assert task["start_date"].startswith("2025-03-01T00:00:00")
+        assert task["end_date"].startswith("2025-03-05T00:00:00")
+        print(f"✓ Task dates stored as datetimes: {task['start_date']}")
+    
+    def test_invalid_date_rejected(self, admin_token):
+        """Test an unparseable task date is rejected"""
+        response = requests.post(f"{BASE_URL}/api/tasks", json={
+            "deal_id": "any",
+            "name": "TEST_Bad Date",
+            "start_date": "next tuesday",
+            "end_date": "2025-03-05"
+        }, headers={"Authorization": f"Bearer {admin_token}"})
+        assert response.status_code == 422
+        print("✓ Invalid task date rejected")
+
+
+class TestBinaryIds:
+    """Test ids stay canonical uuid strings in the API"""
+    
+    @pytest.fixture(scope="class")
+    def admin_token(self):
+        response = requests.post(f"{BASE_URL}/api/auth/login", json=TEST_USERS["admin"])
+        if response.status_code == 200:
+            return response.json()["token"]
+        pytest.skip("Admin login failed")
+    
+    def test_deal_ids_round_trip(self, admin_token):
+        """Test a created deal can be fetched by the string id it was given"""
+        headers = {"Authorization": f"Bearer {admin_token}"}
+        response = requests.post(f"{BASE_URL}/api/deals", json={
+            "name": "TEST_Binary Id Deal",
+            "client_name": "TEST_Client",
+            "client_type": "B2B",
+            "service_types": ["Interior Fit-out"],
+            "estimated_value": 1000
+        }, headers=headers)
+        assert response.status_code == 200
+        deal_id = response.json()["id"]
+        assert str(uuid.UUID(deal_id)) == deal_id
+        
+        response = requests.get(f"{BASE_URL}/api/deals/{deal_id}", headers=headers)
+        assert response.status_code == 200
+        assert response.json()["id"] == deal_id
+        assert isinstance(response.json()["created_by"], str)
+        print(f"✓ Deal id round-trips as string: {deal_id}")
+
+
+class TestMetrics:
+    """Test the Prometheus metrics endpoint"""
+    
+    @pytest.fixture(scope="class")
+    def admin_token(self):
+        response = requests.post(f"{BASE_URL}/api/auth/login", json=TEST_USERS["admin"])
+        if response.status_code == 200:
+            return response.json()["token"]
+        pytest.skip("Admin login failed")
+    
+    def test_route_latency_exposed(self, admin_token):
+        """Test request latency is labelled by route template"""
+        headers = {"Authorization": f"Bearer {admin_token}"}
+        assert requests.get(f"{BASE_URL}/api/deals", headers=headers).status_code == 200
+        
+        metrics_headers = {}
+        if os.environ.get("METRICS_TOKEN"):
+            metrics_headers["Authorization"] = f"Bearer {os.environ['METRICS_TOKEN']}"
+        response = requests.get(f"{BASE_URL}/metrics", headers=metrics_headers)
+        if not response.headers.get("content-type", "").startswith("text/plain"):
+            pytest.skip("/metrics is not routed to the backend")
+        assert response.status_code == 200
+        assert 'route="/api/deals"' in response.text
+        assert "mongo_command_duration_seconds" in response.text
+        print("✓ Route and Mongo command metrics exposed")
+    
+    def test_event_loop_lag_exposed(self):
+        """Test the loop watchdog exports lag"""
+        metrics_headers = {}
+        if os.environ.get("METRICS_TOKEN"):
+            metrics_headers["Authorization"] = f"Bearer {os.environ['METRICS_TOKEN']}"
+        response = requests.get(f"{BASE_URL}/metrics", headers=metrics_headers)
+        if not response.headers.get("content-type", "").startswith("text/plain"):
+            pytest.skip("/metrics is not routed to the backend")
+        assert "event_loop_lag_seconds_count" in response.text
+        print("✓ Event loop lag exposed")
+
+
+class TestSlowQueries:
+    """Test the slow query log endpoint"""
+    
+    @pytest.fixture(scope="class")
+    def admin_token(self):
+        response = requests.post(f"{BASE_URL}/api/auth/login", json=TEST_USERS["admin"])
+        if response.status_code == 200:
+            return response.json()["token"]
+        pytest.skip("Admin login failed")
+    
+    @pytest.fixture(scope="class")
+    def agent_token(self):
+        response = requests.post(f"{BASE_URL}/api/auth/login", json=TEST_USERS["sales_agent"])
+        if response.status_code == 200:
+            return response.json()["token"]
+        pytest.skip("Agent login failed")
+    
+    def test_admin_lists_offenders(self, admin_token):
+        """Test admin gets slow query shapes grouped by endpoint"""
+        headers = {"Authorization": f"Bearer {admin_token}"}
+        response = requests.get(f"{BASE_URL}/api/admin/slow-queries", headers=headers)
+        assert response.status_code == 200
+        data = response.json()
+        assert "threshold_ms" in data
+        for offender in data["offenders"]:
+            assert "shape" in offender and "route" in offender and "count" in offender
+        print(f"✓ Slow query offenders: {len(data['offenders'])}")
+    
+    def test_non_admin_denied(self, agent_token):
+        """Test the slow query log is admin only"""
+        headers = {"Authorization": f"Bearer {agent_token}"}
+        response = requests.get(f"{BASE_URL}/api/admin/slow-queries", headers=headers)
+        assert response.status_code == 403
+        print("✓ Slow query log denied to agent")
+
+
+class TestTracing:
+    """Test request tracing and Server-Timing"""
+    
+    @pytest.fixture(scope="class")
+    def admin_token(self):
+        response = requests.post(f"{BASE_URL}/api/auth/login", json=TEST_USERS["admin"])
+        if response.status_code == 200:
+            return response.json()["token"]
+        pytest.skip("Admin login failed")
+    
+    def test_sampled_parent_gets_server_timing(self, admin_token):
+        """Test a sampled traceparent is continued and timed"""
+        trace_id = uuid.uuid4().hex
+        headers = {
+            "Authorization": f"Bearer {admin_token}",
+            "traceparent": f"00-{trace_id}-{uuid.uuid4().hex[:16]}-01"
+        }
+        response = requests.get(f"{BASE_URL}/api/deals", headers=headers)
+        assert response.status_code == 200
+        timing = response.headers.get("Server-Timing", "")
+        assert "total;dur=" in timing
+        assert trace_id in timing
+        print(f"✓ Server-Timing: {timing}")
+    
+    def test_admin_lists_traces(self, admin_token):
+        """Test recent traces are listed with their spans"""
+        headers = {"Authorization": f"Bearer {admin_token}"}
+        response = requests.get(f"{BASE_URL}/api/admin/traces", headers=headers)
+        assert response.status_code == 200
+        for entry in response.json():
+            assert "trace_id" in entry and "spans" in entry
+        print(f"✓ Recent traces: {len(response.json())}")
+
+
+class TestProfiling:
+    """Test the on-demand worker profiler"""
+    
+    @pytest.fixture(scope="class")
+    def admin_token(self):
+        response = requests.post(f"{BASE_URL}/api/auth/login", json=TEST_USERS["admin"])
+        if response.status_code == 200:
+            return response.json()["token"]
+        pytest.skip("Admin login failed")
+    
+    @pytest.fixture(scope="class")
+    def agent_token(self):
+        response = requests.post(f"{BASE_URL}/api/auth/login", json=TEST_USERS["sales_agent"])
+        if response.status_code == 200:
+            return response.json()["token"]
+        pytest.skip("Agent login failed")
+    
+    def test_admin_profiles_worker(self, admin_token):
+        """Test a short profile returns collapsed stacks and loop lag"""
+        headers = {"Authorization": f"Bearer {admin_token}"}
+        response = requests.post(f"{BASE_URL}/api/admin/profile", params={"seconds": 1}, headers=headers)
+        assert response.status_code == 200
+        data = response.json()
+        assert data["samples"] > 0
+        assert data["collapsed"].splitlines()[0].rsplit(" ", 1)[1].isdigit()
+        assert "p99" in data["loop_lag_ms"]
+        assert isinstance(data["stalls"], list)
+        print(f"✓ Profile: {data['samples']} samples, lag {data['loop_lag_ms']}")
+    
+    def test_non_admin_denied(self, agent_token):
+        """Test profiling is admin only"""
+        headers = {"Authorization": f"Bearer {agent_token}"}
+        response = requests.post(f"{BASE_URL}/api/admin/profile", params={"seconds": 1}, headers=headers)
+        assert response.status_code == 403
+        print("✓ Profiler denied to agent")
+
+
+class TestHealth:
+    """Test the health endpoint"""
+    
+    def test_health_reports_mongo_and_pools(self):
+        """Test health pings Mongo and reports pool utilisation without a token"""
+        response = requests.get(f"{BASE_URL}/api/health")
+        assert response.status_code == 200
+        data = response.json()
+        assert data["status"] in ("ok", "degraded")
+        assert data["mongo"]["ok"] is True
+        assert data["mongo"]["ping_ms"] >= 0
+        for pool in data["pools"]:
+            assert 0 <= pool["utilisation"] <= 1
+            assert pool["checked_out"] <= pool["max_size"]
+        print(f"✓ Health {data['status']}, Mongo ping {data['mongo']['ping_ms']} ms, {len(data['pools'])} pool(s)")
+    
+    def test_dashboard_served_from_reporting_reads(self):
+        """Test dashboard endpoints still answer with reads routed to secondaries"""
+        response = requests.post(f"{BASE_URL}/api/auth/login", json=TEST_USERS["admin"])
+        if response.status_code != 200:
+            pytest.skip("Admin login failed")
+        headers = {"Authorization": f"Bearer {response.json()['token']}"}
+        for path in ("/api/dashboard/stats", "/api/dashboard/pipeline", "/api/commissions"):
+            assert requests.get(f"{BASE_URL}{path}", headers=headers).status_code == 200
+        print("✓ Dashboard and commission reads answer")
+
+
+class TestCoordination:
+    """Test caches stay consistent when several workers serve the API"""
+    
+    @pytest.fixture(scope="class")
+    def admin_headers(self):
+        response = requests.post(f"{BASE_URL}/api/auth/login", json=TEST_USERS["admin"])
+        if response.status_code == 200:
+            return {"Authorization": f"Bearer {response.json()['token']}"}
+        pytest.skip("Admin login failed")
+    
+    def test_commission_book_invalidated_everywhere(self, admin_headers):
+        """Test a new commission shows up in simulations served by any worker"""
+        deals = requests.get(f"{BASE_URL}/api/deals", headers=admin_headers).json()
+        if not deals:
+            pytest.skip("No deals to attach a commission to")
+        simulate = {"rules": [{"rate": 5}]}
+        before = requests.post(f"{BASE_URL}/api/commissions/simulate", json=simulate, headers=admin_headers).json()["commissions"]
+        me = requests.get(f"{BASE_URL}/api/auth/me", headers=admin_headers).json()
+        response = requests.post(f"{BASE_URL}/api/commissions", json={
+            "deal_id": deals[0]["id"], "agent_id": me["id"], "rate": 3, "milestone_triggers": []
+        }, headers=admin_headers)
+        assert response.status_code == 200
+        
+        # Other workers pick the invalidation up on their next coordination poll
+        time.sleep(float(os.environ.get("COORDINATION_POLL_SECONDS", "1")) + 1)
+        counts = {
+            requests.post(f"{BASE_URL}/api/commissions/simulate", json=simulate, headers=admin_headers).json()["commissions"]
+            for _ in range(10)
+        }
+        assert counts == {before + 1}
+        print(f"✓ Every simulation sees {before + 1} commissions")
+
+
+class TestLoginRateLimit:
+    """Test repeated failed logins are turned away before the password is checked"""
+    
+    def test_account_blocked_after_failures(self):
+        """Test an account is blocked with Retry-After once it reaches its failure limit"""
+        credentials = {"email": f"TEST_ratelimit_{uuid.uuid4().hex[:8]}@test.com", "password": "wrongpassword"}
+        for _ in range(int(os.environ.get("LOGIN_ACCOUNT_FAILURES", "5"))):
+            response = requests.post(f"{BASE_URL}/api/auth/login", json=credentials)
+            assert response.status_code == 401
+        
+        response = requests.post(f"{BASE_URL}/api/auth/login", json=credentials)
+        assert response.status_code == 429
+        assert int(response.headers["Retry-After"]) > 0
+        print(f"✓ Blocked for {response.headers['Retry-After']} seconds")
+    
+    def test_rejections_reported_in_metrics(self):
+        """Test rate-limited logins are counted"""
+        metrics_headers = {}
+        if os.environ.get("METRICS_TOKEN"):
+            metrics_headers["Authorization"] = f"Bearer {os.environ['METRICS_TOKEN']}"
+        response = requests.get(f"{BASE_URL}/metrics", headers=metrics_headers)
+        if not response.headers.get("content-type", "").startswith("text/plain"):
+            pytest.skip("/metrics is not routed to the backend")
+        assert "login_rate_limited_total" in response.text
+        assert "login_attempts_total" in response.text
+        print("✓ Login metrics exported")
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v", "--tb=short"])
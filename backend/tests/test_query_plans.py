@@ -0,0 +1,209 @@
+"""
+Query plan tests - every read endpoint, for every role, against a seeded local MongoDB
+Each Mongo command an endpoint issues is explained; a collection scan on a
+filtered query, or examining far more documents than the filter matches, fails
+that endpoint's test.
+
+Needs a disposable local MongoDB (the database is dropped afterwards):
+    QUERY_PLAN_MONGO_URL=mongodb://localhost:27017 pytest tests/test_query_plans.py
+"""
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+QUERY_PLAN_MONGO_URL = os.environ.get("QUERY_PLAN_MONGO_URL")
+if not QUERY_PLAN_MONGO_URL:
+    pytest.skip("QUERY_PLAN_MONGO_URL is not set", allow_module_level=True)
+
+import httpx
+from pymongo import monitoring
+
+os.environ.update({
+    "MONGO_URL": QUERY_PLAN_MONGO_URL,
+    "DB_NAME": os.environ.get("QUERY_PLAN_DB", "dealcentric_query_plans"),
+    "MONGO_TRANSACTIONS": "off",
+    "SLOW_QUERY_MS": "1e9"
+})
+SEED_DEALS = int(os.environ.get("QUERY_PLAN_DEALS", "2000"))
+# Documents examined per document the filter matches
+MAX_EXAMINED_PER_MATCHED = float(os.environ.get("QUERY_PLAN_MAX_RATIO", "5"))
+# Small results are not worth flagging whatever the ratio
+MIN_EXAMINED = 50
+
+# Scans that are deliberate: (collection, route) -> reason
+ALLOWED_SCANS = {
+    ("commissions", "/api/commissions/releases/preview"): "the commission book is loaded whole and cached",
+}
+
+
+class CommandCapture(monitoring.CommandListener):
+    """Collects the explainable commands issued while ``enabled``."""
+
+    def __init__(self):
+        self.enabled = False
+        self.commands = []
+
+    def started(self, event):
+        if self.enabled and event.command_name in server.SHAPE_FIELDS:
+            self.commands.append((event.database_name, event.command_name, dict(event.command)))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+# Must be registered before the server creates its client
+capture = CommandCapture()
+monitoring.register(capture)
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import server  # noqa: E402
+import seed_data  # noqa: E402
+
+ROLES = ["admin", "sales_agent", "project_manager", "supervisor", "fabricator", "partner", "client_b2b"]
+ENDPOINTS = [
+    "/api/auth/me",
+    "/api/deals",
+    "/api/deals/{deal_id}",
+    "/api/tasks",
+    "/api/tasks?deal_id={deal_id}",
+    "/api/quotations?deal_id={deal_id}",
+    "/api/progress-updates?deal_id={deal_id}",
+    "/api/documents?deal_id={deal_id}",
+    "/api/messages?deal_id={deal_id}",
+    "/api/deals/{deal_id}/payments",
+    "/api/commissions",
+    "/api/commissions/releases/preview",
+    "/api/dashboard/stats",
+    "/api/dashboard/pipeline",
+    "/api/dashboard/recent-activity",
+    "/api/activity",
+    "/api/activity?deal_id={deal_id}",
+    "/api/notifications",
+    "/api/sync",
+    "/api/search?q=harbour",
+    "/api/search/typeahead?q=ha",
+    "/api/search/typeahead?q=doc&type=documents",
+    "/api/users",
+    "/api/users?role=sales_agent",
+    "/api/users/{user_id}",
+]
+
+
+def filtered_query(command_name: str, command: dict):
+    """The find equivalent of a command's filter, or None for an unfiltered read."""
+    collection = command[command_name]
+    if command_name == "find":
+        query = command
+    elif command_name == "aggregate":
+        first = (command.get("pipeline") or [{}])[0]
+        query = {"find": collection, "filter": first.get("$match", {})}
+    elif command_name in ("count", "distinct", "findAndModify"):
+        query = {"find": collection, "filter": command.get("query") or {}}
+    else:
+        query = {"find": collection, "filter": command[f"{command_name}s"][0].get("q", {})}
+    return query if query.get("filter") else None
+
+
+@pytest.fixture(scope="module")
+def api():
+    """Seeded database, running app and a logged-in header per role."""
+    loop = asyncio.new_event_loop()
+    run = loop.run_until_complete
+    lifespan = server.app.router.lifespan_context(server.app)
+
+    async def start():
+        await server.client.drop_database(os.environ["DB_NAME"])
+        await seed_data.seed_sample(server, SEED_DEALS)
+        await lifespan.__aenter__()
+        # Let startup backfills finish so they don't show up in the captures
+        await asyncio.wait([server.app.state.migrations], timeout=120)
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://plans")
+        headers, deals = {}, {}
+        for role in ROLES:
+            response = await client.post("/api/auth/login", json={
+                "email": f"{role}.0@{seed_data.LOAD_EMAIL_DOMAIN}", "password": seed_data.LOAD_PASSWORD
+            })
+            headers[role] = {"Authorization": f"Bearer {response.json()['token']}"}
+            visible = (await client.get("/api/deals", headers=headers[role])).json()
+            deals[role] = visible[0]["id"] if visible else None
+        return client, headers, deals
+
+    client, headers, deals = run(start())
+    yield run, client, headers, deals
+
+    async def stop():
+        await client.aclose()
+        await lifespan.__aexit__(None, None, None)
+        await server.client.drop_database(os.environ["DB_NAME"])
+
+    run(stop())
+    loop.close()
+
+
+class TestQueryPlans:
+    """Test every endpoint's queries are served by indexes"""
+
+    @pytest.mark.parametrize("role", ROLES)
+    @pytest.mark.parametrize("path", ENDPOINTS)
+    def test_endpoint_uses_indexes(self, api, role, path):
+        """Test no filtered query scans the collection or over-examines"""
+        run, client, headers, deals = api
+        if "{deal_id}" in path and not deals[role]:
+            pytest.skip(f"{role} sees no deals")
+        me = run(client.get("/api/auth/me", headers=headers[role])).json()
+        url = path.format(deal_id=deals[role], user_id=me["id"])
+
+        capture.commands.clear()
+        capture.enabled = True
+        try:
+            response = run(client.get(url, headers=headers[role]))
+        finally:
+            capture.enabled = False
+        if response.status_code == 403:
+            pytest.skip(f"{path} is not available to {role}")
+        assert response.status_code == 200, response.text
+
+        route = path.split("?")[0]
+        problems = []
+        for database_name, command_name, command in list(capture.commands):
+            query = filtered_query(command_name, command)
+            if query is None:
+                continue
+            collection = command[command_name]
+            plan = server.analyze_explain(run(server.explain_command(database_name, "find", query)))
+            shape = server.command_shape("find", query)
+            if plan["collscan"] and (collection, route) not in ALLOWED_SCANS:
+                problems.append(f"COLLSCAN on {collection} for {shape}")
+            if plan["docs_examined"] >= MIN_EXAMINED and plan["examined_per_returned"] > MAX_EXAMINED_PER_MATCHED:
+                problems.append(
+                    f"{collection} examined {plan['docs_examined']} docs for {plan['returned']} matches "
+                    f"({plan['plan_stages']}) for {shape}"
+                )
+        assert not problems, "\n".join(problems)
+        print(f"✓ {role} {url}: {len(capture.commands)} commands use indexes")
+
+    @pytest.mark.parametrize("kind,q", [("deals", "h"), ("deals", "ha"), ("deals", "harbour"), ("documents", "doc")])
+    def test_typeahead_reads_in_index_order(self, api, kind, q):
+        """Test typeahead's reads need no in-memory SORT stage"""
+        run, client, headers, _ = api
+        capture.commands.clear()
+        capture.enabled = True
+        try:
+            response = run(client.get(f"/api/search/typeahead?q={q}&type={kind}", headers=headers["admin"]))
+        finally:
+            capture.enabled = False
+        assert response.status_code == 200, response.text
+
+        finds = [(database_name, command) for database_name, command_name, command in list(capture.commands)
+                 if command_name == "find" and command["find"] == kind]
+        assert len(finds) == len(server.TYPEAHEAD_FIELDS[kind])
+        for database_name, command in finds:
+            plan = server.analyze_explain(run(server.explain_command(database_name, "find", command)))
+            assert "SORT" not in plan["plan_stages"], f"in-memory sort for {server.command_shape('find', command)}"
+        print(f"✓ {kind} typeahead {q!r}: {len(response.json())} suggestions without an in-memory sort")